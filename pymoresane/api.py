@@ -0,0 +1,320 @@
+import logging
+import os
+import pyfits
+import numpy as np
+import pymoresane.checkpoint as pcheckpoint
+import pymoresane.components as components
+import pymoresane.pipeline as pipeline
+
+from pymoresane.main import FitsImage
+
+logger = logging.getLogger(__name__)
+
+
+def as_plane(data, name="data"):
+    """
+    Views an array, or any object supporting the buffer protocol, as a single image plane. Leading axes of length one,
+    e.g. the FREQ and STOKES axes of an image taken from a .fits file, are dropped. No copy is made.
+
+    INPUTS:
+    data    (no default):       Array or buffer containing the image.
+    name    (default="data"):   Name of the image, for error messages.
+
+    OUTPUTS:
+    Array of two dimensions which shares the memory of data.
+    """
+
+    data = np.asarray(data)
+
+    if (data.ndim<2) or (int(np.prod(data.shape[:-2]))!=1):
+        logger.error("The {} must be a single image plane - shape is {}.".format(name, data.shape))
+        raise ValueError("The {} must be a single image plane - shape is {}.".format(name, data.shape))
+
+    return data.reshape(data.shape[-2:])
+
+
+def make_header(pixel_size=None, header=None):
+    """
+    Creates the minimal header required by a deconvolution, which only makes use of the pixel size (CDELT1 and
+    CDELT2). The restoring beam parameters are in the units of the pixel size, so are in pixels if neither a pixel
+    size nor a header is given.
+
+    INPUTS:
+    pixel_size  (default=None): Pixel size, either a single value or a pair (CDELT1, CDELT2). A single value is taken
+                                to be the size in degrees of a square pixel, with RA increasing to the left.
+    header      (default=None): Existing header, which is copied. Its pixel size is replaced if pixel_size is given.
+
+    OUTPUTS:
+    header                      New pyfits header.
+    """
+
+    header = header.copy() if header is not None else pyfits.Header()
+
+    if pixel_size is not None:
+        if np.ndim(pixel_size)==0:
+            pixel_size = (-pixel_size, pixel_size)
+
+        header.update('CDELT1', float(pixel_size[0]))
+        header.update('CDELT2', float(pixel_size[1]))
+
+    for key in ['CDELT1', 'CDELT2']:
+        if key not in header:
+            header.update(key, 1.0)
+
+    return header
+
+
+class Deconvolution(object):
+    """
+    Deconvolves images which are already in memory, without reading or writing .fits files. The dirty image and PSF
+    may be any arrays or buffers - they are only copied if they are not single precision. The model, residual and
+    restored images are the arrays of the underlying FitsImage and are returned without copying.
+
+    A Deconvolution is used as follows:
+
+        deconvolution = Deconvolution(dirty, psf, pixel_size=cell_size)
+        model, residual = deconvolution.run(stop_scale=6, loop_gain=0.2)
+        restored = deconvolution.restore()
+
+    The FitsImage is available as the image attribute, and its hooks and profiler may be used as usual. Deconvolutions
+    of different images may be run concurrently in threads of one process, and may share a PrecomputationCache if
+    their PSFs are the same.
+    """
+
+    def __init__(self, dirty, psf, pixel_size=None, beam=None, mask=None, header=None, psf_header=None,
+                 cache_dir=None, precomputed=None, name=None):
+        """
+        INPUTS:
+        dirty       (no default):   Array or buffer containing the dirty map.
+        psf         (no default):   Array or buffer containing the PSF.
+        pixel_size  (default=None): Pixel size, see make_header.
+        beam        (default=None): Restoring beam parameters - BMAJ, BMIN and BPA, in the units of the pixel size and
+                                    in degrees respectively. The beam is fitted to the PSF if not given.
+        mask        (default=None): Array or buffer containing a deconvolution mask.
+        header      (default=None): Header of the dirty map. Only its pixel size is used by the deconvolution.
+        psf_header  (default=None): Header of the PSF. Defaults to the header of the dirty map.
+        cache_dir   (default=None): Directory in which PSF precomputations are cached between runs.
+        precomputed (default=None): PrecomputationCache of the PSF, if one already exists.
+        name        (default=None): Name of the deconvolution, which prefixes its log messages.
+        """
+
+        img_hdr = make_header(pixel_size, header)
+        psf_hdr = make_header(pixel_size, psf_header) if psf_header is not None else img_hdr.copy()
+
+        if mask is not None:
+            mask = as_plane(mask, "mask")
+
+        self.image = FitsImage.from_arrays(as_plane(dirty, "dirty image"), as_plane(psf, "PSF"), img_hdr, psf_hdr,
+                                           mask, cache_dir, precomputed, name)
+
+        if beam is not None:
+            self.image.beam_params = [float(param) for param in beam]
+
+    @classmethod
+    def from_fits(cls, dirty_name, psf_name, mask_name=None, cache_dir=None):
+        """
+        Alternative constructor which reads the dirty map, PSF and mask from .fits files, as runsane does.
+
+        INPUTS:
+        dirty_name  (no default):   Name of the input .fits file containing the dirty map.
+        psf_name    (no default):   Name of the input .fits file containing the PSF.
+        mask_name   (default=None): Name of the input .fits file containing a deconvolution mask.
+        cache_dir   (default=None): Directory in which PSF precomputations are cached between runs.
+
+        OUTPUTS:
+        deconvolution               Deconvolution of the given files.
+        """
+
+        deconvolution = cls.__new__(cls)
+        deconvolution.image = FitsImage(dirty_name, psf_name, mask_name, cache_dir)
+
+        return deconvolution
+
+    def run(self, single_run=False, facet_size=None, facet_overlap=32, facet_workers=None, facet_major_cycles=3,
+            coordinator=None, initial_model=None, checkpoint=None, checkpoint_interval=600, resume=False,
+            regions=False, region_fraction=0.5, **params):
+        """
+        Runs the deconvolution.
+
+        INPUTS:
+        single_run          (default=False):    Boolean specifier for whether FitsImage.moresane is used rather than
+                                                FitsImage.moresane_by_scale.
+        facet_size          (default=None):     If given, the image is deconvolved facet by facet with facets of this
+                                                size, see facets.deconvolve_facets.
+        facet_overlap       (default=32):       Minimum overlap, in pixels, between neighbouring facets.
+        facet_workers       (default=None):     Number of processes used in facet mode.
+        facet_major_cycles  (default=3):        Maximum number of global major cycles in facet mode.
+        coordinator         (default=None):     Coordinator which distributes the facets to remote workers.
+        initial_model       (default=None):     Array or components.ComponentList containing a model from which the
+                                                deconvolution starts, see FitsImage.warm_start.
+        checkpoint          (default=None):     File name of a checkpoint of the major loop, which is written
+                                                periodically. Unavailable in facet mode.
+        checkpoint_interval (default=600):      Minimum time, in seconds, between checkpoints.
+        resume              (default=False):    Boolean specifier for whether the deconvolution continues from the
+                                                checkpoint, if it exists. The initial model is then ignored.
+        regions             (default=False):    Boolean specifier for whether only the regions of interest which
+                                                contain significant emission are deconvolved, see
+                                                regions.deconvolve_regions. Unavailable in facet mode.
+        region_fraction     (default=0.5):      Maximum fraction of the image which the regions of interest may cover
+                                                before the full image is deconvolved instead.
+        params              (no default):       Keyword arguments for FitsImage.moresane or
+                                                FitsImage.moresane_by_scale.
+
+        OUTPUTS:
+        model                                   Array containing the model.
+        residual                                Array containing the residual.
+        """
+
+        if regions and (facet_size is not None):
+            logger.error("Regions of interest are unavailable in facet mode.")
+            raise ValueError("Regions of interest are unavailable in facet mode.")
+
+        if checkpoint is not None:
+            if facet_size is not None:
+                logger.error("Checkpoints are unavailable in facet mode.")
+                raise ValueError("Checkpoints are unavailable in facet mode.")
+            if regions:
+                logger.error("Checkpoints are unavailable with regions of interest.")
+                raise ValueError("Checkpoints are unavailable with regions of interest.")
+
+            self.image.checkpoint = pcheckpoint.Checkpoint(checkpoint, checkpoint_interval)
+
+            if resume and os.path.exists(checkpoint):
+                params["resume"] = pcheckpoint.load_checkpoint(checkpoint)
+            elif resume:
+                logger.warning("Checkpoint {} does not exist - starting from the beginning.".format(checkpoint))
+
+        if isinstance(initial_model, components.ComponentList):
+            initial_model = initial_model.to_model()
+
+        if (initial_model is not None) and ("resume" not in params):
+            self.image.warm_start(as_plane(initial_model, "initial model"), params.get("conv_mode", "linear"))
+
+        if facet_size is not None:
+            from pymoresane.facets import deconvolve_facets
+
+            deconvolve_facets(self.image, facet_size, facet_overlap, facet_workers, facet_major_cycles, single_run,
+                              coordinator=coordinator, **params)
+        elif regions:
+            from pymoresane.regions import deconvolve_regions
+
+            deconvolve_regions(self.image, single_run, region_fraction, **params)
+        elif single_run:
+            self.image.moresane(**params)
+        else:
+            self.image.moresane_by_scale(**params)
+
+        return self.model, self.residual
+
+    def restore(self):
+        """
+        Convolves the model with the restoring beam and adds the residual.
+
+        OUTPUTS:
+        restored                                Array containing the restored image.
+        """
+
+        self.image.restore()
+
+        return self.restored
+
+    def save(self, model_name, residual_name, restored_name, output_format="fits", mef_name=None,
+             component_name=None, component_scales=False, model_image=True):
+        """
+        Restores the model and writes the model, residual and restored images. The model and residual are written in
+        the background while the model is restored. The model may also, or instead, be written as a component list.
+
+        INPUTS:
+        model_name          (no default):       File name of the model. Will overwrite.
+        residual_name       (no default):       File name of the residual. Will overwrite.
+        restored_name       (no default):       File name of the restored image. Will overwrite.
+        output_format       (default="fits"):   Output format, see pipeline.OutputWriter.
+        mef_name            (default=None):     File name of the multi-extension file, for the "mef" format.
+        component_name      (default=None):     File name of the component list of the model, see
+                                                components.ComponentList.save. Will overwrite.
+        component_scales    (default=False):    Boolean specifier for whether the components are grouped by scale.
+        model_image         (default=True):     Boolean specifier for whether the model image is written.
+        """
+
+        if component_name is not None:
+            self.components(component_scales).save(component_name)
+
+        writer = pipeline.OutputWriter(output_format, mef_name)
+
+        try:
+            if model_image:
+                writer.write(model_name, self.model, self.header, "MODEL")
+            writer.write(residual_name, self.residual, self.header, "RESIDUAL")
+
+            self.restore()
+
+            writer.write(restored_name, self.restored, self.header, "RESTORED")
+        finally:
+            writer.close()
+
+    def components(self, by_scale=False):
+        """
+        Returns the model as a components.ComponentList, see FitsImage.components.
+        """
+
+        return self.image.components(by_scale)
+
+    @property
+    def model(self):
+        return self.image.model
+
+    @property
+    def residual(self):
+        return self.image.residual
+
+    @property
+    def restored(self):
+        return self.image.restored
+
+    @property
+    def header(self):
+        """
+        The header of the dirty map, which holds the restoring beam parameters once the model has been restored.
+        """
+
+        return self.image.img_hdr
+
+    @property
+    def beam(self):
+        """
+        The restoring beam parameters - BMAJ, BMIN and BPA. The beam is fitted to the PSF if necessary.
+        """
+
+        return self.image.precomputed.beam_parameters(self.image.psf_hdr, self.image.beam_params)
+
+
+def deconvolve(dirty, psf, pixel_size=None, beam=None, mask=None, single_run=False, restore=True, cache_dir=None,
+               **params):
+    """
+    Convenience function which deconvolves images which are already in memory. See Deconvolution.
+
+    INPUTS:
+    dirty       (no default):       Array or buffer containing the dirty map.
+    psf         (no default):       Array or buffer containing the PSF.
+    pixel_size  (default=None):     Pixel size, see make_header.
+    beam        (default=None):     Restoring beam parameters - BMAJ, BMIN and BPA. Fitted to the PSF if not given.
+    mask        (default=None):     Array or buffer containing a deconvolution mask.
+    single_run  (default=False):    Boolean specifier for whether FitsImage.moresane is used rather than
+                                    FitsImage.moresane_by_scale.
+    restore     (default=True):     Boolean specifier for whether the restored image is computed.
+    cache_dir   (default=None):     Directory in which PSF precomputations are cached between runs.
+    params      (no default):       Keyword arguments for Deconvolution.run.
+
+    OUTPUTS:
+    model                           Array containing the model.
+    residual                        Array containing the residual.
+    restored                        Array containing the restored image, or None if restore is False.
+    """
+
+    deconvolution = Deconvolution(dirty, psf, pixel_size, beam, mask, cache_dir=cache_dir)
+
+    model, residual = deconvolution.run(single_run, **params)
+
+    restored = deconvolution.restore() if restore else None
+
+    return model, residual, restored
@@ -0,0 +1,437 @@
+import copy
+import csv
+import json
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pymoresane.parser as pparser
+import pymoresane.precompute as precompute
+
+from collections import OrderedDict
+from pymoresane.api import Deconvolution
+from pymoresane.main import (deconvolution_parameters, make_logger, output_names, read_plane, run_parameters,
+                             save_parameters)
+
+logger = logging.getLogger(__name__)
+
+# State of each worker process, set up once by init_worker. PSFs and their precomputations are kept between jobs.
+
+_worker = {}
+
+# The number of PSFs whose precomputations each worker keeps in memory. Older PSFs are reloaded from the disk cache.
+
+_PSF_CACHE_SIZE = 4
+
+# Entries of a job which are not runsane options.
+
+_JOB_KEYS = ("id", "dirty", "psf", "output")
+
+_TRUE = ("1", "true", "yes", "y", "on")
+
+
+def read_manifest(name):
+    """
+    Reads the jobs of a batch from a manifest. A .csv manifest has a header row naming its columns, with one job per
+    row - empty cells are ignored. A .json manifest is either a list of jobs or an object with a "jobs" list and a
+    "defaults" object whose entries apply to every job.
+
+    Each job has dirty, psf and output entries and optionally an id, which defaults to the output. Any other entries
+    are runsane options, named by their long names without dashes, e.g. {"loopgain": 0.2, "enforcepositivity": true}.
+
+    INPUTS:
+    name    (no default):   File name of the manifest.
+
+    OUTPUTS:
+    List of dictionaries, one per job.
+    """
+
+    if name.lower().endswith(".json"):
+        with open(name) as manifest:
+            contents = json.load(manifest)
+
+        if isinstance(contents, dict):
+            defaults = contents.get("defaults", {})
+            jobs = [dict(defaults, **job) for job in contents["jobs"]]
+        else:
+            jobs = [dict(job) for job in contents]
+    else:
+        with open(name) as manifest:
+            jobs = [dict((key.strip(), value.strip()) for key, value in row.items() if value and value.strip())
+                    for row in csv.DictReader(manifest)]
+
+    for index, job in enumerate(jobs):
+        missing = [key for key in ["dirty", "psf", "output"] if key not in job]
+
+        if missing:
+            logger.error("Job {} of {} has no {}.".format(index + 1, name, ", ".join(missing)))
+            raise ValueError("Job {} of {} has no {}.".format(index + 1, name, ", ".join(missing)))
+
+        job["id"] = str(job.get("id", job["output"]))
+
+    ids = [job["id"] for job in jobs]
+
+    if len(set(ids))!=len(ids):
+        logger.error("The ids of the jobs of {} are not unique.".format(name))
+        raise ValueError("The ids of the jobs of {} are not unique.".format(name))
+
+    return jobs
+
+
+def job_arguments(job, options=()):
+    """
+    Converts a job of a manifest to a runsane command line.
+
+    INPUTS:
+    job         (no default):   Dictionary describing the job, as returned by read_manifest.
+    options     (default=()):   List of runsane options which apply to every job. The options of the job take
+                                precedence.
+
+    OUTPUTS:
+    List of arguments for parser.handle_parser.
+    """
+
+    actions = dict((action.dest, action) for action in pparser.make_parser()._actions if action.option_strings)
+
+    arguments = [job["dirty"], job["psf"], job["output"]] + list(options)
+
+    for key, value in sorted(job.items()):
+        if key in _JOB_KEYS:
+            continue
+
+        if key not in actions:
+            raise ValueError("Job {} has an unknown option {}.".format(job["id"], key))
+
+        action = actions[key]
+
+        # Flags are given as booleans, or as strings such as "true" in a .csv manifest.
+
+        if action.nargs==0:
+            if (value is True) or (str(value).lower() in _TRUE):
+                arguments.append(action.option_strings[-1])
+        else:
+            arguments.extend([action.option_strings[-1], str(value)])
+
+    return arguments
+
+
+def parse_job(job, options=(), defaults=None, output_files=True):
+    """
+    Parses and checks the runsane command line of a job.
+
+    INPUTS:
+    job             (no default):   Dictionary describing the job, as returned by read_manifest.
+    options         (default=()):   List of runsane options which apply to every job.
+    defaults        (default=None): Parsed arguments whose values replace the defaults of runsane for every job.
+    output_files    (default=True): Boolean specifier for whether the job writes its images to files, in which case
+                                    the output names are checked.
+
+    OUTPUTS:
+    args                            Parsed arguments, as returned by parser.handle_parser.
+    """
+
+    try:
+        args = pparser.handle_parser(job_arguments(job, options), copy.copy(defaults))
+    except SystemExit:
+        logger.error("Invalid options for job {}.".format(job["id"]))
+        raise ValueError("Invalid options for job {}.".format(job["id"]))
+
+    # Cube and facet mode run their own pools of processes, which is not possible within a worker of the batch.
+
+    if args.cube or (args.facetsize is not None) or (args.coordinator is not None):
+        logger.error("Job {} uses cube, facet or distributed mode, which are unavailable in a batch.".format(job["id"]))
+        raise ValueError("Job {} uses cube, facet or distributed mode, which are unavailable in a batch."
+                         .format(job["id"]))
+
+    if output_files:
+        if (args.outputformat=="mef") and (args.outputname is None):
+            raise ValueError("Job {} uses the mef output format, which requires an output.".format(job["id"]))
+
+        output_names(args)
+
+    return args
+
+
+def marker_name(args):
+    """
+    Returns the file name of the marker which records that a job has completed.
+    """
+
+    return (args.outputname if args.outputname is not None else args.modelname) + ".done"
+
+
+def schedule(jobs):
+    """
+    Orders the jobs so that the first job of each PSF runs before any other job. The precomputations of each PSF are
+    then usually in the disk cache by the time the remaining jobs which use it start, and those jobs follow one
+    another so that a worker can reuse the PSF it already holds in memory.
+
+    INPUTS:
+    jobs    (no default):   List of (job, args) pairs.
+
+    OUTPUTS:
+    List of the (job, args) pairs in the order in which they are to be run.
+    """
+
+    groups = OrderedDict()
+
+    for job, args in jobs:
+        groups.setdefault(os.path.abspath(args.psf), []).append((job, args))
+
+    first = [group[0] for group in groups.values()]
+    rest = [item for group in groups.values() for item in group[1:]]
+
+    return first + rest
+
+
+def init_worker(cache_dir):
+    """
+    Initialises a worker process.
+
+    INPUTS:
+    cache_dir   (no default):   Directory in which PSF precomputations are shared between workers.
+    """
+
+    _worker["cache_dir"] = cache_dir
+    _worker["psfs"] = OrderedDict()
+
+
+def job_psf(name, dirty_data_shape, cache_dir=None):
+    """
+    Returns the PSF of a job and its PrecomputationCache. The PSFs of recent jobs are kept by the worker, and the
+    precomputations of other PSFs are loaded from the disk cache where possible.
+
+    INPUTS:
+    name                (no default):   File name of the PSF.
+    dirty_data_shape    (no default):   Shape of the dirty image.
+    cache_dir           (default=None): Directory of the disk cache. Overrides that of the batch if given.
+
+    OUTPUTS:
+    psf_data                            Array containing the PSF.
+    psf_hdr                             Header of the PSF.
+    precomputed                         PrecomputationCache of the PSF.
+    """
+
+    cache_dir = cache_dir if cache_dir is not None else _worker["cache_dir"]
+
+    key = (os.path.abspath(name), os.path.getmtime(name), tuple(dirty_data_shape), cache_dir)
+
+    psfs = _worker["psfs"]
+
+    if key in psfs:
+        psfs[key] = psfs.pop(key)
+        return psfs[key]
+
+    psf_data, psf_hdr = read_plane(name, [2*sz for sz in dirty_data_shape])
+    psf_data = np.asarray(psf_data, dtype=np.float32)
+
+    psfs[key] = (psf_data, psf_hdr, precompute.PrecomputationCache(psf_data, tuple(dirty_data_shape), cache_dir,
+                                                                   name))
+
+    while len(psfs)>_PSF_CACHE_SIZE:
+        psfs.popitem(last=False)
+
+    return psfs[key]
+
+
+def deconvolve_job(args):
+    """
+    Deconvolves a single job as runsane would, and writes its completion marker.
+
+    INPUTS:
+    args    (no default):   Parsed arguments of the job, as returned by parse_job.
+    """
+
+    model_name, residual_name, restored_name = output_names(args)
+
+    mef_name = args.outputname + ".fits" if args.outputformat=="mef" else None
+
+    dirty_data, img_hdr = read_plane(args.dirty)
+    psf_data, psf_hdr, precomputed = job_psf(args.psf, dirty_data.shape, args.psfcache)
+    mask = read_plane(args.mask)[0] if args.mask is not None else None
+
+    deconvolution = Deconvolution(dirty_data, psf_data, mask=mask, header=img_hdr, psf_header=psf_hdr,
+                                  precomputed=precomputed)
+
+    deconvolution.run(args.singlerun, **dict(run_parameters(args), **deconvolution_parameters(args)))
+
+    deconvolution.save(model_name, residual_name, restored_name, args.outputformat, mef_name, **save_parameters(args))
+
+    # The marker is written to a temporary file which is then renamed, so that it only exists once the outputs do.
+
+    tmp_name = "{}.{}.tmp".format(marker_name(args), os.getpid())
+
+    with open(tmp_name, "w") as marker:
+        json.dump(dict(dirty=args.dirty, psf=args.psf, model=model_name, residual=residual_name,
+                       restored=restored_name, completed=time.time()), marker)
+
+    os.replace(tmp_name, marker_name(args))
+
+
+def run_job(task):
+    """
+    Runs a job in a worker process. Errors are reported rather than raised, so that a failed job does not stop the
+    batch.
+
+    INPUTS:
+    task    (no default):   Tuple of the id of the job and its parsed arguments.
+
+    OUTPUTS:
+    job_id                  Id of the job.
+    error                   Description of the error, or None if the job completed.
+    elapsed                 Time, in seconds, taken by the job.
+    """
+
+    job_id, args = task
+
+    start_time = time.time()
+
+    try:
+        deconvolve_job(args)
+    except Exception as error:
+        logger.exception("Job {} failed.".format(job_id))
+        return job_id, "{}: {}".format(type(error).__name__, error), time.time() - start_time
+
+    return job_id, None, time.time() - start_time
+
+
+def run_batch(jobs, options=(), worker_count=None, rerun=False, cache_dir=None):
+    """
+    Runs the jobs of a manifest on a pool of processes. Jobs whose completion markers exist are skipped unless rerun
+    is set, so that an interrupted batch may be resumed by running it again.
+
+    INPUTS:
+    jobs            (no default):       List of jobs, as returned by read_manifest.
+    options         (default=()):       List of runsane options which apply to every job.
+    worker_count    (default=None):     Number of jobs which are run at once. Defaults to the number of cores.
+    rerun           (default=False):    Boolean specifier for whether completed jobs are run again.
+    cache_dir       (default=None):     Directory in which PSF precomputations are shared between jobs. Defaults to
+                                        a temporary directory which is removed afterwards.
+
+    OUTPUTS:
+    summary                             Dictionary summarising the batch - the numbers of jobs which completed,
+                                        were skipped and failed, the timings and throughput and the failures.
+    """
+
+    start_time = time.time()
+
+    # Every job is parsed before any is run, so that errors in the manifest are found straight away.
+
+    parsed = [(job, parse_job(job, options)) for job in jobs]
+
+    pending = [(job, args) for job, args in parsed if rerun or not os.path.isfile(marker_name(args))]
+
+    skipped = len(parsed) - len(pending)
+
+    if skipped:
+        logger.info("Skipping {} completed jobs.".format(skipped))
+
+    if worker_count is None:
+        worker_count = mp.cpu_count()
+
+    worker_count = max(min(worker_count, len(pending)), 1)
+
+    temporary_cache = cache_dir is None
+
+    if temporary_cache:
+        cache_dir = tempfile.mkdtemp(prefix="pymoresane-batch-")
+
+    tasks = [(job["id"], args) for job, args in schedule(pending)]
+
+    logger.info("Running {} jobs on {} workers.".format(len(tasks), worker_count))
+
+    job_times = []
+    failures = []
+
+    def record(result):
+        job_id, error, elapsed = result
+
+        if error is None:
+            job_times.append(elapsed)
+            logger.info("Job {} completed in {:.1f}s ({} of {}).".format(job_id, elapsed,
+                        len(job_times) + len(failures), len(tasks)))
+        else:
+            failures.append(dict(id=job_id, error=error, time=elapsed))
+            logger.error("Job {} failed after {:.1f}s: {}".format(job_id, elapsed, error))
+
+    try:
+        if worker_count==1:
+            init_worker(cache_dir)
+
+            for task in tasks:
+                record(run_job(task))
+        else:
+            pool = mp.Pool(worker_count, initializer=init_worker, initargs=(cache_dir,))
+
+            try:
+                for result in pool.imap_unordered(run_job, tasks):
+                    record(result)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        if temporary_cache:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    elapsed = time.time() - start_time
+
+    return dict(jobs=len(parsed), completed=len(job_times), skipped=skipped, failed=len(failures),
+                workers=worker_count, elapsed=elapsed,
+                jobs_per_hour=3600*len(job_times)/elapsed if elapsed>0 else 0.0,
+                mean_job_time=float(np.mean(job_times)) if job_times else None,
+                max_job_time=max(job_times) if job_times else None, failures=failures)
+
+
+def batch_report(summary):
+    """
+    Formats the summary returned by run_batch for the log.
+    """
+
+    lines = ["{} jobs: {} completed, {} skipped, {} failed.".format(summary["jobs"], summary["completed"],
+                                                                    summary["skipped"], summary["failed"]),
+             "Elapsed time was {} on {} workers - {:.1f} jobs per hour.".format(
+                 time.strftime('%H:%M:%S', time.gmtime(summary["elapsed"])), summary["workers"],
+                 summary["jobs_per_hour"])]
+
+    if summary["mean_job_time"] is not None:
+        lines.append("Mean job time was {:.1f}s, longest {:.1f}s.".format(summary["mean_job_time"],
+                                                                            summary["max_job_time"]))
+
+    for failure in summary["failures"]:
+        lines.append("Failed: {} - {}".format(failure["id"], failure["error"]))
+
+    return "\n".join(lines)
+
+
+def batch_main(args=None, options=None):
+    """
+    Entry point of runsane-batch.
+
+    INPUTS:
+    args        (default=None): Parsed batch options, as returned by parser.handle_batch_parser. Parsed here if not
+                                given.
+    options     (default=None): List of runsane options which apply to every job.
+
+    OUTPUTS:
+    summary                     Dictionary summarising the batch, see run_batch.
+    """
+
+    if args is None:
+        args, options = pparser.handle_batch_parser()
+
+    make_logger(args.loglevel)
+
+    summary = run_batch(read_manifest(args.manifest), options or (), args.batchworkers, args.rerun, args.psfcache)
+
+    logger.info("Batch summary:\n" + batch_report(summary))
+
+    if args.report is not None:
+        with open(args.report, "w") as report:
+            json.dump(summary, report, indent=2)
+
+        logger.info("Report written to {}.".format(args.report))
+
+    return summary
@@ -1,69 +1,274 @@
 import numpy as np
 from scipy import ndimage
-from scipy.optimize import curve_fit
+from scipy.optimize import leastsq
+
+# Ratio of the full width at half maximum of a Gaussian to its standard deviation.
+
+FWHM = 2*np.sqrt(2*np.log(2))
+
+# The intensity-weighted second moments of a Gaussian which is truncated at half of its maximum are this fraction of
+# its variance.
+
+HALF_MAX_MOMENT = 1 - np.log(2)
+
+# The beam is fitted within the central region of the PSF of at most FIT_SIZE pixels along each axis, and evaluated
+# only within BEAM_SUPPORT standard deviations of its peak, beyond which it is below single precision.
+
+FIT_SIZE = 512
+BEAM_SUPPORT = 8
+
+
+def fit_region(shape):
+    """
+    Returns the slices of the central region of the PSF in which the restoring beam is fitted.
+
+    INPUTS:
+    shape   (no default):   Shape of the PSF.
+
+    OUTPUTS:
+    Tuple of slices selecting the central region.
+    """
+
+    return tuple(slice(max(sz//2-FIT_SIZE//2, 0), min(sz//2+FIT_SIZE//2, sz)) for sz in shape)
+
+
+def psf_peak(psf):
+    """
+    Returns the pixel (row, column) of the peak of the PSF within fit_region, at which the restoring beam is centred.
+    """
+
+    psf_slice = fit_region(psf.shape)
+
+    max_location = np.unravel_index(np.argmax(psf[psf_slice]), psf[psf_slice].shape)
+
+    return (psf_slice[0].start+max_location[0], psf_slice[1].start+max_location[1])
+
+
+def main_lobe(psf):
+    """
+    Extracts the pixels of the central lobe of the PSF which lie above half of its maximum. The lobe is labelled
+    within a window around the peak which is enlarged until it contains the whole lobe, so that the cost depends on
+    the size of the lobe rather than that of the PSF.
+
+    INPUTS:
+    psf     (no default):   Array containing the psf.
+
+    OUTPUTS:
+    centre                  Pixel (row, column) of the peak of the PSF.
+    xy                      Nx2 array of the offsets of the lobe pixels from the peak - x to the right and y upwards.
+    z                       Values of the lobe pixels, normalised to a peak of one.
+    """
+
+    psf_slice = fit_region(psf.shape)
+    psf_centre = psf[psf_slice]
+
+    centre = psf_peak(psf)
+
+    max_location = (centre[0]-psf_slice[0].start, centre[1]-psf_slice[1].start)
+    peak = psf_centre[max_location]
+
+    width = 16
+
+    while True:
+        window = tuple(slice(max(loc-width, 0), min(loc+width+1, sz)) for loc, sz in zip(max_location,
+                                                                                         psf_centre.shape))
+
+        labelled_psf = ndimage.label(psf_centre[window]>0.5*peak)[0]
+        lobe = labelled_psf==labelled_psf[max_location[0]-window[0].start, max_location[1]-window[1].start]
+
+        touches_edge = lobe[0,:].any() | lobe[-1,:].any() | lobe[:,0].any() | lobe[:,-1].any()
+
+        if (not touches_edge) or (lobe.shape==psf_centre.shape):
+            break
+
+        width *= 2
+
+    rows, columns = np.nonzero(lobe)
+    rows += window[0].start
+    columns += window[1].start
+
+    xy = np.column_stack((columns-max_location[1], max_location[0]-rows)).astype(np.float64)
+    z = psf_centre[rows, columns]/peak
+
+    return centre, xy, z
+
+
+def ellipgauss(xy, A, xsigma, ysigma, theta):
+    """
+    Elliptical Gaussian which is fitted to the central lobe of the PSF. xy must be an Nx2 array consisting of pairs of
+    x and y offsets from the peak.
+    """
+
+    u = xy[:,0]*np.cos(theta) - xy[:,1]*np.sin(theta)
+    v = xy[:,0]*np.sin(theta) + xy[:,1]*np.cos(theta)
+
+    return A*np.exp(-1*((u**2)/(2*(xsigma**2)) + (v**2)/(2*(ysigma**2))))
+
+
+def ellipgauss_residuals(params, xy, z):
+    """
+    Residuals of the fit of ellipgauss to the values z.
+    """
+
+    return ellipgauss(xy, *params) - z
+
+
+def ellipgauss_jacobian(params, xy, z):
+    """
+    Analytic Jacobian of ellipgauss_residuals with respect to the parameters A, xsigma, ysigma and theta.
+    """
+
+    A, xsigma, ysigma, theta = params
+
+    u = xy[:,0]*np.cos(theta) - xy[:,1]*np.sin(theta)
+    v = xy[:,0]*np.sin(theta) + xy[:,1]*np.cos(theta)
+
+    gauss = np.exp(-1*((u**2)/(2*(xsigma**2)) + (v**2)/(2*(ysigma**2))))
+    fit = A*gauss
+
+    return np.column_stack((gauss, fit*(u**2)/(xsigma**3), fit*(v**2)/(ysigma**3),
+                            fit*u*v*(1/(xsigma**2) - 1/(ysigma**2))))
+
+
+def moments_estimate(xy, z):
+    """
+    Estimates the parameters of ellipgauss from the intensity-weighted second moments of the lobe pixels. The moments
+    of the lobe, which is truncated at half maximum, are scaled by HALF_MAX_MOMENT to give the covariance of the
+    Gaussian, whose eigenvectors are the axes of the beam.
+
+    INPUTS:
+    xy      (no default):   Nx2 array of the offsets of the lobe pixels from the peak.
+    z       (no default):   Values of the lobe pixels, normalised to a peak of one.
+
+    OUTPUTS:
+    Tuple of the estimated A, xsigma, ysigma and theta, where xsigma is that of the major axis.
+    """
+
+    weights = z/np.sum(z)
+
+    offsets = xy - np.dot(weights, xy)
+
+    covariance = np.dot(offsets.T*weights, offsets)/HALF_MAX_MOMENT
+
+    # A lobe of a single pixel or a single row has no extent along an axis, so the variance is bounded from below by
+    # that of a uniformly filled pixel.
+
+    variances, axes = np.linalg.eigh(covariance)
+    variances = np.maximum(variances, 1./12)
+
+    # ellipgauss measures xsigma along the direction (cos(theta), -sin(theta)).
+
+    theta = np.arctan2(-axes[1,1], axes[0,1])
+
+    return (1.0, np.sqrt(variances[1]), np.sqrt(variances[0]), theta)
 
 
 def beam_fit(psf, psf_header):
     """
     The following contructs a restoring beam from the psf. This is accoplished by fitting an elliptical Gaussian to the
-    central lobe of the PSF.
+    central lobe of the PSF. Only the pixels of the lobe above half maximum are fitted, starting from the estimate of
+    moments_estimate and using the analytic Jacobian, so the fit takes milliseconds.
 
     INPUTS:
     psf         (no default):   Array containing the psf for the image in question.
     psf_header  (no default):   Header of the psf.
+
+    OUTPUTS:
+    clean_beam                  Array containing the restoring beam, normalised to a peak of one.
+    beam_params                 List of the beam parameters - BMAJ, BMIN and BPA. BPA is in degrees, measured as in
+                                gaussian_beam.
     """
 
-    if psf.shape>512:
-        psf_slice = tuple([slice(psf.shape[0]/2-256, psf.shape[0]/2+256),slice(psf.shape[1]/2-256, psf.shape[1]/2+256)])
-    else:
-        psf_slice = tuple([slice(0, psf.shape[0]),slice(0, psf.shape[1])])
+    centre, xy, z = main_lobe(psf)
 
-    psf_centre = psf[psf_slice]/np.max(psf[psf_slice])
+    opt = moments_estimate(xy, z)
 
-    max_location = np.unravel_index(np.argmax(psf_centre), psf_centre.shape)
+    # A lobe of fewer pixels than parameters cannot be fitted, so the estimate is used as it stands.
 
-    threshold_psf = np.where(psf_centre>0.5 , psf_centre, 0)
+    if z.size>len(opt):
+        opt = leastsq(ellipgauss_residuals, opt, args=(xy, z), Dfun=ellipgauss_jacobian)[0]
 
-    labelled_psf, labels = ndimage.label(threshold_psf)
+    A, xsigma, ysigma, theta = opt
 
-    extracted_primary_beam = np.where(labelled_psf==labelled_psf[max_location], psf_centre, 0)
+    xsigma, ysigma = abs(xsigma), abs(ysigma)
 
-    # Following creates row and column values of interest for the central PSF lobe and then selects those values
-    # from the PSF using np.where. Additionally, the inputs for the fitting are created by reshaping the x,y,
-    # and z data into columns.
+    # The major axis is taken to be that of xsigma. If it is not, the axes are swapped by a rotation of 90 degrees.
 
-    x = np.arange(-max_location[1],-max_location[1]+psf_centre.shape[1],1)
-    y = np.arange(-max_location[0],-max_location[0]+psf_centre.shape[0],1)
-    z = extracted_primary_beam
+    if ysigma>xsigma:
+        xsigma, ysigma = ysigma, xsigma
+        theta += np.pi/2
+
+    bmaj = FWHM*xsigma*psf_header['CDELT1']
+    bmin = FWHM*ysigma*psf_header['CDELT2']
+    bpa = np.degrees(-theta)%180 - 90
+
+    beam_params = [abs(bmaj), abs(bmin), bpa]
 
-    gridx, gridy = np.meshgrid(x,-y)
+    clean_beam = gaussian_beam(psf.shape, centre, beam_params, psf_header)
 
-    xyz = np.column_stack((gridx.reshape(-1,1),gridy.reshape(-1,1),z.reshape(-1,1,order="C")))
+    return clean_beam, beam_params
 
-    # Elliptical gaussian which can be fit to the central lobe of the PSF. xy must be an Nx2 array consisting of
-    # pairs of row and column values for the region of interest.
 
-    def ellipgauss(xy,A,xsigma,ysigma,theta):
-        return A*np.exp(-1*(((xy[:,0]*np.cos(theta)-xy[:,1]*np.sin(theta))**2)/(2*(xsigma**2)) +
-                            ((xy[:,0]*np.sin(theta)+xy[:,1]*np.cos(theta))**2)/(2*(ysigma**2))))
+def gaussian_beam(shape, centre, beam_params, psf_header):
+    """
+    Constructs a restoring beam from known beam parameters rather than by fitting the PSF. BPA is the position angle
+    of the major axis, measured from north (up) through east (left). The beam is evaluated within BEAM_SUPPORT
+    standard deviations of its peak and is zero elsewhere.
 
-    # This command from scipy performs the fitting of the 2D gaussian, and returns the optimal coefficients in opt.
+    INPUTS:
+    shape       (no default):   Shape of the beam array, i.e. of the PSF.
+    centre      (no default):   Pixel (row, column) at which the beam peaks, i.e. the peak of the PSF.
+    beam_params (no default):   Sequence of the beam parameters - BMAJ and BMIN in the units of the header, and BPA
+                                in degrees.
+    psf_header  (no default):   Header of the psf, from which the pixel size is taken.
 
-    opt = curve_fit(ellipgauss, xyz[:,0:2],xyz[:,2],(1,1,1,0))[0]
+    OUTPUTS:
+    clean_beam                  Array containing the restoring beam, normalised to a peak of one.
+    """
 
-    # Following create the data for the new images. The cleanbeam has to be reshaped to reclaim it in 2D.
+    bmaj, bmin, bpa = beam_params
 
-    clean_beam = np.zeros_like(psf)
-    clean_beam[psf_slice] = ellipgauss(xyz[:,0:2],opt[0],opt[1],opt[2],opt[3]).reshape(psf_centre.shape,order="C")
+    xsigma = abs(bmaj/psf_header['CDELT1'])/FWHM
+    ysigma = abs(bmin/psf_header['CDELT2'])/FWHM
+    theta = -np.radians(bpa + 90)
 
-    # Experimental - forces the beam to be normalised. This should be redundant, but helps when the PSF is bad.
+    half_width = int(np.ceil(BEAM_SUPPORT*max(xsigma, ysigma)))
 
-    clean_beam = clean_beam/np.max(clean_beam)
+    window = tuple(slice(max(c-half_width, 0), min(c+half_width+1, sz)) for c, sz in zip(centre, shape))
 
-    bmaj = 2*np.sqrt(2*np.log(2))*max(opt[1],opt[2])*psf_header['CDELT1']
-    bmin = 2*np.sqrt(2*np.log(2))*min(opt[1],opt[2])*psf_header['CDELT2']
-    bpa = np.degrees(opt[3])%360 - 90
+    x = np.arange(window[1].start, window[1].stop) - centre[1]
+    y = centre[0] - np.arange(window[0].start, window[0].stop)
 
-    beam_params = [abs(bmaj), abs(bmin), bpa]
+    gridx, gridy = np.meshgrid(x, y)
 
-    return clean_beam, beam_params
+    clean_beam = np.zeros(shape)
+    clean_beam[window] = np.exp(-1*(((gridx*np.cos(theta)-gridy*np.sin(theta))**2)/(2*(xsigma**2)) +
+                                    ((gridx*np.sin(theta)+gridy*np.cos(theta))**2)/(2*(ysigma**2))))
+
+    return clean_beam
+
+
+def beam_covariance(beam_params, psf_header):
+    """
+    Returns the covariance matrix of the restoring beam in pixels, with x to the right and y upwards, so that the beam
+    is exp(-0.5*r.T*inv(covariance)*r) for an offset r=(x, y) from its peak. This describes the same beam as
+    gaussian_beam and allows it to be applied without being constructed, see iuwt_convolution.gaussian_convolve.
+
+    INPUTS:
+    beam_params (no default):   Sequence of the beam parameters - BMAJ, BMIN and BPA.
+    psf_header  (no default):   Header of the psf, from which the pixel size is taken.
+
+    OUTPUTS:
+    covariance                  2x2 array containing the covariance of the beam.
+    """
+
+    bmaj, bmin, bpa = beam_params
+
+    xsigma = abs(bmaj/psf_header['CDELT1'])/FWHM
+    ysigma = abs(bmin/psf_header['CDELT2'])/FWHM
+    theta = -np.radians(bpa + 90)
+
+    c, s = np.cos(theta), np.sin(theta)
+
+    return np.array([[(xsigma*c)**2 + (ysigma*s)**2, (ysigma**2 - xsigma**2)*s*c],
+                     [(ysigma**2 - xsigma**2)*s*c, (xsigma*s)**2 + (ysigma*c)**2]])
@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# The state of the major loop which is stored alongside the model and residual. The iteration counters are those of
+# the current call of FitsImage.moresane (major_loop_niter) and of the calls which preceded it in the scale-by-scale
+# approach (total_niter).
+
+STATE_FIELDS = [("scale_count", np.int64), ("major_loop_niter", np.int64), ("total_niter", np.int64),
+                ("std_current", np.float64), ("min_scale", np.int64)]
+
+
+def save_checkpoint(name, model, residual, scale_count, major_loop_niter, total_niter, std_current, min_scale):
+    """
+    Writes the state of a deconvolution to a .npy file holding a single record, so that the model and residual can be
+    memory-mapped when the checkpoint is loaded. The file is written to a temporary file which is then renamed, so
+    that a run which dies while writing leaves the previous checkpoint intact.
+
+    INPUTS:
+    name                (no default):   File name of the checkpoint. Will overwrite.
+    model               (no default):   Array containing the model.
+    residual            (no default):   Array containing the residual.
+    scale_count         (no default):   Maximum scale of the current call of FitsImage.moresane.
+    major_loop_niter    (no default):   Number of major loop iterations of the current call.
+    total_niter         (no default):   Number of major loop iterations of the preceding calls.
+    std_current         (no default):   Standard deviation of the residual after the last iteration.
+    min_scale           (no default):   Current minimum scale of interest.
+    """
+
+    dtype = np.dtype([("model", model.dtype, model.shape), ("residual", residual.dtype, residual.shape)] +
+                     STATE_FIELDS)
+
+    tmp_name = "{}.{}.{}.tmp".format(name, os.getpid(), threading.current_thread().ident)
+
+    # The record is written through a memory map of the temporary file, so no copy of the images is made.
+
+    record = np.lib.format.open_memmap(tmp_name, mode="w+", dtype=dtype, shape=(1,))
+
+    try:
+        record["model"][0] = model
+        record["residual"][0] = residual
+
+        for field, value in zip([field for field, field_type in STATE_FIELDS],
+                                [scale_count, major_loop_niter, total_niter, std_current, min_scale]):
+            record[field][0] = value
+
+        record.flush()
+    finally:
+        del record
+
+    os.replace(tmp_name, name)
+
+
+def load_checkpoint(name):
+    """
+    Loads a checkpoint written by save_checkpoint. The model and residual are memory-mapped and read-only.
+
+    INPUTS:
+    name    (no default):   File name of the checkpoint.
+
+    OUTPUTS:
+    Dictionary of the model, residual and the fields of STATE_FIELDS.
+    """
+
+    record = np.load(name, mmap_mode="r")
+
+    fields = ["model", "residual"] + [field for field, field_type in STATE_FIELDS]
+
+    if (record.dtype.names is None) or (not set(fields).issubset(record.dtype.names)):
+        logger.error("{} is not a pymoresane checkpoint.".format(name))
+        raise ValueError("{} is not a pymoresane checkpoint.".format(name))
+
+    state = dict((field, record[field][0].item()) for field, field_type in STATE_FIELDS)
+
+    state["model"] = record["model"][0]
+    state["residual"] = record["residual"][0]
+
+    return state
+
+
+class Checkpoint(object):
+    """
+    Periodically writes the state of a deconvolution, see save_checkpoint. FitsImage.moresane saves a checkpoint at
+    the end of a major loop iteration once the interval has passed since the last one.
+    """
+
+    def __init__(self, name, interval=600):
+        """
+        INPUTS:
+        name        (no default):   File name of the checkpoint.
+        interval    (default=600):  Minimum time, in seconds, between checkpoints. Each major loop iteration is
+                                    saved if zero.
+        """
+
+        self.name = name
+        self.interval = interval
+        self.last_save = time.time()
+
+    def due(self):
+        """
+        Determines whether or not the interval has passed since the last checkpoint.
+        """
+
+        return (time.time() - self.last_save)>=self.interval
+
+    def save(self, model, residual, scale_count, major_loop_niter, total_niter, std_current, min_scale):
+        """
+        Writes a checkpoint. See save_checkpoint.
+        """
+
+        save_checkpoint(self.name, model, residual, scale_count, major_loop_niter, total_niter, std_current, min_scale)
+
+        self.last_save = time.time()
+
+        logger.info("Checkpoint written to {} after {} major loop iterations.".format(self.name,
+                                                                                      total_niter + major_loop_niter))
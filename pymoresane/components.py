@@ -0,0 +1,235 @@
+import logging
+import numpy as np
+from pymoresane.beam_fit import BEAM_SUPPORT
+
+logger = logging.getLogger(__name__)
+
+# Approximate costs, in nanoseconds, of restoring a model by splatting its components - per pixel of the image, per
+# component and per pixel of the beam stamp. See iuwt_convolution.gaussian_convolve_cost for those of the convolution.
+
+SPLAT_IMAGE_COST = 10
+SPLAT_COMPONENT_COST = 3000
+SPLAT_STAMP_COST = 2
+
+# Fields of a component list file. The shape is that of the model image.
+
+FILE_FIELDS = ["shape", "y", "x", "flux", "scale"]
+
+
+def beam_stamp(covariance):
+    """
+    Evaluates a Gaussian of unit peak, such as the restoring beam, within BEAM_SUPPORT standard deviations of its
+    centre. It is the beam of beam_fit.gaussian_beam, given by its covariance.
+
+    INPUTS:
+    covariance  (no default):   2x2 covariance of the Gaussian in pixels, see beam_fit.beam_covariance.
+
+    OUTPUTS:
+    stamp                       Single precision array of odd width containing the Gaussian at its centre.
+    """
+
+    half_width = int(np.ceil(BEAM_SUPPORT*np.sqrt(np.max(np.linalg.eigvalsh(covariance)))))
+
+    # The offsets are x to the right and y upwards, so y decreases along the rows of the stamp.
+
+    x, y = np.meshgrid(np.arange(-half_width, half_width + 1), np.arange(half_width, -half_width - 1, -1))
+
+    inverse = np.linalg.inv(covariance)
+
+    exponent = inverse[0,0]*x**2 + 2*inverse[0,1]*x*y + inverse[1,1]*y**2
+
+    return np.exp(-0.5*exponent).astype(np.float32)
+
+
+def splat_cost(shape, component_count, covariance):
+    """
+    Estimates the time, in nanoseconds, taken to list the components of a model of the given shape and restore them
+    with ComponentList.restore.
+    """
+
+    half_width = int(np.ceil(BEAM_SUPPORT*np.sqrt(np.max(np.linalg.eigvalsh(covariance)))))
+
+    return SPLAT_IMAGE_COST*shape[0]*shape[1] + \
+           component_count*(SPLAT_COMPONENT_COST + SPLAT_STAMP_COST*(2*half_width + 1)**2)
+
+
+class ComponentList(object):
+    """
+    Compact representation of a model as a list of its non-zero pixels, or components. MORESANE models are usually
+    sparse, so the list is much smaller than the model image and is cheaper to store and to restore.
+
+    The components may be grouped by the scale at which they were added - the scale_count of the call of
+    FitsImage.moresane, or zero for an initial model. A pixel then appears once for every scale at which it changed,
+    and its flux in the model is the sum of its components.
+    """
+
+    def __init__(self, shape, y, x, flux, scale=None):
+        """
+        INPUTS:
+        shape       (no default):   Shape of the model image.
+        y           (no default):   Array of the rows of the components.
+        x           (no default):   Array of the columns of the components.
+        flux        (no default):   Array of the fluxes of the components.
+        scale       (default=None): Array of the scales of the components, if they are grouped by scale.
+        """
+
+        self.shape = tuple(int(sz) for sz in shape)
+        self.y = np.asarray(y, dtype=np.int32)
+        self.x = np.asarray(x, dtype=np.int32)
+        self.flux = np.asarray(flux, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.int16) if scale is not None else None
+
+    def __len__(self):
+        return self.flux.size
+
+    @classmethod
+    def from_model(cls, model, scale=None):
+        """
+        Alternative constructor which lists the non-zero pixels of a model.
+
+        INPUTS:
+        model       (no default):   Array containing the model.
+        scale       (default=None): Scale at which the model was added, by which its components are grouped.
+
+        OUTPUTS:
+        components                  ComponentList of the model.
+        """
+
+        y, x = np.nonzero(model)
+
+        return cls(model.shape, y, x, model[y, x], np.full(y.size, scale) if scale is not None else None)
+
+    @classmethod
+    def concatenate(cls, groups):
+        """
+        Alternative constructor which joins the component lists of a model which are grouped by scale, as created by
+        from_model with a scale.
+
+        INPUTS:
+        groups      (no default):   Non-empty list of ComponentLists of the same shape, each with scales.
+
+        OUTPUTS:
+        components                  ComponentList containing every component of the groups.
+        """
+
+        return cls(groups[0].shape, np.concatenate([group.y for group in groups]),
+                   np.concatenate([group.x for group in groups]), np.concatenate([group.flux for group in groups]),
+                   np.concatenate([group.scale for group in groups]))
+
+    def select(self, scale):
+        """
+        Returns the components which were added at the given scale, as a new ComponentList.
+        """
+
+        if self.scale is None:
+            logger.error("The components are not grouped by scale.")
+            raise ValueError("The components are not grouped by scale.")
+
+        selection = self.scale==scale
+
+        return ComponentList(self.shape, self.y[selection], self.x[selection], self.flux[selection],
+                             self.scale[selection])
+
+    def to_model(self):
+        """
+        Constructs the model image. The components are added in order, so that a model which was grouped by scale is
+        reproduced exactly.
+
+        OUTPUTS:
+        model                       Single precision array containing the model.
+        """
+
+        model = np.zeros(self.shape, dtype=np.float32)
+
+        np.add.at(model, (self.y, self.x), self.flux)
+
+        return model
+
+    def restore(self, covariance, conv_mode="linear"):
+        """
+        Convolves the model with the restoring beam by adding a stamp of the beam, scaled by its flux, at each
+        component. The time taken depends on the number of components rather than the size of the image. The result
+        is that of FitsImage.restore before the residual is added.
+
+        INPUTS:
+        covariance  (no default):           2x2 covariance of the beam in pixels, see beam_fit.beam_covariance.
+        conv_mode   (default="linear"):     Specifier for convolution mode - linear, in which the beam is cut off at
+                                            the edges of the image, or circular, in which it wraps around.
+
+        OUTPUTS:
+        restored                            Single precision array containing the model convolved with the beam.
+        """
+
+        stamp = beam_stamp(covariance)
+
+        half_width = stamp.shape[0]//2
+        width = stamp.shape[0]
+
+        # The stamps are added to an image which is padded by the half width of the stamp, so that no stamp needs to
+        # be cut. The padding is then discarded or, for circular convolution, wrapped around onto the image.
+
+        padded = np.zeros([sz + 2*half_width for sz in self.shape], dtype=np.float32)
+
+        for y, x, flux in zip(self.y.tolist(), self.x.tolist(), self.flux.tolist()):
+            padded[y:y+width, x:x+width] += flux*stamp
+
+        if conv_mode=="linear":
+            return padded[half_width:half_width+self.shape[0], half_width:half_width+self.shape[1]].copy()
+
+        rows = (np.arange(padded.shape[0]) - half_width)%self.shape[0]
+        columns = (np.arange(padded.shape[1]) - half_width)%self.shape[1]
+
+        wrapped_rows = np.zeros([self.shape[0], padded.shape[1]], dtype=np.float32)
+        np.add.at(wrapped_rows, rows, padded)
+
+        restored = np.zeros(self.shape, dtype=np.float32)
+        np.add.at(restored, (slice(None), columns), wrapped_rows)
+
+        return restored
+
+    def save(self, name):
+        """
+        Writes the components to an uncompressed .npz file, see FILE_FIELDS. Ungrouped components are written with
+        an empty array of scales.
+
+        INPUTS:
+        name        (no default):   File name of the component list. Will overwrite.
+        """
+
+        scale = self.scale if self.scale is not None else np.zeros(0)
+
+        # The positions are stored in the smallest unsigned integers which hold them, i.e. 16 bits for images of up to
+        # 65536 pixels across. Writing to an open file stops numpy from appending .npz to the name.
+
+        position_type = np.min_scalar_type(max(self.shape) - 1)
+
+        with open(name, "wb") as component_file:
+            np.savez(component_file, shape=np.array(self.shape), y=self.y.astype(position_type),
+                     x=self.x.astype(position_type), flux=self.flux, scale=scale.astype(np.int8))
+
+    @classmethod
+    def load(cls, name):
+        """
+        Alternative constructor which reads a component list written by save.
+
+        INPUTS:
+        name        (no default):   File name of the component list.
+
+        OUTPUTS:
+        components                  ComponentList read from the file.
+        """
+
+        try:
+            component_file = np.load(name)
+        except (IOError, OSError, ValueError):
+            component_file = None
+
+        if (not hasattr(component_file, "files")) or (not set(FILE_FIELDS).issubset(component_file.files)):
+            logger.error("{} is not a pymoresane component list.".format(name))
+            raise ValueError("{} is not a pymoresane component list.".format(name))
+
+        with component_file:
+            scale = component_file["scale"]
+
+            return cls(component_file["shape"], component_file["y"], component_file["x"], component_file["flux"],
+                       scale if scale.size==component_file["flux"].size else None)
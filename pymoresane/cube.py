@@ -0,0 +1,450 @@
+import logging
+import multiprocessing as mp
+import time
+import pyfits
+import numpy as np
+import pymoresane.distributed as distributed
+import pymoresane.memory as memory
+import pymoresane.precompute as precompute
+import pymoresane.pipeline as pipeline
+import pymoresane.shared as shared
+
+from pymoresane.main import FitsImage, smooth_mask
+
+logger = logging.getLogger(__name__)
+
+# State of each worker process of the pool, set up once by init_worker rather than sent with every plane.
+
+_worker = {}
+
+
+def plane_stack(data):
+    """
+    Views the data of a .fits file as a stack of planes. As in FitsImage.handle_input, RA and DEC are assumed to be
+    the last two axes of the array - every other axis (FREQ, STOKES, ...) is iterated over.
+
+    INPUTS:
+    data    (no default):   Array containing the data of the .fits file.
+
+    OUTPUTS:
+    Array of shape (plane_count, DEC, RA).
+    """
+
+    return data.reshape(-1, data.shape[-2], data.shape[-1])
+
+
+def psf_plane_indices(dirty_shape, psf_shape):
+    """
+    Determines which PSF plane is to be used for each plane of the dirty cube. The non-spatial axes of the PSF cube
+    are broadcast against those of the dirty cube, so that a single PSF plane may serve the whole cube, or one PSF
+    per channel may be shared between all Stokes parameters.
+
+    INPUTS:
+    dirty_shape     (no default):   Shape of the dirty cube.
+    psf_shape       (no default):   Shape of the PSF cube.
+
+    OUTPUTS:
+    Array containing the index of the PSF plane for each dirty plane.
+    """
+
+    psf_planes = np.arange(int(np.prod(psf_shape[:-2]))).reshape(psf_shape[:-2])
+
+    try:
+        return np.broadcast_to(psf_planes, dirty_shape[:-2]).ravel()
+    except ValueError:
+        logger.error("PSF cube of shape {} does not match dirty cube of shape {}.".format(psf_shape, dirty_shape))
+        raise ValueError("PSF cube of shape {} does not match dirty cube of shape {}.".format(psf_shape, dirty_shape))
+
+
+def shared_precomputations(psf_data, dirty_plane_shape, psf_hdr, params, cache_dir=None):
+    """
+    Computes the PSF FFTs, PSF energies and restoring beam of a PSF plane so that they may be shared with every
+    worker. Precomputations on the gpu cannot be shared between processes and are left to the workers.
+
+    INPUTS:
+    psf_data            (no default):   Array containing the PSF plane.
+    dirty_plane_shape   (no default):   Shape of a single plane of the dirty cube.
+    psf_hdr             (no default):   Header of the PSF.
+    params              (no default):   Dictionary of keyword arguments for the deconvolution.
+    cache_dir           (default=None): Directory in which PSF precomputations are cached between runs.
+
+    OUTPUTS:
+    Dictionary of precomputations, as returned by PrecomputationCache.entries.
+    """
+
+    cache = precompute.PrecomputationCache(psf_data, dirty_plane_shape, cache_dir)
+
+    on_gpu = params.get("all_on_gpu", False) | (params.get("conv_device", "cpu")=="gpu")
+
+    if not on_gpu:
+        subregion = params.get("subregion")
+
+        if (subregion is None) or (subregion>dirty_plane_shape[0]):
+            subregion = dirty_plane_shape[0]
+
+        cache.psf_ffts(subregion, "cpu", params.get("conv_mode", "linear"))
+
+        if params.get("decom_mode", "ser")!="gpu":
+            cache.psf_energies(subregion, int(np.log2(dirty_plane_shape[0])-1), params.get("decom_mode", "ser"),
+                               params.get("core_count", 1))
+
+    cache.beam_parameters(psf_hdr)
+
+    return cache.entries()
+
+
+def plane_state(psf_stack, mask, entries, img_hdr, psf_hdr, params, single_run, cache_dir):
+    """
+    Collects everything needed to deconvolve the planes of a cube, other than the planes themselves.
+
+    INPUTS:
+    psf_stack   (no default):   Array of PSF planes.
+    mask        (no default):   Array containing a deconvolution mask, or None.
+    entries     (no default):   Dictionary of precomputations of the first PSF plane, see shared_precomputations.
+    img_hdr     (no default):   Header of the dirty cube.
+    psf_hdr     (no default):   Header of the PSF.
+    params      (no default):   Dictionary of keyword arguments for the deconvolution.
+    single_run  (no default):   Boolean specifier for whether FitsImage.moresane is used.
+    cache_dir   (no default):   Directory in which PSF precomputations are cached between runs.
+
+    OUTPUTS:
+    Dictionary describing the deconvolution, as used by deconvolve_data.
+    """
+
+    # One PrecomputationCache is kept per PSF plane, so that planes which share a PSF also share its FFTs, energies
+    # and restoring beam.
+
+    return dict(psf_stack=psf_stack, mask=mask, entries=entries, img_hdr=img_hdr, psf_hdr=psf_hdr, params=params,
+                single_run=single_run, cache_dir=cache_dir, caches={})
+
+
+def deconvolve_data(state, dirty_data, psf_plane):
+    """
+    Deconvolves a single plane of the cube.
+
+    INPUTS:
+    state       (no default):   Dictionary describing the deconvolution, as returned by plane_state.
+    dirty_data  (no default):   Array containing the dirty plane.
+    psf_plane   (no default):   Index of the PSF plane.
+
+    OUTPUTS:
+    model                       Array containing the model plane.
+    residual                    Array containing the residual plane.
+    restored                    Array containing the restored plane.
+    beam_params                 List of the restoring beam parameters, or None if the plane was skipped.
+    """
+
+    # Blank or flagged planes are passed through unchanged rather than deconvolved.
+
+    if (not np.all(np.isfinite(dirty_data))) or (not np.any(dirty_data)):
+        return np.zeros_like(dirty_data), dirty_data, dirty_data, None
+
+    psf_data = state["psf_stack"][psf_plane]
+
+    if psf_plane not in state["caches"]:
+        cache = precompute.PrecomputationCache(np.asarray(psf_data, dtype=np.float32), dirty_data.shape,
+                                               state["cache_dir"])
+        if psf_plane==0:
+            cache.load_entries(state["entries"])
+        state["caches"][psf_plane] = cache
+
+    data = FitsImage.from_arrays(dirty_data, psf_data, state["img_hdr"].copy(), state["psf_hdr"], state["mask"],
+                                 state["cache_dir"], state["caches"][psf_plane])
+
+    if state["single_run"]:
+        data.moresane(**state["params"])
+    else:
+        data.moresane_by_scale(**state["params"])
+
+    data.restore()
+
+    return data.model, data.residual, data.restored, list(data.precomputed.beam_parameters(data.psf_hdr))
+
+
+def init_worker(image_name, psf_descriptor, mask_descriptor, output_descriptors, entry_descriptors, img_hdr,
+                psf_hdr, params, single_run, cache_dir):
+    """
+    Initialises a worker process of the pool. The dirty cube is read plane by plane from a memory-mapped .fits file,
+    while the PSF cube, mask, precomputations and output cubes are attached from shared memory.
+    """
+
+    _worker["img_hdu_list"] = pyfits.open(image_name, memmap=True)
+    _worker["dirty_stack"] = plane_stack(_worker["img_hdu_list"][0].data)
+
+    # The SharedArrays are kept so that the memory remains attached for the lifetime of the worker.
+
+    psf_stack = shared.SharedArray.attach(psf_descriptor)
+    mask = shared.SharedArray.attach(mask_descriptor) if mask_descriptor is not None else None
+
+    _worker["outputs"] = [shared.SharedArray.attach(descriptor) for descriptor in output_descriptors]
+    _worker["shared_entries"], entries = shared.attach_entries(entry_descriptors)
+    _worker["shared"] = [psf_stack, mask]
+
+    _worker["state"] = plane_state(psf_stack.array, mask.array if mask is not None else None, entries, img_hdr,
+                                   psf_hdr, params, single_run, cache_dir)
+
+
+def deconvolve_plane(task):
+    """
+    Deconvolves a single plane of the cube in a worker process and stores the model, residual and restored planes in
+    the shared output cubes.
+
+    INPUTS:
+    task    (no default):   Tuple of the index of the plane and the index of its PSF plane.
+
+    OUTPUTS:
+    plane                   Index of the plane.
+    beam_params             List of the restoring beam parameters, or None if the plane was skipped.
+    """
+
+    plane, psf_plane = task
+
+    dirty_data = np.array(_worker["dirty_stack"][plane], dtype=np.float32)
+
+    results = deconvolve_data(_worker["state"], dirty_data, psf_plane)
+
+    for output, result in zip(_worker["outputs"], results[:3]):
+        output.array[plane] = result
+
+    return plane, results[3]
+
+
+def deconvolve_cube(image_name, psf_name, model_name, residual_name, restored_name, params, single_run=False,
+                    mask_name=None, cache_dir=None, worker_count=None, queue_size=2, coordinator=None):
+    """
+    Deconvolves every plane of a spectral or polarisation cube. The model, residual and restored cubes are each
+    written to a single .fits file, plane by plane as the planes are completed.
+
+    With a single worker, the planes are deconvolved in this process by a Pipeline, so that reading the next plane and
+    writing the previous one overlap with the deconvolution. Otherwise, the planes are distributed over a pool of
+    processes and a writer thread flushes the planes as the workers complete them.
+
+    INPUTS:
+    image_name      (no default):   Name of the input .fits file containing the dirty cube.
+    psf_name        (no default):   Name of the input .fits file containing the PSF, either a single plane or a cube
+                                    which can be broadcast against the dirty cube.
+    model_name      (no default):   Name of the output .fits file for the model cube.
+    residual_name   (no default):   Name of the output .fits file for the residual cube.
+    restored_name   (no default):   Name of the output .fits file for the restored cube.
+    params          (no default):   Dictionary of keyword arguments for FitsImage.moresane or
+                                    FitsImage.moresane_by_scale.
+    single_run      (default=False):Boolean specifier for whether FitsImage.moresane is used rather than
+                                    FitsImage.moresane_by_scale.
+    mask_name       (default=None): Name of the input .fits file containing a deconvolution mask.
+    cache_dir       (default=None): Directory in which PSF precomputations are cached between runs.
+    worker_count    (default=None): Number of worker processes. Defaults to the number of cores.
+    queue_size      (default=2):    Maximum number of planes waiting to be deconvolved or written.
+    coordinator     (default=None): Coordinator which distributes the planes to remote workers. The planes are then
+                                    restored and written in this process, and worker_count limits the number of
+                                    planes which are outstanding at any one time.
+    """
+
+    start_time = time.time()
+
+    if (worker_count is None) & (coordinator is None):
+        worker_count = mp.cpu_count()
+
+    img_hdu_list = pyfits.open(image_name, memmap=True)
+    psf_hdu_list = pyfits.open(psf_name, memmap=True)
+
+    img_hdr = img_hdu_list[0].header.copy()
+    psf_hdr = psf_hdu_list[0].header
+
+    dirty_stack = plane_stack(img_hdu_list[0].data)
+    dirty_shape = img_hdu_list[0].data.shape
+    psf_shape = psf_hdu_list[0].data.shape
+
+    psf_planes = psf_plane_indices(dirty_shape, psf_shape)
+    plane_count = psf_planes.size
+    plane_shape = dirty_shape[-2:]
+
+    # Under a memory budget, the budget is divided between the workers. Fewer workers are used if a plane would not
+    # otherwise fit within its share, even with the most frugal memory plan.
+
+    if (coordinator is None) and (params.get("memory_budget") is not None):
+        subregion = min(params.get("subregion") or plane_shape[0], plane_shape[0])
+        worker_estimate = memory.estimate_memory(plane_shape, psf_shape[-2:], subregion,
+                                                 int(np.log2(plane_shape[0])-1), params.get("conv_mode", "linear"),
+                                                 mask_name is not None, memory.PLANS[-1])
+        worker_count, worker_budget = memory.divide_budget(params["memory_budget"], worker_count, worker_estimate)
+        params = dict(params, memory_budget=worker_budget)
+
+    logger.info("Deconvolving {} planes of {}x{}px using {} worker(s).".format(plane_count, plane_shape[0],
+                                                                              plane_shape[1], worker_count))
+
+    # The PSF cube is copied into shared memory once, rather than being sent to or read by every worker.
+
+    psf_stack = shared.SharedArray.from_array(plane_stack(psf_hdu_list[0].data), np.float32)
+    psf_hdu_list.close()
+
+    if mask_name is not None:
+        mask_hdu_list = pyfits.open(mask_name, memmap=True)
+        mask = shared.SharedArray.from_array(mask_hdu_list[0].data, np.float32)
+        mask_hdu_list.close()
+    else:
+        mask = None
+
+    outputs = []
+    writers = []
+    shared_entries = {}
+
+    try:
+        # When all planes share the same PSF, its precomputations are made here and shared with the workers.
+        # Otherwise each worker computes them once per PSF plane. The restoring beam of the first PSF plane is
+        # recorded in the header of the output cubes, which are allocated before the deconvolution starts.
+
+        if psf_stack.shape[0]==1:
+            entries = shared_precomputations(psf_stack.array[0], plane_shape, psf_hdr, params, cache_dir)
+            beam_params = [value for key, value in entries.items() if key[0]=="beam"][0]
+        else:
+            entries = {}
+            beam_params = precompute.PrecomputationCache(psf_stack.array[psf_planes[0]], plane_shape,
+                                                         cache_dir).beam_parameters(psf_hdr)
+
+        img_hdr.update('BMAJ',beam_params[0])
+        img_hdr.update('BMIN',beam_params[1])
+        img_hdr.update('BPA',beam_params[2])
+
+        writers = [pipeline.CubeFileWriter(name, img_hdr, dirty_shape)
+                   for name in [model_name, residual_name, restored_name]]
+
+        tasks = [(plane, int(psf_plane)) for plane, psf_plane in enumerate(psf_planes)]
+
+        if coordinator is not None:
+            deconvolve_remote(coordinator, dirty_stack, tasks, psf_stack.array, mask, writers, img_hdr, psf_hdr,
+                              params, single_run, worker_count, queue_size)
+
+        elif worker_count==1:
+            state = plane_state(psf_stack.array, mask.array if mask is not None else None, entries, img_hdr,
+                                psf_hdr, params, single_run, cache_dir)
+
+            def read(task):
+                return np.array(dirty_stack[task[0]], dtype=np.float32)
+
+            def process(task, dirty_data):
+                return deconvolve_data(state, dirty_data, task[1])
+
+            def write(task, results):
+                for writer, result in zip(writers, results[:3]):
+                    writer.write_plane(task[0], result)
+                log_plane(task[0], results[3])
+
+            pipeline.Pipeline(read, process, write, queue_size).run(tasks)
+
+        else:
+            outputs = [shared.SharedArray((plane_count,) + plane_shape, np.float32) for i in range(3)]
+            shared_entries, entry_descriptors = shared.share_entries(entries)
+
+            initargs = (image_name, psf_stack.descriptor(), mask.descriptor() if mask is not None else None,
+                        [output.descriptor() for output in outputs], entry_descriptors, img_hdr, psf_hdr, params,
+                        single_run, cache_dir)
+
+            def write(result, data):
+                plane, plane_beam_params = result
+                for writer, output in zip(writers, outputs):
+                    writer.write_plane(plane, output.array[plane])
+                log_plane(plane, plane_beam_params)
+
+            pool = mp.Pool(worker_count, initializer=init_worker, initargs=initargs)
+
+            try:
+                pipeline.Pipeline(None, None, write, queue_size).run(pool.imap_unordered(deconvolve_plane, tasks))
+            finally:
+                pool.close()
+                pool.join()
+
+    finally:
+        img_hdu_list.close()
+
+        for writer in writers:
+            writer.close()
+
+        for array in [psf_stack, mask] + outputs:
+            if array is not None:
+                array.close()
+
+        shared.close_entries(shared_entries)
+
+    end_time = time.time()
+    logger.info("Elapsed time was %s." % (time.strftime('%H:%M:%S', time.gmtime(end_time - start_time))))
+
+
+def deconvolve_remote(coordinator, dirty_stack, tasks, psf_stack, mask, writers, img_hdr, psf_hdr, params,
+                      single_run, max_pending=None, queue_size=2):
+    """
+    Deconvolves the planes of a cube on the remote workers of a coordinator. Blank planes are written directly, while
+    the remaining planes are sent to the workers as compressed buffers. The returned models and residuals are
+    restored and written in this process, overlapping with the remote deconvolution.
+
+    INPUTS:
+    coordinator (no default):   Coordinator which distributes the planes.
+    dirty_stack (no default):   Array of dirty planes.
+    tasks       (no default):   List of tuples of the index of each plane and the index of its PSF plane.
+    psf_stack   (no default):   Array of PSF planes.
+    mask        (no default):   SharedArray containing a deconvolution mask, or None.
+    writers     (no default):   List of the CubeFileWriters of the model, residual and restored cubes.
+    img_hdr     (no default):   Header of the dirty cube.
+    psf_hdr     (no default):   Header of the PSF.
+    params      (no default):   Dictionary of keyword arguments for the deconvolution.
+    single_run  (no default):   Boolean specifier for whether FitsImage.moresane is used.
+    max_pending (default=None): Maximum number of planes outstanding at any one time.
+    queue_size  (default=2):    Maximum number of planes waiting to be restored or written.
+    """
+
+    for psf_plane in set(psf_plane for plane, psf_plane in tasks):
+        coordinator.share(("psf", psf_plane), psf_stack[psf_plane])
+
+    if mask is not None:
+        mask = distributed.compress_array(smooth_mask(mask.array))
+
+    remote_tasks = []
+    caches = {}
+
+    def plane_tasks():
+        for plane, psf_plane in tasks:
+            dirty_data = np.array(dirty_stack[plane], dtype=np.float32)
+
+            if (not np.all(np.isfinite(dirty_data))) or (not np.any(dirty_data)):
+                for writer, result in zip(writers, [np.zeros_like(dirty_data), dirty_data, dirty_data]):
+                    writer.write_plane(plane, result)
+                log_plane(plane, None)
+                continue
+
+            remote_tasks.append((plane, psf_plane))
+
+            yield dict(dirty=distributed.compress_array(dirty_data), psf_key=("psf", psf_plane), mask=mask,
+                       params=params, single_run=single_run)
+
+    def restore(item, result):
+        plane, psf_plane = remote_tasks[item[0]]
+
+        if psf_plane not in caches:
+            caches[psf_plane] = precompute.PrecomputationCache(np.asarray(psf_stack[psf_plane], dtype=np.float32),
+                                                               dirty_stack.shape[-2:])
+
+        data = FitsImage.from_arrays(distributed.decompress_array(item[1]["residual"]), psf_stack[psf_plane],
+                                     img_hdr.copy(), psf_hdr, precomputed=caches[psf_plane])
+        data.model = distributed.decompress_array(item[1]["model"])
+        data.restore()
+
+        return plane, [data.model, data.residual, data.restored], list(data.precomputed.beam_parameters(data.psf_hdr))
+
+    def write(item, result):
+        plane, results, beam_params = result
+        for writer, data in zip(writers, results):
+            writer.write_plane(plane, data)
+        log_plane(plane, beam_params)
+
+    pipeline.Pipeline(None, restore, write, queue_size).run(coordinator.imap_unordered(plane_tasks(), max_pending))
+
+
+def log_plane(plane, beam_params):
+    """
+    Logs the completion of a plane and its restoring beam.
+    """
+
+    if beam_params is None:
+        logger.info("Skipped blank plane {}.".format(plane))
+    else:
+        logger.info("Completed plane {}.".format(plane))
+        logger.debug("Restoring beam of plane {}: {}".format(plane, beam_params))
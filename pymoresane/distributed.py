@@ -0,0 +1,530 @@
+import collections
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+import numpy as np
+import pymoresane.precompute as precompute
+
+from multiprocessing.managers import BaseManager
+
+logger = logging.getLogger(__name__)
+
+
+def compress_array(in1, level=1):
+    """
+    Compresses an array into a picklable buffer for transfer between nodes.
+
+    INPUTS:
+    in1     (no default):   Array which is to be compressed.
+    level   (default=1):    zlib compression level. Low levels are fast and still remove most of the zeros in models.
+
+    OUTPUTS:
+    Tuple of the compressed buffer, shape and data type of the array.
+    """
+
+    in1 = np.ascontiguousarray(in1)
+
+    return zlib.compress(in1.tobytes(), level), in1.shape, in1.dtype.str
+
+
+def decompress_array(buffer):
+    """
+    Inverse of compress_array.
+    """
+
+    data, shape, dtype = buffer
+
+    return np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape).copy()
+
+
+def parse_address(address):
+    """
+    Converts an address of the form HOST:PORT into a (host, port) tuple.
+    """
+
+    host, port = address.rsplit(":", 1)
+
+    return host, int(port)
+
+
+class TaskBoard(object):
+    """
+    Keeps track of the tasks of a coordinator. Workers fetch tasks from the board and submit their results to it.
+    Each fetched task is leased to a worker - if the worker fails the task, or stops sending heartbeats, the task is
+    returned to the queue until it has been attempted max_retries + 1 times.
+    """
+
+    def __init__(self, max_retries=2, worker_timeout=60):
+        """
+        INPUTS:
+        max_retries     (default=2):    Number of times a failed or lost task is retried.
+        worker_timeout  (default=60):   Time, in seconds, after which a worker which has not sent a heartbeat is
+                                        considered lost.
+        """
+
+        self.max_retries = max_retries
+        self.worker_timeout = worker_timeout
+
+        self.lock = threading.Lock()
+
+        self.pending = collections.deque()
+        self.tasks = {}
+        self.attempts = {}
+        self.leases = {}
+        self.heartbeats = {}
+        self.results = {}
+        self.errors = {}
+        self.shared = {}
+        self.closed = False
+        self.released = set()
+
+    def add(self, task_id, task):
+        """
+        Adds a task to the queue.
+        """
+
+        with self.lock:
+            self.tasks[task_id] = task
+            self.attempts[task_id] = 0
+            self.pending.append(task_id)
+
+    def share(self, key, value):
+        """
+        Stores a value, e.g. a compressed PSF, which is common to many tasks. Workers fetch it once using get_shared.
+        """
+
+        with self.lock:
+            self.shared[key] = value
+
+    def get_shared(self, key):
+        """
+        Returns a value stored by share.
+        """
+
+        with self.lock:
+            return self.shared[key]
+
+    def fetch(self, worker_id):
+        """
+        Leases the next task to a worker.
+
+        OUTPUTS:
+        Tuple of the task identifier and the task, or None if no task is pending.
+        """
+
+        with self.lock:
+            self.heartbeats[worker_id] = time.time()
+            self._requeue_lost()
+
+            if not self.pending:
+                return None
+
+            task_id = self.pending.popleft()
+            self.leases[task_id] = worker_id
+            self.attempts[task_id] += 1
+
+            return task_id, self.tasks[task_id]
+
+    def heartbeat(self, worker_id):
+        """
+        Records that a worker is still alive.
+        """
+
+        with self.lock:
+            self.heartbeats[worker_id] = time.time()
+
+    def submit(self, worker_id, task_id, result):
+        """
+        Stores the result of a task. Results of tasks which have already completed, e.g. after a worker was wrongly
+        considered lost, are discarded.
+        """
+
+        with self.lock:
+            self.heartbeats[worker_id] = time.time()
+
+            if (task_id in self.tasks) & (task_id not in self.results):
+                self.results[task_id] = result
+                self.leases.pop(task_id, None)
+                if task_id in self.pending:
+                    self.pending.remove(task_id)
+
+    def fail(self, worker_id, task_id, error):
+        """
+        Records the failure of a task, which is retried unless it has been attempted too often.
+        """
+
+        with self.lock:
+            self.heartbeats[worker_id] = time.time()
+
+            if self.leases.get(task_id)==worker_id:
+                del self.leases[task_id]
+                logger.warning("Task {} failed on worker {}: {}".format(task_id, worker_id, error))
+                self._retry(task_id, error)
+
+    def requeue_lost(self):
+        """
+        Returns the tasks leased to lost workers to the queue.
+        """
+
+        with self.lock:
+            self._requeue_lost()
+
+    def _requeue_lost(self):
+        now = time.time()
+
+        for task_id, worker_id in list(self.leases.items()):
+            if now - self.heartbeats.get(worker_id, now)>self.worker_timeout:
+                del self.leases[task_id]
+                logger.warning("Worker {} lost - retrying task {}.".format(worker_id, task_id))
+                self._retry(task_id, "worker {} lost".format(worker_id))
+
+    def _retry(self, task_id, error):
+        if self.attempts[task_id]>self.max_retries:
+            self.errors[task_id] = error
+        else:
+            self.pending.append(task_id)
+
+    def pop_completed(self):
+        """
+        Removes and returns the results and errors of all completed tasks.
+
+        OUTPUTS:
+        results                     Dictionary of results by task identifier.
+        errors                      Dictionary of errors by task identifier.
+        """
+
+        with self.lock:
+            results, self.results = self.results, {}
+            errors, self.errors = self.errors, {}
+
+            for task_id in list(results.keys()) + list(errors.keys()):
+                self.tasks.pop(task_id, None)
+                self.attempts.pop(task_id, None)
+
+            return results, errors
+
+    def close(self):
+        """
+        Signals to the workers that no further tasks will be added.
+        """
+
+        with self.lock:
+            self.closed = True
+
+    def is_closed(self, worker_id=None):
+        """
+        Returns True once the coordinator has closed the board. A worker which gives its identifier is recorded as
+        having seen that the board has closed, see unreleased_workers.
+        """
+
+        with self.lock:
+            if self.closed and (worker_id is not None):
+                self.released.add(worker_id)
+            return self.closed
+
+    def unreleased_workers(self):
+        """
+        Returns the identifiers of the workers which are still alive but have not yet seen that the board has closed.
+        """
+
+        with self.lock:
+            now = time.time()
+            return [worker_id for worker_id, heartbeat in self.heartbeats.items()
+                    if (worker_id not in self.released) and (now - heartbeat<=self.worker_timeout)]
+
+
+class WorkerManager(BaseManager):
+    """
+    Manager used by workers to connect to the TaskBoard of a coordinator.
+    """
+
+    pass
+
+
+WorkerManager.register("get_board")
+
+
+class Coordinator(object):
+    """
+    Serves a TaskBoard over TCP using multiprocessing.managers, so that workers on other nodes (see run_worker) can
+    fetch tasks and return their results. Tasks are dictionaries as understood by run_task.
+    """
+
+    def __init__(self, address=("", 0), authkey=None, max_retries=2, worker_timeout=60):
+        """
+        INPUTS:
+        address         (default=("", 0)):  Address on which the coordinator listens. Port 0 selects a free port.
+        authkey         (no default):       Authentication key which workers must present. As tasks are pickled, it
+                                            must be kept secret.
+        max_retries     (default=2):        Number of times a failed or lost task is retried.
+        worker_timeout  (default=60):       Time, in seconds, after which a silent worker is considered lost.
+        """
+
+        if not authkey:
+            logger.error("An authentication key is required to coordinate workers.")
+            raise ValueError("An authentication key is required to coordinate workers.")
+
+        if not isinstance(authkey, bytes):
+            authkey = authkey.encode()
+
+        self.board = TaskBoard(max_retries, worker_timeout)
+        self.task_count = 0
+
+        board = self.board
+
+        class CoordinatorManager(BaseManager):
+            pass
+
+        CoordinatorManager.register("get_board", callable=lambda: board)
+
+        self.server = CoordinatorManager(address, authkey).get_server()
+        self.address = self.server.address
+
+        # Connections are accepted here rather than by Server.serve_forever, which cannot stop its accepting thread
+        # and ends by raising SystemExit. The stop event also ends the threads which serve the workers.
+
+        self.server.stop_event = threading.Event()
+
+        self.server_thread = threading.Thread(target=self._accept, name="pymoresane-coordinator")
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        logger.info("Coordinator listening on {}:{}.".format(self.address[0] or socket.gethostname(),
+                                                            self.address[1]))
+
+    def _accept(self):
+        while not self.server.stop_event.is_set():
+            try:
+                connection = self.server.listener.accept()
+            except OSError:
+                continue
+
+            if self.server.stop_event.is_set():
+                connection.close()
+                break
+
+            handler = threading.Thread(target=self.server.handle_request, args=(connection,))
+            handler.daemon = True
+            handler.start()
+
+        self.server.listener.close()
+
+    def share(self, key, in1):
+        """
+        Makes an array, e.g. a PSF, available to all workers. Tasks refer to it by key.
+        """
+
+        self.board.share(key, compress_array(in1))
+
+    def imap_unordered(self, tasks, max_pending=None, poll_interval=0.05):
+        """
+        Distributes tasks to the workers, yielding results as they are completed.
+
+        INPUTS:
+        tasks           (no default):       Iterable of tasks.
+        max_pending     (default=None):     Maximum number of tasks queued or in progress at any one time, which limits
+                                            the memory held by the coordinator. Unlimited by default.
+        poll_interval   (default=0.05):     Time, in seconds, between checks for completed tasks.
+
+        OUTPUTS:
+        Tuples of the index of each task and its result.
+        """
+
+        tasks = iter(tasks)
+        outstanding = {}
+        exhausted = False
+        index = 0
+
+        while True:
+            while (not exhausted) and ((max_pending is None) or (len(outstanding)<max_pending)):
+                try:
+                    task = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                task_id = self.task_count
+                self.task_count += 1
+                outstanding[task_id] = index
+                index += 1
+                self.board.add(task_id, task)
+
+            if exhausted and not outstanding:
+                return
+
+            self.board.requeue_lost()
+            results, errors = self.board.pop_completed()
+
+            if errors:
+                task_id, error = list(errors.items())[0]
+                raise RuntimeError("Task {} failed after {} attempts: {}".format(task_id, self.board.max_retries + 1,
+                                                                                 error))
+
+            if not results:
+                time.sleep(poll_interval)
+
+            for task_id, result in results.items():
+                yield outstanding.pop(task_id), result
+
+    def map(self, tasks, max_pending=None):
+        """
+        Distributes tasks to the workers and returns their results in order.
+        """
+
+        results = {}
+
+        for index, result in self.imap_unordered(tasks, max_pending):
+            results[index] = result
+
+        return [results[index] for index in range(len(results))]
+
+    def close(self, timeout=5, poll_interval=0.05):
+        """
+        Closes the board, so that idle workers exit, and stops the server.
+
+        INPUTS:
+        timeout         (default=5):    Maximum time, in seconds, for which the server is kept up for workers which
+                                        have not yet seen that the board has closed.
+        poll_interval   (default=0.05): Time, in seconds, between checks for such workers.
+        """
+
+        self.board.close()
+
+        # Workers poll the board, so the server is kept up until every live worker has seen that it has closed.
+
+        end_time = time.time() + timeout
+
+        while self.board.unreleased_workers() and (time.time()<end_time):
+            time.sleep(poll_interval)
+
+        self.server.stop_event.set()
+
+        # The accepting thread is woken by a connection of its own, which it closes straight away.
+
+        host, port = self.address[:2]
+
+        try:
+            socket.create_connection((host if host not in ("", "0.0.0.0") else "127.0.0.1", port), 1).close()
+        except (IOError, OSError):
+            pass
+
+        self.server_thread.join(1)
+
+
+def run_task(task, state):
+    """
+    Deconvolves the dirty image of a task.
+
+    INPUTS:
+    task    (no default):   Dictionary containing the compressed dirty image ("dirty"), the key of the shared PSF
+                            ("psf_key"), an optional compressed and smoothed mask ("mask"), the keyword arguments for
+                            the deconvolution ("params") and whether FitsImage.moresane is to be used ("single_run").
+    state   (no default):   Dictionary of the worker state, containing the board and the cached PSFs.
+
+    OUTPUTS:
+    Dictionary containing the compressed model ("model") and residual ("residual").
+    """
+
+    from pymoresane.main import FitsImage
+
+    dirty_data = decompress_array(task["dirty"])
+
+    # Each PSF is fetched from the coordinator once, after which its precomputations are reused for every task which
+    # shares it.
+
+    psf_key = task["psf_key"]
+
+    if psf_key not in state["caches"]:
+        psf_data = decompress_array(state["board"].get_shared(psf_key)).astype(np.float32)
+        state["caches"][psf_key] = precompute.PrecomputationCache(psf_data, dirty_data.shape)
+
+    cache = state["caches"][psf_key]
+
+    data = FitsImage.from_arrays(dirty_data, cache.psf_data, None, None, precomputed=cache)
+
+    if task.get("mask") is not None:
+        data.mask = decompress_array(task["mask"])
+
+    if task["single_run"]:
+        data.moresane(**task["params"])
+    else:
+        data.moresane_by_scale(**task["params"])
+
+    return dict(model=compress_array(data.model), residual=compress_array(data.residual))
+
+
+def run_worker(address, authkey, worker_id=None, poll_interval=0.5, heartbeat_interval=5):
+    """
+    Runs a worker which fetches tasks from a coordinator until the coordinator closes or disappears.
+
+    INPUTS:
+    address             (no default):   Address of the coordinator as a (host, port) tuple.
+    authkey             (no default):   Authentication key of the coordinator.
+    worker_id           (default=None): Identifier of the worker. Defaults to the host name and process id.
+    poll_interval       (default=0.5):  Time, in seconds, between requests for tasks while the queue is empty.
+    heartbeat_interval  (default=5):    Time, in seconds, between heartbeats.
+    """
+
+    if not isinstance(authkey, bytes):
+        authkey = authkey.encode()
+
+    if worker_id is None:
+        worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+
+    manager = WorkerManager(address, authkey)
+    manager.connect()
+
+    state = dict(board=manager.get_board(), caches={})
+
+    # Heartbeats are sent from a separate thread, so that long tasks are not mistaken for lost workers. Proxies open
+    # a separate connection for each thread.
+
+    stop = threading.Event()
+
+    def heartbeat():
+        board = manager.get_board()
+        while not stop.wait(heartbeat_interval):
+            try:
+                board.heartbeat(worker_id)
+            except (EOFError, IOError):
+                return
+
+    heartbeat_thread = threading.Thread(target=heartbeat, name="pymoresane-heartbeat")
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+
+    logger.info("Worker {} connected to {}:{}.".format(worker_id, address[0], address[1]))
+
+    completed = 0
+
+    try:
+        while True:
+            item = state["board"].fetch(worker_id)
+
+            if item is None:
+                if state["board"].is_closed(worker_id):
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            task_id, task = item
+
+            try:
+                result = run_task(task, state)
+            except Exception as error:
+                logger.exception("Task {} failed.".format(task_id))
+                state["board"].fail(worker_id, task_id, repr(error))
+                continue
+
+            state["board"].submit(worker_id, task_id, result)
+            completed += 1
+
+    except (EOFError, IOError):
+        logger.info("Lost connection to the coordinator.")
+
+    finally:
+        stop.set()
+
+    logger.info("Worker {} completed {} tasks.".format(worker_id, completed))
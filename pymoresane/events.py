@@ -0,0 +1,133 @@
+import json
+import logging
+import sys
+import time
+import pymoresane.profiling as profiling
+
+logger = logging.getLogger(__name__)
+
+# The events emitted by FitsImage.moresane and FitsImage.moresane_by_scale.
+
+EVENTS = ("major", "minor", "scale_change", "completion")
+
+
+class EventHooks(object):
+    """
+    Callbacks which are invoked as a deconvolution progresses. A callback is called as callback(event, fields), where
+    fields is a dictionary of the iteration counters, convergence measures and timings of the event. A callback may
+    request that the deconvolution stops early by returning True - the current iteration is then completed and the
+    deconvolution finishes as though it had converged.
+
+    The events are:
+    major           After each major loop iteration. Carries iteration, scale_count, std_current, std_ratio,
+                    snr_current, max_scale, scale_adjust, minor_loop_niter and iteration_time.
+    minor           After each minor loop iteration. Carries iteration, major_iteration, snr_current, max_scale and
+                    scale_adjust.
+    scale_change    When the scale-by-scale approach moves on to a new maximum scale. Carries scale_count.
+    completion      When the deconvolution finishes. Carries major_loop_niter, std_current and stopped, which is True
+                    if a callback requested the stop.
+
+    Every event also carries its name (event) and the time elapsed since the deconvolution started (elapsed).
+    """
+
+    def __init__(self):
+        self.callbacks = dict((event, []) for event in EVENTS)
+        self.stop_requested = False
+        self.start_time = time.time()
+
+    def add(self, callback, events=EVENTS):
+        """
+        Registers a callback for one or more events.
+
+        INPUTS:
+        callback    (no default):   Function called as callback(event, fields).
+        events      (default=all):  Name of an event or sequence of names.
+        """
+
+        if isinstance(events, str):
+            events = [events]
+
+        for event in events:
+            if event not in self.callbacks:
+                raise ValueError("Unknown event {}. Events are {}.".format(event, ", ".join(EVENTS)))
+            self.callbacks[event].append(callback)
+
+    def remove(self, callback):
+        """
+        Removes a callback from every event.
+        """
+
+        for callbacks in self.callbacks.values():
+            while callback in callbacks:
+                callbacks.remove(callback)
+
+    def reset(self):
+        """
+        Clears any stop request and restarts the clock. Called at the start of each deconvolution.
+        """
+
+        self.stop_requested = False
+        self.start_time = time.time()
+
+    def emit(self, event, **fields):
+        """
+        Invokes the callbacks of an event.
+
+        INPUTS:
+        event       (no default):   Name of the event.
+        fields      (no default):   Quantities describing the event.
+
+        OUTPUTS:
+        True if a stop has been requested, by this or an earlier event.
+        """
+
+        callbacks = self.callbacks[event]
+
+        if callbacks:
+            fields["event"] = event
+            fields["elapsed"] = time.time() - self.start_time
+
+            for callback in callbacks:
+                if callback(event, fields):
+                    if not self.stop_requested:
+                        logger.info("Stop requested on {} event.".format(event))
+                    self.stop_requested = True
+
+        return self.stop_requested
+
+
+class EventStream(object):
+    """
+    Callback which writes each event as a line of JSON (newline-delimited JSON), so that the progress of a
+    deconvolution can be followed by other programs without parsing the log.
+    """
+
+    def __init__(self, name):
+        """
+        INPUTS:
+        name    (no default):   Name of the output file, or "-" for standard output. Will overwrite.
+        """
+
+        if name=="-":
+            self.out_file = sys.stdout
+            self.close_file = False
+        else:
+            self.out_file = open(name, "w")
+            self.close_file = True
+
+    def __call__(self, event, fields):
+        fields = dict(fields, timestamp=time.time())
+
+        self.out_file.write(json.dumps(fields, default=profiling.to_json) + "\n")
+        self.out_file.flush()
+
+        return False
+
+    def close(self):
+        """
+        Closes the output file.
+        """
+
+        if self.close_file:
+            self.out_file.close()
+
@@ -0,0 +1,333 @@
+import logging
+import multiprocessing as mp
+import time
+import numpy as np
+import pymoresane.distributed as distributed
+import pymoresane.iuwt_convolution as conv
+import pymoresane.memory as memory
+import pymoresane.precompute as precompute
+import pymoresane.shared as shared
+
+from pymoresane.main import FitsImage
+
+logger = logging.getLogger(__name__)
+
+# State of each worker process of the pool, set up once by init_worker rather than sent with every facet.
+
+_worker = {}
+
+
+def facet_starts(image_size, facet_size, overlap):
+    """
+    Determines the positions of the facets along one axis of the image. Facets are spread evenly so that neighbouring
+    facets overlap by at least overlap pixels.
+
+    INPUTS:
+    image_size  (no default):   Size of the image along the axis.
+    facet_size  (no default):   Size of each facet along the axis.
+    overlap     (no default):   Minimum overlap between neighbouring facets.
+
+    OUTPUTS:
+    List of the first pixel of each facet.
+    """
+
+    if facet_size>=image_size:
+        return [0]
+
+    facet_count = int(np.ceil(float(image_size - overlap)/(facet_size - overlap)))
+
+    return [int(start) for start in np.round(np.linspace(0, image_size - facet_size, facet_count))]
+
+
+def facet_taper(facet_size, overlap, first, last):
+    """
+    Creates the one-dimensional taper of a facet. The taper falls off as a raised cosine over the overlap at each edge
+    of the facet which is interior to the image, and is flat elsewhere.
+
+    INPUTS:
+    facet_size  (no default):   Size of the facet.
+    overlap     (no default):   Overlap between neighbouring facets.
+    first       (no default):   Boolean specifier for whether the facet lies on the first edge of the image.
+    last        (no default):   Boolean specifier for whether the facet lies on the last edge of the image.
+
+    OUTPUTS:
+    Array containing the taper.
+    """
+
+    taper = np.ones(facet_size)
+
+    if overlap>0:
+        ramp = 0.5 - 0.5*np.cos(np.pi*(np.arange(overlap) + 0.5)/overlap)
+
+        if not first:
+            taper[:overlap] = ramp
+        if not last:
+            taper[-overlap:] = ramp[::-1]
+
+    return taper
+
+
+def facet_layout(image_shape, facet_size, overlap):
+    """
+    Divides the image into overlapping facets.
+
+    INPUTS:
+    image_shape (no default):   Shape of the image.
+    facet_size  (no default):   Size of each (square) facet.
+    overlap     (no default):   Minimum overlap between neighbouring facets.
+
+    OUTPUTS:
+    facets                      List of tuples of the slices which select each facet from the image.
+    weights                     List of the corresponding taper weights, normalised so that the weights of all the
+                                facets sum to one at every pixel.
+    """
+
+    starts = [facet_starts(image_shape[i], facet_size, overlap) for i in range(2)]
+
+    facets = []
+    weights = []
+
+    for i, row in enumerate(starts[0]):
+        for j, col in enumerate(starts[1]):
+            facets.append((slice(row, row + facet_size), slice(col, col + facet_size)))
+            weights.append(np.outer(facet_taper(facet_size, overlap, i==0, i==len(starts[0])-1),
+                                    facet_taper(facet_size, overlap, j==0, j==len(starts[1])-1)))
+
+    weight_sum = np.zeros(image_shape)
+
+    for facet, weight in zip(facets, weights):
+        weight_sum[facet] += weight
+
+    weights = [(weight/weight_sum[facet]).astype(np.float32) for facet, weight in zip(facets, weights)]
+
+    return facets, weights
+
+
+def facet_psf(psf_data, dirty_data_shape, facet_size):
+    """
+    Returns the central region of the PSF which is used to deconvolve a facet. If the PSF is twice the size of the
+    image, the PSF of the facet is also twice the size of the facet.
+    """
+
+    if np.all(np.array(psf_data.shape)==2*np.array(dirty_data_shape)):
+        return psf_data[precompute.central_slice(psf_data.shape, 2*facet_size)]
+    else:
+        return psf_data[precompute.central_slice(psf_data.shape, facet_size)]
+
+
+def init_worker(residual_descriptor, psf_descriptor, mask_descriptor, facet_size, img_hdr, psf_hdr, params,
+                single_run):
+    """
+    Initialises a worker process of the pool by attaching the residual, PSF and mask from shared memory.
+    """
+
+    _worker["residual"] = shared.SharedArray.attach(residual_descriptor)
+    _worker["psf"] = shared.SharedArray.attach(psf_descriptor)
+
+    if mask_descriptor is not None:
+        _worker["mask"] = shared.SharedArray.attach(mask_descriptor)
+    else:
+        _worker["mask"] = None
+
+    psf_data = facet_psf(_worker["psf"].array, _worker["residual"].shape, facet_size)
+
+    # Every facet has the same size and PSF, so the precomputations of the PSF are made once per worker.
+
+    _worker["psf_data"] = np.array(psf_data)
+    _worker["precomputed"] = precompute.PrecomputationCache(_worker["psf_data"], (facet_size, facet_size))
+
+    _worker["img_hdr"] = img_hdr
+    _worker["psf_hdr"] = psf_hdr
+    _worker["params"] = params
+    _worker["single_run"] = single_run
+
+
+def deconvolve_facet(facet):
+    """
+    Deconvolves a single facet of the current residual in a worker process.
+
+    INPUTS:
+    facet   (no default):   Tuple of the slices which select the facet from the image.
+
+    OUTPUTS:
+    Array containing the model of the facet.
+    """
+
+    residual = np.array(_worker["residual"].array[facet])
+
+    if not np.any(residual):
+        return np.zeros_like(residual)
+
+    data = FitsImage.from_arrays(residual, _worker["psf_data"], _worker["img_hdr"], _worker["psf_hdr"],
+                                 precomputed=_worker["precomputed"])
+
+    # The mask has already been smoothed by the FitsImage of the full image.
+
+    if _worker["mask"] is not None:
+        data.mask = np.array(_worker["mask"].array[facet])
+
+    if _worker["single_run"]:
+        data.moresane(**_worker["params"])
+    else:
+        data.moresane_by_scale(**_worker["params"])
+
+    return data.model
+
+
+def deconvolve_facets(image, facet_size, overlap=32, worker_count=None, major_cycles=3, single_run=False,
+                      accuracy=1e-6, coordinator=None, **params):
+    """
+    Deconvolves a FitsImage facet by facet. In each major cycle, the facets of the current residual are deconvolved
+    in parallel by a pool of processes which share the residual, PSF and mask through shared memory. The models of
+    the facets are stitched together with taper weights, after which the residual of the full image is updated using
+    the full PSF. The result is stored in image.model and image.residual, as for FitsImage.moresane.
+
+    INPUTS:
+    image           (no default):   FitsImage which is to be deconvolved.
+    facet_size      (no default):   Size, in pixels, of each (square) facet. Must be even.
+    overlap         (default=32):   Minimum overlap, in pixels, between neighbouring facets.
+    worker_count    (default=None): Number of worker processes. Defaults to the number of cores.
+    major_cycles    (default=3):    Maximum number of global major cycles.
+    single_run      (default=False):Boolean specifier for whether FitsImage.moresane is used rather than
+                                    FitsImage.moresane_by_scale to deconvolve each facet.
+    accuracy        (default=1e-6): Threshold on the relative change in the standard deviation of the residual.
+                                    Exit the major cycle when the change falls below this threshold. Also passed on
+                                    to the deconvolution of each facet.
+    coordinator     (default=None): Coordinator which distributes the facets to remote workers, in which case no
+                                    local processes are started.
+    params          (no default):   Keyword arguments for FitsImage.moresane or FitsImage.moresane_by_scale. The
+                                    subregion is ignored, as each facet is deconvolved in full.
+    """
+
+    start_time = time.time()
+
+    if (facet_size%2)==1:
+        logger.error("Facet size is uneven. Please use even dimensions.")
+        raise ValueError("Facet size is uneven. Please use even dimensions.")
+
+    if worker_count is None:
+        worker_count = mp.cpu_count()
+
+    facet_size = min(facet_size, image.dirty_data_shape[0])
+    overlap = min(overlap, facet_size//2)
+
+    params = dict(params, accuracy=accuracy)
+    params.pop("subregion", None)
+
+    # A facet is not periodic, so the facets are always deconvolved using linear convolution. The conv_mode given
+    # applies to the update of the residual of the full image.
+
+    conv_mode = params.get("conv_mode", "linear")
+    params["conv_mode"] = "linear"
+
+    facets, weights = facet_layout(image.dirty_data_shape, facet_size, overlap)
+
+    # Under a memory budget, the budget is divided between the workers, as in cube mode.
+
+    if (coordinator is None) and (params.get("memory_budget") is not None):
+        worker_estimate = memory.estimate_memory((facet_size, facet_size), facet_psf(image.psf_data,
+                                                 image.dirty_data_shape, facet_size).shape, facet_size,
+                                                 int(np.log2(facet_size)-1), "linear", image.mask is not None,
+                                                 memory.PLANS[-1])
+        worker_count, worker_budget = memory.divide_budget(params["memory_budget"], worker_count, worker_estimate)
+        params["memory_budget"] = worker_budget
+
+    logger.info("Deconvolving {} facets of {}px using {} worker(s).".format(len(facets), facet_size, worker_count))
+
+    # The residual of the full image is updated on the cpu against the full PSF.
+
+    psf_data_fft = image.precomputed.psf_ffts(image.dirty_data_shape[0], "cpu", conv_mode)[1]
+
+    # With a coordinator, the facets are sent to remote workers. Otherwise the residual, PSF and mask are shared with
+    # a local pool of processes.
+
+    if coordinator is None:
+        residual = shared.SharedArray.from_array(image.residual, np.float32)
+        psf = shared.SharedArray.from_array(image.psf_data, np.float32)
+        mask = shared.SharedArray.from_array(image.mask, np.float32) if image.mask is not None else None
+
+        initargs = (residual.descriptor(), psf.descriptor(), mask.descriptor() if mask is not None else None,
+                    facet_size, image.img_hdr, image.psf_hdr, params, single_run)
+    else:
+        residual = psf = mask = None
+
+        coordinator.share("facet_psf", np.array(facet_psf(image.psf_data, image.dirty_data_shape, facet_size)))
+
+    def map_facets():
+        if coordinator is None:
+            return pool.map(deconvolve_facet, facets)
+
+        tasks = [dict(dirty=distributed.compress_array(image.residual[facet]), psf_key="facet_psf",
+                      mask=distributed.compress_array(image.mask[facet]) if image.mask is not None else None,
+                      params=params, single_run=single_run) for facet in facets]
+
+        return [distributed.decompress_array(result["model"]) for result in coordinator.map(tasks)]
+
+    try:
+        if coordinator is None:
+            pool = mp.Pool(worker_count, initializer=init_worker, initargs=initargs)
+        else:
+            pool = None
+
+        try:
+            std_current = np.std(image.residual)
+
+            for cycle in range(major_cycles):
+
+                facet_models = map_facets()
+
+                # The facet models are combined using their taper weights, so that sources in the overlaps are not
+                # counted twice.
+
+                model = np.zeros_like(image.model)
+
+                for facet, weight, facet_model in zip(facets, weights, facet_models):
+                    model[facet] += weight*facet_model
+
+                if not np.any(model):
+                    logger.info("Major cycle {} did no work - finished.".format(cycle + 1))
+                    break
+
+                # The facets cannot account for sources outside their borders, so the stitched model may over- or
+                # under-shoot. The step along the stitched model which minimises the norm of the residual of the full
+                # image is taken instead. As the residual is linear in the model, this requires only the response to
+                # the stitched model.
+
+                model_response = conv.fft_convolve(model, psf_data_fft, "cpu", conv_mode)
+
+                step = np.vdot(image.residual.ravel(), model_response.ravel())/\
+                       np.vdot(model_response.ravel(), model_response.ravel())
+                step = min(max(step, 0), 1)
+
+                if step==0:
+                    logger.info("Major cycle {} did not improve the residual - finished.".format(cycle + 1))
+                    break
+
+                image.model += (step*model).astype(np.float32)
+                image.component_groups = None
+                image.residual = (image.residual - step*model_response).astype(np.float32)
+
+                if residual is not None:
+                    residual.array[...] = image.residual
+
+                std_last = std_current
+                std_current = np.std(image.residual)
+
+                logger.info("Major cycle {} complete - residual standard deviation is {}.".format(cycle + 1,
+                                                                                                  std_current))
+
+                if abs(std_last - std_current)/std_last<accuracy:
+                    break
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    finally:
+        for array in [residual, psf, mask]:
+            if array is not None:
+                array.close()
+
+    end_time = time.time()
+    logger.info("Elapsed time was %s." % (time.strftime('%H:%M:%S', time.gmtime(end_time - start_time))))
@@ -0,0 +1,60 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# The pycuda and scikits.cuda names, imported on first use. The lock ensures that they are imported, and the CUDA
+# context created, only once when several threads request them at the same time.
+
+_pycuda = {}
+_cuda_fft = {}
+_import_lock = threading.RLock()
+
+
+def import_pycuda(namespace):
+    """
+    Imports pycuda on first use and makes drv, gpuarray and SourceModule available in the given module namespace.
+    Importing pycuda.autoinit creates a CUDA context, so this is deferred until a gpu mode is actually requested
+    rather than happening whenever pymoresane is imported. Called at the start of each function which uses the gpu.
+
+    INPUTS:
+    namespace   (no default):   Dictionary of the globals of the calling module, i.e. globals().
+    """
+
+    with _import_lock:
+        if not _pycuda:
+            try:
+                import pycuda.driver as drv
+                import pycuda.autoinit
+                import pycuda.gpuarray as gpuarray
+                from pycuda.compiler import SourceModule
+            except ImportError:
+                logger.error("Pycuda unavailable - GPU mode will fail.")
+                raise
+
+            _pycuda.update(drv=drv, gpuarray=gpuarray, SourceModule=SourceModule)
+
+    namespace.update(_pycuda)
+
+
+def import_cuda_fft(namespace):
+    """
+    As import_pycuda, but additionally makes the Plan, fft and ifft of scikits.cuda available for the gpu FFTs.
+
+    INPUTS:
+    namespace   (no default):   Dictionary of the globals of the calling module, i.e. globals().
+    """
+
+    import_pycuda(namespace)
+
+    with _import_lock:
+        if not _cuda_fft:
+            try:
+                from scikits.cuda.fft import Plan, fft, ifft
+            except ImportError:
+                logger.error("Scikits.cuda unavailable - GPU FFTs will fail.")
+                raise
+
+            _cuda_fft.update(Plan=Plan, fft=fft, ifft=ifft)
+
+    namespace.update(_cuda_fft)
@@ -1,17 +1,7 @@
 import numpy as np
 import multiprocessing as mp
 import ctypes
-import traceback
-
-try:
-    import pycuda.driver as drv
-    import pycuda.tools
-    import pycuda.autoinit
-    import pycuda.gpuarray as gpuarray
-    from pycuda.compiler import SourceModule
-except ImportError:
-    traceback.print_exc()
-    print("Pycuda unavailable - GPU mode will fail.")
+import pymoresane.gpu as gpu
 
 
 def iuwt_decomposition(in1, scale_count, scale_adjust=0, mode='ser', core_count=2, store_smoothed=False,
@@ -63,6 +53,46 @@ def iuwt_recomposition(in1, scale_adjust=0, mode='ser', core_count=1, store_on_g
     elif mode=='gpu':
         return gpu_iuwt_recomposition(in1, scale_adjust, store_on_gpu, smoothed_array)
 
+def extend_iuwt_decomposition(detail_coeffs, smoothed_array, scale_count, mode='ser', core_count=1):
+    """
+    This function extends an existing decomposition to a larger number of scales. Only the additional scales are
+    computed, starting from the smoothed coefficients of the existing decomposition. Only the 'ser' and 'mp'
+    implementations are supported.
+
+    INPUTS:
+    detail_coeffs       (no default):       Array containing the detail coefficients of the existing decomposition.
+    smoothed_array      (no default):       The smoothest approximation of the existing decomposition.
+    scale_count         (no default):       Maximum scale to be considered.
+    mode                (default='ser'):    Implementation of the IUWT to be used - 'ser' or 'mp'.
+    core_count          (default=1):        Additional option for multiprocessing - specifies core count.
+
+    OUTPUTS:
+    detail_coeffs                           Array containing the extended detail coefficients.
+    C0                                      Array containing the smoothest version of the input.
+    """
+
+    wavelet_filter = (1./16)*np.array([1,4,6,4,1])      # Filter-bank for use in the a trous algorithm.
+
+    if mode=='ser':
+        a_trous = lambda C0, scale: ser_a_trous(C0, wavelet_filter, scale)
+    elif mode=='mp':
+        a_trous = lambda C0, scale: mp_a_trous(C0, wavelet_filter, scale, core_count)
+    else:
+        raise ValueError("Decompositions can only be extended in 'ser' or 'mp' mode.")
+
+    extended_coeffs = np.empty([scale_count, smoothed_array.shape[0], smoothed_array.shape[1]])
+    extended_coeffs[:detail_coeffs.shape[0],:,:] = detail_coeffs
+
+    C0 = smoothed_array
+
+    for i in range(detail_coeffs.shape[0], scale_count):
+        C = a_trous(C0, i)                                                      # Approximation coefficients.
+        C1 = a_trous(C, i)                                                      # Approximation coefficients.
+        extended_coeffs[i,:,:] = C0 - C1                                        # Detail coefficients.
+        C0 = C
+
+    return extended_coeffs, C0
+
 def ser_iuwt_decomposition(in1, scale_count, scale_adjust, store_smoothed):
     """
     This function calls the a trous algorithm code to decompose the input into its wavelet coefficients. This is
@@ -190,6 +220,112 @@ def ser_a_trous(C0, filter, scale):
 
     return C1
 
+def ser_iuwt_decomposition_adjoint(in1, scale_adjust):
+    """
+    This function applies the adjoint of the serial IUWT decomposition. It maps a set of wavelet coefficients back to
+    a single array and is the transpose of ser_iuwt_decomposition (without the smoothed coefficients). This is
+    required by solvers which make use of the adjoint of the deconvolution operator.
+
+    INPUTS:
+    in1                 (no default):   Array containing wavelet coefficients.
+    scale_adjust        (no default):   Number of omitted scales.
+
+    OUTPUTS:
+    out1                                Array containing the result of the adjoint operation.
+    """
+
+    wavelet_filter = (1./16)*np.array([1,4,6,4,1])      # Filter-bank for use in the a trous algorithm.
+
+    scale_count = in1.shape[0] + scale_adjust
+
+    # The following reverses the operations of the decomposition. The final smoothed array is discarded by the
+    # decomposition, so its adjoint starts at zero.
+
+    C0_adj = np.zeros([in1.shape[1], in1.shape[2]])
+
+    for i in range(scale_count-1, scale_adjust-1, -1):
+        C_adj = C0_adj + ser_a_trous_adjoint(-in1[i-scale_adjust,:,:], wavelet_filter, i)
+        C0_adj = in1[i-scale_adjust,:,:] + ser_a_trous_adjoint(C_adj, wavelet_filter, i)
+
+    if scale_adjust>0:
+        for i in range(scale_adjust-1, -1, -1):
+            C0_adj = ser_a_trous_adjoint(C0_adj, wavelet_filter, i)
+
+    return C0_adj
+
+def ser_iuwt_recomposition_adjoint(in1, scale_count, scale_adjust):
+    """
+    This function applies the adjoint of the serial IUWT recomposition. It maps a single array to a set of wavelet
+    coefficients and is the transpose of ser_iuwt_recomposition (without the smoothed coefficients).
+
+    INPUTS:
+    in1                 (no default):   Array on which the adjoint is to be applied.
+    scale_count         (no default):   Maximum scale to be considered.
+    scale_adjust        (no default):   Number of omitted scales.
+
+    OUTPUTS:
+    detail_coeffs                       Array containing the result of the adjoint operation.
+    """
+
+    wavelet_filter = (1./16)*np.array([1,4,6,4,1])      # Filter-bank for use in the a trous algorithm.
+
+    detail_coeffs = np.empty([scale_count-scale_adjust, in1.shape[0], in1.shape[1]])
+
+    recomposition_adj = in1
+
+    if scale_adjust>0:
+        for i in range(0, scale_adjust):
+            recomposition_adj = ser_a_trous_adjoint(recomposition_adj, wavelet_filter, i)
+
+    for i in range(scale_adjust, scale_count):
+        detail_coeffs[i-scale_adjust,:,:] = recomposition_adj
+        recomposition_adj = ser_a_trous_adjoint(recomposition_adj, wavelet_filter, i)
+
+    return detail_coeffs
+
+def ser_a_trous_adjoint(C1, filter, scale):
+    """
+    The following is the adjoint of the serial a trous algorithm. The symmetric boundary handling makes ser_a_trous
+    non-symmetric at the edges, so each of its operations is transposed in reverse order.
+
+    INPUTS:
+    filter      (no default):   The filter-bank which is applied to the components of the transform.
+    C1          (no default):   The current array on which filtering is to be performed.
+    scale       (no default):   The scale for which the decomposition is being carried out.
+
+    OUTPUTS:
+    C0                          The result of applying the adjoint of the a trous algorithm to the input.
+    """
+    tmp = filter[2]*C1
+
+    tmp[:,:-(2**(scale+1))] += filter[0]*C1[:,(2**(scale+1)):]
+    tmp[:,(2**(scale+1))-1::-1] += filter[0]*C1[:,:(2**(scale+1))]
+
+    tmp[:,:-(2**scale)] += filter[1]*C1[:,(2**scale):]
+    tmp[:,(2**scale)-1::-1] += filter[1]*C1[:,:(2**scale)]
+
+    tmp[:,(2**scale):] += filter[3]*C1[:,:-(2**scale)]
+    tmp[:,:-(2**scale)-1:-1] += filter[3]*C1[:,-(2**scale):]
+
+    tmp[:,(2**(scale+1)):] += filter[4]*C1[:,:-(2**(scale+1))]
+    tmp[:,:-(2**(scale+1))-1:-1] += filter[4]*C1[:,-(2**(scale+1)):]
+
+    C0 = filter[2]*tmp
+
+    C0[:-(2**(scale+1)),:] += filter[0]*tmp[(2**(scale+1)):,:]
+    C0[(2**(scale+1))-1::-1,:] += filter[0]*tmp[:(2**(scale+1)),:]
+
+    C0[:-(2**scale),:] += filter[1]*tmp[(2**scale):,:]
+    C0[(2**scale)-1::-1,:] += filter[1]*tmp[:(2**scale),:]
+
+    C0[(2**scale):,:] += filter[3]*tmp[:-(2**scale),:]
+    C0[:-(2**scale)-1:-1,:] += filter[3]*tmp[-(2**scale):,:]
+
+    C0[(2**(scale+1)):,:] += filter[4]*tmp[:-(2**(scale+1)),:]
+    C0[:-(2**(scale+1))-1:-1,:] += filter[4]*tmp[-(2**(scale+1)):,:]
+
+    return C0
+
 def mp_iuwt_decomposition(in1, scale_count, scale_adjust, store_smoothed, core_count):
     """
     This function calls the a trous algorithm code to decompose the input into its wavelet coefficients. This is
@@ -398,6 +534,8 @@ def gpu_iuwt_decomposition(in1, scale_count, scale_adjust, store_smoothed, store
     C0                  (optional):     Array containing the smoothest version of the input.
     """
 
+    gpu.import_pycuda(globals())
+
     # The following simple kernel just allows for the construction of a 3D decomposition on the GPU.
 
     ker = SourceModule("""
@@ -512,6 +650,8 @@ def gpu_iuwt_recomposition(in1, scale_adjust, store_on_gpu, smoothed_array):
     recomposiiton                   Array containing the reconstructed array.
     """
 
+    gpu.import_pycuda(globals())
+
     wavelet_filter = (1./16)*np.array([1,4,6,4,1], dtype=np.float32)    # Filter-bank for use in the a trous algorithm.
     wavelet_filter = gpuarray.to_gpu_async(wavelet_filter)
 
@@ -585,6 +725,8 @@ def gpu_a_trous():
     Simple convenience function so that the a trous kernels can be easily accessed by any function.
     """
 
+    gpu.import_pycuda(globals())
+
     ker1 = SourceModule("""
                         __global__ void gpu_a_trous_row_kernel(float *in1, float *in2, float *wfil, int *scale)
                         {
@@ -1,18 +1,20 @@
 import numpy as np
-import traceback
-
-try:
-    import pycuda.driver as drv
-    import pycuda.tools
-    import pycuda.autoinit
-    import pycuda.gpuarray as gpuarray
-    from pycuda.compiler import SourceModule
-    from scikits.cuda.fft import Plan
-    from scikits.cuda.fft import fft
-    from scikits.cuda.fft import ifft
-except:
-    traceback.print_exc()
-    print("Pycuda unavailable - GPU mode will fail.")
+from scipy import ndimage
+import pymoresane.gpu as gpu
+from pymoresane.beam_fit import BEAM_SUPPORT
+
+# Gaussians aligned with the pixel axes which extend at most SEPARABLE_WIDTH pixels from their peak are convolved by
+# filtering along each axis in real space, which is then faster than the FFT.
+
+SEPARABLE_WIDTH = 24
+
+# Approximate costs, in nanoseconds, of gaussian_convolve - per pixel and doubling of the FFT size, and per pixel and
+# per pixel of half width of the separable filters, in addition to a fixed cost per pixel. These are compared with the
+# cost of restoring a model by splatting its components, see components.splat_cost.
+
+FFT_COST = 2.5
+FILTER_COST = 2
+FILTER_PIXEL_COST = 20
 
 
 def fft_convolve(in1, in2, conv_device="cpu", conv_mode="linear", store_on_gpu=False):
@@ -65,7 +67,7 @@ def fft_convolve(in1, in2, conv_device="cpu", conv_mode="linear", store_on_gpu=F
             fft_in1 = pad_array(in1)
             fft_in2 = in2
 
-            out1_slice = tuple(slice(0.5*sz,1.5*sz) for sz in in1.shape)
+            out1_slice = tuple(slice(sz//2,3*sz//2) for sz in in1.shape)
 
             return np.require(np.fft.fftshift(np.fft.irfft2(fft_in2*np.fft.rfft2(fft_in1)))[out1_slice], np.float32, 'C')
 
@@ -73,6 +75,181 @@ def fft_convolve(in1, in2, conv_device="cpu", conv_mode="linear", store_on_gpu=F
             return np.fft.fftshift(np.fft.irfft2(in2*np.fft.rfft2(in1)))
 
 
+def fft_convolve_adjoint(in1, in2, conv_mode="linear"):
+    """
+    This function applies the adjoint of fft_convolve on the CPU. This amounts to a correlation with the PSF and is
+    required by solvers which make use of the adjoint of the deconvolution operator.
+
+    INPUTS:
+    in1             (no default):           Array containing one set of data, possibly an image.
+    in2             (no default):           Array containing the FFT of the PSF, as passed to fft_convolve.
+    conv_mode       (default = "linear"):   Mode specifier for the convolution - "linear" or "circular".
+    """
+
+    if conv_mode=="linear":
+        out1_slice = tuple(slice(sz//2, 3*sz//2) for sz in in1.shape)
+
+        fft_in1 = np.zeros([2*sz for sz in in1.shape])
+        fft_in1[out1_slice] = in1
+
+        return np.fft.irfft2(np.conj(in2)*np.fft.rfft2(np.fft.ifftshift(fft_in1)), fft_in1.shape)[out1_slice]
+
+    elif conv_mode=="circular":
+        return np.fft.irfft2(np.conj(in2)*np.fft.rfft2(np.fft.ifftshift(in1)), in1.shape)
+
+
+def gaussian_convolve(in1, covariance, conv_mode="linear"):
+    """
+    This function convolves an image with a Gaussian of unit peak, such as the restoring beam, without constructing
+    the Gaussian or taking its FFT. The image is filtered in real space along each axis if the Gaussian is aligned with
+    the axes and narrow, and is otherwise multiplied in the Fourier domain by the analytic transform of the Gaussian,
+    see gaussian_transfer. The result is that of an FFT convolution with the sampled Gaussian centred on the image.
+
+    INPUTS:
+    in1             (no default):           Array containing the image, e.g. the model.
+    covariance      (no default):           2x2 covariance of the Gaussian in pixels, see beam_fit.beam_covariance.
+    conv_mode       (default = "linear"):   Mode specifier for the convolution - "linear" or "circular".
+
+    OUTPUTS:
+    out1                                    Single precision array containing the convolved image.
+    """
+
+    in1 = np.asarray(in1, dtype=np.float32)
+
+    half_width = int(np.ceil(BEAM_SUPPORT*np.sqrt(np.max(np.linalg.eigvalsh(covariance)))))
+
+    aligned = abs(covariance[0,1])<=1e-6*np.sqrt(covariance[0,0]*covariance[1,1])
+
+    if aligned & (half_width<=SEPARABLE_WIDTH):
+
+        # The axes of the image are rows (y downwards) and columns (x), so the variance along rows is that along y.
+        # gaussian_filter1d normalises the sampled Gaussian to a unit sum, which is undone to give it a unit peak.
+
+        mode = "constant" if conv_mode=="linear" else "wrap"
+
+        out1 = in1
+
+        for axis, variance in [(0, covariance[1,1]), (1, covariance[0,0])]:
+            sigma = np.sqrt(variance)
+            radius = int(BEAM_SUPPORT*sigma + 0.5)
+            kernel_sum = np.sum(np.exp(-0.5*np.arange(-radius, radius + 1)**2/variance))
+
+            out1 = ndimage.gaussian_filter1d(out1, sigma, axis=axis, mode=mode, truncate=BEAM_SUPPORT)
+            out1 *= kernel_sum
+
+        return out1
+
+    # Linear convolution only requires padding by the extent of the Gaussian rather than doubling the image. The
+    # padding is taken up by rfft2 and dropped by irfft2, so no padded copy of the image is made.
+
+    if conv_mode=="linear":
+        fft_shape = tuple(fast_length(sz + half_width) for sz in in1.shape)
+    else:
+        fft_shape = in1.shape
+
+    fft_in1 = np.fft.rfft2(in1, fft_shape)
+    fft_in1 *= gaussian_transfer(fft_shape, covariance)
+
+    return np.require(np.fft.irfft2(fft_in1, fft_shape)[:in1.shape[0],:in1.shape[1]], np.float32, 'C')
+
+
+def gaussian_convolve_cost(shape, covariance, conv_mode="linear"):
+    """
+    This function estimates the time, in nanoseconds, taken by gaussian_convolve to convolve an image with a Gaussian.
+
+    INPUTS:
+    shape           (no default):           Shape of the image.
+    covariance      (no default):           2x2 covariance of the Gaussian in pixels.
+    conv_mode       (default = "linear"):   Mode specifier for the convolution - "linear" or "circular".
+
+    OUTPUTS:
+    Estimated time in nanoseconds.
+    """
+
+    half_width = int(np.ceil(BEAM_SUPPORT*np.sqrt(np.max(np.linalg.eigvalsh(covariance)))))
+
+    aligned = abs(covariance[0,1])<=1e-6*np.sqrt(covariance[0,0]*covariance[1,1])
+
+    if aligned & (half_width<=SEPARABLE_WIDTH):
+        return shape[0]*shape[1]*(FILTER_PIXEL_COST + FILTER_COST*half_width)
+
+    if conv_mode=="linear":
+        fft_size = (shape[0] + half_width)*(shape[1] + half_width)
+    else:
+        fft_size = shape[0]*shape[1]
+
+    return FFT_COST*fft_size*np.log2(fft_size)
+
+
+def gaussian_transfer(shape, covariance):
+    """
+    This function evaluates the transform of a sampled Gaussian of unit peak on the grid of rfft2, so that it may be
+    used in place of the FFT of the Gaussian centred at the origin. The transform of the continuous Gaussian is
+    analytic. Sampling aliases it, which is only significant for Gaussians less than a couple of pixels across, in
+    which case as many aliases are added as are above single precision. A Gaussian of a standard deviation of a third
+    of a pixel requires three aliases on either side.
+
+    INPUTS:
+    shape           (no default):   Shape of the real array to which the transform applies.
+    covariance      (no default):   2x2 covariance of the Gaussian in pixels, x to the right and y upwards.
+
+    OUTPUTS:
+    transfer                        Single precision array containing the transform.
+    """
+
+    # Rows of the image run downwards, so the y frequency is the negative of that along the rows.
+
+    row_freqs = -np.fft.fftfreq(shape[0]).astype(np.float32)[:,np.newaxis]
+    col_freqs = np.fft.rfftfreq(shape[1]).astype(np.float32)[np.newaxis,:]
+
+    cxx, cxy, cyy = [np.float32(2*(np.pi**2)*value) for value in [covariance[0,0], covariance[0,1], covariance[1,1]]]
+
+    # The alias k is at most exp(-2*(pi**2)*variance*(|k|-0.5)**2) at the Nyquist frequency, where the variance is
+    # that of the narrowest axis of the Gaussian. Aliases are added until this falls below single precision.
+
+    min_variance = np.min(np.linalg.eigvalsh(covariance))
+
+    alias_count = max(int(np.ceil(np.sqrt(-np.log(np.finfo(np.float32).eps)/(2*(np.pi**2)*min_variance)) - 0.5)), 0)
+
+    aliases = range(-alias_count, alias_count + 1)
+
+    transfer = np.zeros([shape[0], shape[1]//2 + 1], dtype=np.float32)
+
+    for row_alias in aliases:
+        for col_alias in aliases:
+            fy = row_freqs + row_alias
+            fx = col_freqs + col_alias
+
+            exponent = (2*cxy)*fx*fy
+            exponent += cxx*fx**2
+            exponent += cyy*fy**2
+
+            transfer += np.exp(-exponent)
+
+    transfer *= np.float32(2*np.pi*np.sqrt(np.linalg.det(covariance)))
+
+    return transfer
+
+
+def fast_length(length):
+    """
+    Returns the smallest length of at least length which has no prime factors other than 2, 3 and 5, for which the FFT
+    is fastest.
+    """
+
+    while True:
+        remainder = length
+
+        for factor in [2, 3, 5]:
+            while remainder%factor==0:
+                remainder //= factor
+
+        if remainder==1:
+            return length
+
+        length += 1
+
+
 def gpu_r2c_fft(in1, is_gpuarray=False, store_on_gpu=False):
     """
     This function makes use of the scikits implementation of the FFT for GPUs to take the real to complex FFT.
@@ -88,6 +265,8 @@ def gpu_r2c_fft(in1, is_gpuarray=False, store_on_gpu=False):
     gpu_out1.get()                      The result from the gpu array.
     """
 
+    gpu.import_cuda_fft(globals())
+
     if is_gpuarray:
         gpu_in1 = in1
     else:
@@ -120,6 +299,8 @@ def gpu_c2r_ifft(in1, is_gpuarray=False, store_on_gpu=False):
     gpu_out1.get()                      The result from the gpu array.
     """
 
+    gpu.import_cuda_fft(globals())
+
     if is_gpuarray:
         gpu_in1 = in1
     else:
@@ -153,7 +334,7 @@ def pad_array(in1):
     padded_size = 2*np.array(in1.shape)
 
     out1 = np.zeros([padded_size[0],padded_size[1]])
-    out1[padded_size[0]/4:3*padded_size[0]/4,padded_size[1]/4:3*padded_size[1]/4] = in1
+    out1[padded_size[0]//4:3*padded_size[0]//4,padded_size[1]//4:3*padded_size[1]//4] = in1
 
     return out1
 
@@ -169,6 +350,8 @@ def fft_shift(in1):
     in1                     FFT-shifted version of in1.
     """
 
+    gpu.import_pycuda(globals())
+
     ker = SourceModule("""
                         __global__ void fft_shift_ker(float *in1)
                         {
@@ -212,6 +395,8 @@ def contiguous_slice(in1):
     gpu_out1                Array containing unpadded, contiguous data.
     """
 
+    gpu.import_pycuda(globals())
+
     ker = SourceModule("""
                         __global__ void contiguous_slice_ker(float *in1, float *out1)
                         {
@@ -248,6 +433,8 @@ def scale_fft(in1):
 
     """
 
+    gpu.import_pycuda(globals())
+
     ker = SourceModule("""
                         __global__ void scale_fft_ker(float *in1)
                         {
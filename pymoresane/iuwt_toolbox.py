@@ -1,18 +1,6 @@
 import numpy as np
 from scipy import ndimage
-import traceback
-
-try:
-    import pycuda.driver as drv
-    import pycuda.tools
-    import pycuda.autoinit
-    import pycuda.gpuarray as gpuarray
-    from pycuda.compiler import SourceModule
-except:
-    traceback.print_exc()
-    print("Pycuda unavailable - GPU mode will fail.")
-
-import pylab as plt
+import pymoresane.gpu as gpu
 
 def estimate_threshold(in1, edge_excl=0, int_excl=0):
     """
@@ -74,8 +62,56 @@ def apply_threshold(in1, threshold, sigma_level=4):
 
     return out1
 
+def suppression_widths(scale_count, edge_suppression=False, edge_offset=0):
+    """
+    This function determines the width of the border of each scale whose wavelet coefficients are suppressed. When
+    edge suppression is enabled, this is the width corrupted by the edges of the image at that scale, or the edge
+    offset if this is greater. Otherwise, it is the edge offset at every scale.
+
+    INPUTS:
+    scale_count         (no default):       Maximum scale to be considered.
+    edge_suppression    (default=False):    Boolean specifier for whether or not the edges are to be suprressed.
+    edge_offset         (default=0):        Number of additional edge pixels to be ignored.
+
+    OUTPUTS:
+    widths                                  List of the border widths of each scale.
+    """
+
+    widths = []
+    edge_corruption = 0
+
+    for i in range(scale_count):
+        edge_corruption += 2*2**i
+        if edge_suppression:
+            widths.append(max(edge_offset, edge_corruption))
+        else:
+            widths.append(edge_offset)
+
+    return widths
+
+def suppress_edges(in1, widths):
+    """
+    This function sets the wavelet coefficients within the border of each scale to zero, in place.
+
+    INPUTS:
+    in1         (no default):   Array containing the wavelet decomposition.
+    widths      (no default):   List of the border widths of each scale, as returned by suppression_widths.
+
+    OUTPUTS:
+    in1                         The decomposition with its borders suppressed.
+    """
+
+    for i, width in enumerate(widths[:in1.shape[0]]):
+        if width>0:
+            in1[i,:width,:] = 0
+            in1[i,-width:,:] = 0
+            in1[i,:,:width] = 0
+            in1[i,:,-width:] = 0
+
+    return in1
+
 def source_extraction(in1, tolerance, mode="cpu", store_on_gpu=False,
-                      neg_comp=False):
+                      neg_comp=False, dtype=None):
     """
     Convenience function for allocating work to cpu or gpu, depending on the selected mode.
 
@@ -83,18 +119,20 @@ def source_extraction(in1, tolerance, mode="cpu", store_on_gpu=False,
     in1         (no default):   Array containing the wavelet decomposition.
     tolerance   (no default):   Percentage of maximum coefficient at which objects are deemed significant.
     mode        (default="cpu"):Mode of operation - either "gpu" or "cpu".
+    dtype       (default=None): Type of the extracted coefficients on the cpu. By default, the type of the product of
+                                the mask and in1.
 
     OUTPUTS:
     Array containing the significant wavelet coefficients of extracted sources.
     """
 
     if mode=="cpu":
-        return cpu_source_extraction(in1, tolerance, neg_comp)
+        return cpu_source_extraction(in1, tolerance, neg_comp, dtype)
     elif mode=="gpu":
         return gpu_source_extraction(in1, tolerance, store_on_gpu, neg_comp)
 
 
-def cpu_source_extraction(in1, tolerance, neg_comp):
+def cpu_source_extraction(in1, tolerance, neg_comp, dtype=None):
     """
     The following function determines connectivity within a given wavelet decomposition. These connected and labelled
     structures are thresholded to within some tolerance of the maximum coefficient at the scale. This determines
@@ -105,51 +143,45 @@ def cpu_source_extraction(in1, tolerance, neg_comp):
     INPUTS:
     in1         (no default):   Array containing the wavelet decomposition.
     tolerance   (no default):   Percentage of maximum coefficient at which objects are deemed significant.
+    dtype       (default=None): Type of the extracted coefficients. By default, the type of objects*in1.
 
     OUTPUTS:
     objects*in1                 The wavelet coefficients of the significant structures.
-    objects                     The mask of the significant structures.
+    objects                     The mask of the significant structures, as a uint8 array.
     """
 
-    # The following initialises some variables for storing the labelled image and the number of labels. The per scale
-    # maxima are also initialised here.
+    # Only the support of the significant objects is kept for each scale, which requires a single byte per
+    # coefficient. The labels are only needed while the current scale is processed.
 
-    scale_maxima = np.empty([in1.shape[0],1])
+    objects = np.empty(in1.shape, dtype=np.uint8)
 
-    objects = np.empty_like(in1, dtype=np.int32)
-    object_count = np.empty([in1.shape[0],1], dtype=np.int32)
-
-    # The following loop uses functionality from the ndimage module to assess connectivity. The maxima are also
-    # calculated here.
+    # The following works from the largest scale down, as the objects of each scale must overlap the significant
+    # objects of the scale above. The connectivity of each scale is assessed using the ndimage module and the labels
+    # of the objects which contain a coefficient within tolerance of the maximum of the scale are retained.
 
-    for i in range(in1.shape[0]):
+    for i in range(-1,-in1.shape[0]-1,-1):
         if neg_comp:
-            scale_maxima[i] = np.max(abs(in1[i,:,:]))
+            scale_maximum = np.max(abs(in1[i,:,:]))
+            significant = (abs(in1[i,:,:])>=(tolerance*scale_maximum))
         else:
-            scale_maxima[i] = np.max(in1[i,:,:])
-        objects[i,:,:], object_count[i] = ndimage.label(in1[i,:,:], structure=[[1,1,1],[1,1,1],[1,1,1]])
+            scale_maximum = np.max(in1[i,:,:])
+            significant = (in1[i,:,:]>=(tolerance*scale_maximum))
 
-    # The following removes the insignificant objects and then extracts the remaining ones.
+        labels, label_count = ndimage.label(in1[i,:,:], structure=[[1,1,1],[1,1,1],[1,1,1]])
 
-    for i in range(-1,-in1.shape[0]-1,-1):
-        if neg_comp:
-            if i==(-1):
-                tmp = (abs(in1[i,:,:])>=(tolerance*scale_maxima[i]))*objects[i,:,:]
-            else:
-                tmp = (abs(in1[i,:,:])>=(tolerance*scale_maxima[i]))*objects[i,:,:]*objects[i+1,:,:]
-        else:
-            if i==(-1):
-                tmp = (in1[i,:,:]>=(tolerance*scale_maxima[i]))*objects[i,:,:]
-            else:
-                tmp = (in1[i,:,:]>=(tolerance*scale_maxima[i]))*objects[i,:,:]*objects[i+1,:,:]
+        if i!=(-1):
+            significant &= (objects[i+1,:,:]>0)
 
-        labels = np.unique(tmp[tmp>0])
+        significant_labels = np.zeros(label_count+1, dtype=np.uint8)
+        significant_labels[labels[significant]] = 1
+        significant_labels[0] = 0
 
-        for j in labels:
-            objects[i,(objects[i,:,:]==j)] = -1
+        objects[i,:,:] = significant_labels[labels]
+
+    # If a type is given, the product of the mask and the coefficients is formed directly in an array of that type.
 
-        objects[i,(objects[i,:,:]>0)] = 0
-        objects[i,:,:] = -(objects[i,:,:])
+    if dtype is not None:
+        return np.multiply(objects, in1, out=np.empty(in1.shape, dtype)), objects
 
     return objects*in1, objects
 
@@ -171,6 +203,8 @@ def gpu_source_extraction(in1, tolerance, store_on_gpu, neg_comp):
     objects                     The mask of the significant structures - if store_on_gpu is True, returns a gpuarray.
     """
 
+    gpu.import_pycuda(globals())
+
     # The following are pycuda kernels which are executed on the gpu. Specifically, these both perform thresholding
     # operations. The gpu is much faster at this on large arrays due to their massive parallel processing power.
 
@@ -289,18 +323,29 @@ def gpu_source_extraction(in1, tolerance, store_on_gpu, neg_comp):
     else:
         return objects*in1, objects
 
-def snr_ratio(in1, in2):
+def snr_ratio(in1, in2, in1_norm=None, work=None):
     """
     The following function simply calculates the signal to noise ratio between two signals.
 
     INPUTS:
     in1         (no default):   Array containing values for signal 1.
     in2         (no default):   Array containing values for signal 2.
+    in1_norm    (default=None): Precomputed norm of in1, if available.
+    work        (default=None): Array into which the difference of the signals is written. May be in2 itself, in which
+                                case in2 is overwritten. Avoids a temporary when given.
 
     OUTPUTS:
     out1                        The ratio of the signal to noise ratios of two signals.
     """
 
-    out1 = 20*(np.log10(np.linalg.norm(in1)/np.linalg.norm(in1-in2)))
+    if in1_norm is None:
+        in1_norm = np.linalg.norm(in1)
+
+    if work is None:
+        work = in1 - in2
+    else:
+        np.subtract(in1, in2, out=work)
+
+    out1 = 20*(np.log10(in1_norm/np.sqrt(np.vdot(work.ravel(), work.ravel()))))
 
     return out1
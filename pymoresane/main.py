@@ -1,15 +1,21 @@
 import logging
 import pyfits
 import numpy as np
+import pymoresane.components as components
+import pymoresane.events as events
 import pymoresane.iuwt as iuwt
 import pymoresane.iuwt_convolution as conv
 import pymoresane.iuwt_toolbox as tools
+import pymoresane.memory as memory
+import pymoresane.minor_loop as minor
+import pymoresane.pipeline as pipeline
+import pymoresane.precompute as precompute
+import pymoresane.profiling as profiling
 import pymoresane.parser as pparser
-from pymoresane.beam_fit import beam_fit
 import time
 
-from scipy.signal import fftconvolve
-import pylab as plt
+from scipy import ndimage
+from pymoresane.beam_fit import beam_covariance
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +23,7 @@ class FitsImage:
     """A class for the manipulation of .fits images - in particular for
     implementing deconvolution."""
 
-    def __init__(self, image_name, psf_name, mask_name=None):
+    def __init__(self, image_name, psf_name, mask_name=None, cache_dir=None):
         """
         Opens the original .fits images specified by imagename and psfname and stores their contents in appropriate
         variables for later use. Also initialises variables to store the sizes of the psf and dirty image as these
@@ -28,53 +34,185 @@ class FitsImage:
         image_name  (no default):   Name of the input .fits file containing the dirty map.
         psf_name    (no default):   Name of the input .fits file containing the PSF.
         mask_name   (default=None): Name of the input .fits file containing a deconvolution mask.
+        cache_dir   (default=None): Directory in which PSF precomputations are cached between runs.
         """
 
         self.image_name = image_name
         self.psf_name = psf_name
 
-        self.img_hdu_list = pyfits.open("{}".format(self.image_name))
-        self.psf_hdu_list = pyfits.open("{}".format(self.psf_name))
+        # Only the plane which is deconvolved is read from each file, and each file is closed once its header and plane
+        # have been read. The PSF is cropped to twice the size of the dirty image, as no larger region is used.
 
-        self.img_hdr = self.img_hdu_list[0].header
-        self.psf_hdr = self.psf_hdu_list[0].header
-
-        img_slice = self.handle_input(self.img_hdr)
-        psf_slice = self.handle_input(self.psf_hdr)
-
-        self.dirty_data = (self.img_hdu_list[0].data[img_slice]).astype(np.float32)
-        self.psf_data = (self.psf_hdu_list[0].data[psf_slice]).astype(np.float32)
+        dirty_data, self.img_hdr = read_plane(self.image_name)
+        psf_data, self.psf_hdr = read_plane(self.psf_name, [2*sz for sz in dirty_data.shape])
 
         self.mask_name = mask_name
 
         if self.mask_name is not None:
-            self.mask = pyfits.open("{}".format(mask_name))[0].data
-            self.mask = self.mask.reshape(self.mask.shape[-2], self.mask.shape[-1])
-            self.mask = self.mask/np.max(self.mask)
-            self.mask = fftconvolve(self.mask,np.ones([5,5]),mode="same")
-            self.mask = self.mask/np.max(self.mask)
+            mask = read_plane(self.mask_name)[0]
+        else:
+            mask = None
+
+        self.initialise_data(dirty_data, psf_data, mask, cache_dir)
+
+    @classmethod
+    def from_arrays(cls, dirty_data, psf_data, img_hdr, psf_hdr, mask=None, cache_dir=None, precomputed=None,
+                    name=None):
+        """
+        Alternative constructor which creates a FitsImage from arrays already in memory rather than from .fits
+        files. Used when planes of a cube are deconvolved separately.
+
+        INPUTS:
+        dirty_data  (no default):   Array containing the dirty map.
+        psf_data    (no default):   Array containing the PSF.
+        img_hdr     (no default):   Header of the dirty map.
+        psf_hdr     (no default):   Header of the PSF.
+        mask        (default=None): Array containing a deconvolution mask.
+        cache_dir   (default=None): Directory in which PSF precomputations are cached between runs.
+        precomputed (default=None): PrecomputationCache of the PSF, if one already exists.
+        name        (default=None): Name of the image, which prefixes its log messages.
+
+        OUTPUTS:
+        image                       FitsImage containing the given data.
+        """
+
+        image = cls.__new__(cls)
+
+        image.image_name = None
+        image.psf_name = None
+        image.mask_name = None
+
+        image.img_hdr = img_hdr
+        image.psf_hdr = psf_hdr
+
+        image.initialise_data(dirty_data, psf_data, mask, cache_dir, precomputed, name)
+
+        return image
+
+    def initialise_data(self, dirty_data, psf_data, mask=None, cache_dir=None, precomputed=None, name=None):
+        """
+        Stores the dirty map, PSF and mask and initialises the model, residual and restored images.
+
+        INPUTS:
+        dirty_data  (no default):   Array containing the dirty map.
+        psf_data    (no default):   Array containing the PSF.
+        mask        (default=None): Array containing a deconvolution mask.
+        cache_dir   (default=None): Directory in which PSF precomputations are cached between runs.
+        precomputed (default=None): PrecomputationCache of the PSF, if one already exists.
+        name        (default=None): Name of the image, which prefixes its log messages.
+        """
+
+        # The arrays are only copied if they are not already single precision. They are never modified in place.
+
+        self.dirty_data = np.asarray(dirty_data, dtype=np.float32)
+        self.psf_data = np.asarray(psf_data, dtype=np.float32)
+
+        # The mask is smoothed so that its edges do not cut through sources.
+
+        self.mask = smooth_mask(mask) if mask is not None else None
 
         self.dirty_data_shape = self.dirty_data.shape
         self.psf_data_shape = self.psf_data.shape
 
-        self.img_hdu_list.close()
-        self.psf_hdu_list.close()
-
-        self.complete = False
         self.model = np.zeros_like(self.dirty_data)
         self.residual = np.copy(self.dirty_data)
         self.restored = np.zeros_like(self.dirty_data)
 
+        if precomputed is None:
+            precomputed = precompute.PrecomputationCache(self.psf_data, self.dirty_data_shape, cache_dir,
+                                                         self.psf_name)
+
+        self.precomputed = precomputed
+
+        # Profiling is disabled unless a profiling.Profiler is assigned. Callbacks may be registered with hooks to
+        # follow the progress of a deconvolution.
+
+        self.profiler = profiling.NULL_PROFILER
+        self.hooks = events.EventHooks()
+
+        # The state of the major loop is periodically saved if a checkpoint.Checkpoint is assigned.
+
+        self.checkpoint = None
+
+        # The components of the model, grouped by the scale at which they were added, once a deconvolution has run.
+        # See components.ComponentList.
+
+        self.component_groups = None
+
+        # Each FitsImage logs through its own adapter of the module logger, so that the messages of deconvolutions
+        # which run concurrently in one process can be told apart.
+
+        self.name = name
+        self.logger = ImageLogger(logger, dict(image=name))
+
+        # The restoring beam is fitted to the PSF unless its parameters (BMAJ, BMIN and BPA) are assigned here.
+
+        self.beam_params = None
+
+    def warm_start(self, model, conv_mode="linear"):
+        """
+        Starts the deconvolution from an existing model, e.g. that of an earlier run with different parameters. The
+        residual of the model is computed once here, and the deconvolution then continues from it.
+
+        INPUTS:
+        model       (no default):       Array containing the model.
+        conv_mode   (default='linear'): Specifier for convolution mode - linear or circular.
+        """
+
+        model = np.array(model, dtype=np.float32)
+
+        if model.shape!=self.dirty_data_shape:
+            self.logger.error("The initial model must have the shape of the dirty image - shape is {}."
+                              .format(model.shape))
+            raise ValueError("The initial model must have the shape of the dirty image - shape is {}."
+                             .format(model.shape))
+
+        psf_data_fft = self.precomputed.psf_ffts(self.dirty_data_shape[0], "cpu", conv_mode)[1]
+
+        self.model = model
+        self.residual = self.dirty_data - conv.fft_convolve(model, psf_data_fft, "cpu", conv_mode)
+        self.component_groups = None
+
+    def start_run(self, resume=None):
+        """
+        Creates the RunState of a deconvolution. The deconvolution continues from the current model and residual,
+        which are those of the dirty image unless a previous deconvolution or warm_start has replaced them, or from
+        a checkpoint.
+
+        INPUTS:
+        resume  (default=None): Checkpoint, as returned by checkpoint.load_checkpoint, from which the run continues.
+
+        OUTPUTS:
+        run                     RunState of the deconvolution.
+        """
+
+        if resume is None:
+            return RunState(self.residual, self.model, self.residual, self.component_groups)
+
+        if resume["model"].shape!=self.dirty_data_shape:
+            self.logger.error("The checkpoint does not match the dirty image - shape is {}."
+                              .format(resume["model"].shape))
+            raise ValueError("The checkpoint does not match the dirty image - shape is {}."
+                             .format(resume["model"].shape))
+
+        self.logger.info("Resuming at scale {} after {} major loop iterations.".format(
+                         resume["scale_count"], resume["total_niter"] + resume["major_loop_niter"]))
+
+        return RunState.from_checkpoint(resume)
+
     def moresane(self, subregion=None, scale_count=None, sigma_level=4, loop_gain=0.1, tolerance=0.75, accuracy=1e-6,
                  major_loop_miter=100, minor_loop_miter=30, all_on_gpu=False, decom_mode="ser", core_count=1,
                  conv_device='cpu', conv_mode='linear', extraction_mode='cpu', enforce_positivity=False,
                  edge_suppression=False, edge_offset=0, flux_threshold=0,
-                 neg_comp=False, edge_excl=0, int_excl=0):
+                 neg_comp=False, edge_excl=0, int_excl=0, minor_loop_solver="cg", memory_budget=None, run=None,
+                 resume=None):
         """
         Primary method for wavelet analysis and subsequent deconvolution.
 
         INPUTS:
-        subregion           (default=None):     Size, in pixels, of the central region to be analyzed and deconvolved.
+        subregion           (default=None):     Size, in pixels, of the central region to be analyzed and deconvolved,
+                                                or a window - a pair of slices selecting a square region of even size
+                                                anywhere in the image.
         scale_count         (default=None):     Maximum scale to be considered - maximum scale considered during
                                                 initialisation.
         sigma_level         (default=4)         Number of sigma at which thresholding is to be performed.
@@ -100,6 +238,15 @@ class FitsImage:
                                                 to be ignored. This is added to the minimum suppression.
         flux_threshold      (default=0):        Float value, assumed to be in Jy, which specifies an approximate
                                                 convolution depth.
+        minor_loop_solver   (default='cg'):     Solver used in the minor loop - currently only 'cg'.
+        memory_budget       (default=None):     Memory budget, in bytes or as a string such as "4G". If given, the
+                                                fastest memory plan which is estimated to fit is used, see
+                                                memory.plan_memory. The results then differ slightly if lower
+                                                precision is required.
+        run                 (default=None):     RunState which this call continues, as used by moresane_by_scale. A
+                                                new run is started if not given.
+        resume              (default=None):     Checkpoint, as returned by checkpoint.load_checkpoint, from which a
+                                                new run continues.
 
         OUTPUTS:
         self.model          (no default):       Model extracted by the algorithm.
@@ -111,13 +258,37 @@ class FitsImage:
         # The default value for subregion is the whole image. The default value for scale_count is the log to the
         # base two of the image dimensions minus one.
 
+        logger = self.logger
+
         logger.info("Starting...")
 
+        profiler = self.profiler
+        hooks = self.hooks
+
+        # The state of the deconvolution is held by a RunState rather than by the FitsImage, so that the FitsImage is
+        # not modified until the deconvolution is finished. The scale-by-scale approach passes its own run, and resets
+        # the hooks itself, as it calls this method repeatedly.
+
+        if run is None:
+            run = self.start_run(resume)
+
+        if not run.by_scale:
+            hooks.reset()
+
         if (self.dirty_data_shape[0]%2)==1:
             logger.error("Image size is uneven. Please use even dimensions.")
             raise ValueError("Image size is uneven. Please use even dimensions.")
 
-        if (subregion is None)|(subregion>self.dirty_data_shape[0]):
+        # A window, given as a pair of slices, selects a square subregion anywhere in the image rather than at its
+        # centre. The PSF precomputations only depend on its size.
+
+        if isinstance(subregion, tuple):
+            window = subregion
+            subregion = window[0].stop - window[0].start
+        else:
+            window = None
+
+        if (subregion is None) or (subregion>self.dirty_data_shape[0]):
             subregion = self.dirty_data_shape[0]
             logger.info("Assuming subregion is {}px.".format(self.dirty_data_shape[0]))
 
@@ -130,127 +301,46 @@ class FitsImage:
             conv_device = 'gpu'
             extraction_mode = 'gpu'
 
-        # The following creates arrays with dimensions equal to subregion and containing the values of the dirty
-        # image and psf in their central subregions.
+        # The following creates an array with dimensions equal to subregion and containing the values of the dirty
+        # image in its central subregion, or in the window.
 
-        subregion_slice = tuple([slice(self.dirty_data_shape[0]/2-subregion/2, self.dirty_data_shape[0]/2+subregion/2),
-                                 slice(self.dirty_data_shape[1]/2-subregion/2, self.dirty_data_shape[1]/2+subregion/2)])
+        if window is not None:
+            subregion_slice = window
+        else:
+            subregion_slice = precompute.central_slice(self.dirty_data_shape, subregion)
 
-        dirty_subregion = self.dirty_data[subregion_slice]
+        dirty_subregion = run.dirty_data[subregion_slice]
 
-        if np.all(np.array(self.psf_data_shape)==2*np.array(self.dirty_data_shape)):
-            psf_subregion = self.psf_data[self.psf_data_shape[0]/2-subregion/2:self.psf_data_shape[0]/2+subregion/2,
-                            self.psf_data_shape[1]/2-subregion/2:self.psf_data_shape[1]/2+subregion/2]
+        # Under a memory budget, the precision of the PSF FFTs and minor loop and the storage of the decompositions are
+        # chosen so that the estimated peak memory is within the budget. Otherwise, no savings are made.
+
+        if memory_budget is not None:
+            memory_plan, memory_estimate = memory.plan_memory(memory.parse_size(memory_budget), self.dirty_data_shape,
+                                                              self.psf_data_shape, subregion, scale_count, conv_mode,
+                                                              self.mask is not None)
+            logger.info("Memory plan: {} (estimated peak {}).".format(", ".join(memory_plan.options()) or
+                        "no savings required", memory.format_size(memory_estimate)))
         else:
-            psf_subregion = self.psf_data[subregion_slice]
-
-        # The following pre-loads the gpu with the fft of both the full PSF and the subregion of interest. If usegpu
-        # is false, this simply precomputes the fft of the PSF.
-
-        if conv_device=="gpu":
-            if conv_mode=="circular":
-                if np.all(np.array(self.psf_data_shape)==2*np.array(self.dirty_data_shape)):
-                    psf_subregion_fft = conv.gpu_r2c_fft(psf_subregion, is_gpuarray=False, store_on_gpu=True)
-                    psf_slice = tuple([slice(self.psf_data_shape[0]/2-self.dirty_data_shape[0]/2, self.psf_data_shape[0]/2+self.dirty_data_shape[0]/2),
-                                       slice(self.psf_data_shape[1]/2-self.dirty_data_shape[1]/2, self.psf_data_shape[1]/2+self.dirty_data_shape[1]/2)])
-                    psf_data_fft = self.psf_data[psf_slice]
-                    psf_data_fft = conv.gpu_r2c_fft(psf_data_fft, is_gpuarray=False, store_on_gpu=True)
-                else:
-                    psf_subregion_fft = conv.gpu_r2c_fft(psf_subregion, is_gpuarray=False, store_on_gpu=True)
-                    if psf_subregion.shape==self.psf_data_shape:
-                        psf_data_fft = psf_subregion_fft
-                    else:
-                        psf_data_fft = conv.gpu_r2c_fft(self.psf_data, is_gpuarray=False, store_on_gpu=True)
-
-            if conv_mode=="linear":
-                if np.all(np.array(self.psf_data_shape)==2*np.array(self.dirty_data_shape)):
-                    if np.all(np.array(self.dirty_data_shape)==subregion):
-                        psf_subregion_fft = conv.gpu_r2c_fft(self.psf_data, is_gpuarray=False, store_on_gpu=True)
-                        psf_data_fft = psf_subregion_fft
-                        logger.info("Using double size PSF.")
-                    else:
-                        psf_slice = tuple([slice(self.psf_data_shape[0]/2-subregion, self.psf_data_shape[0]/2+subregion),
-                                           slice(self.psf_data_shape[1]/2-subregion, self.psf_data_shape[1]/2+subregion)])
-                        psf_subregion_fft = self.psf_data[psf_slice]
-                        psf_subregion_fft = conv.gpu_r2c_fft(psf_subregion_fft, is_gpuarray=False, store_on_gpu=True)
-                        psf_data_fft = conv.gpu_r2c_fft(self.psf_data, is_gpuarray=False, store_on_gpu=True)
-                else:
-                    if np.all(np.array(self.dirty_data_shape)==subregion):
-                        psf_subregion_fft = conv.pad_array(self.psf_data)
-                        psf_subregion_fft = conv.gpu_r2c_fft(psf_subregion_fft, is_gpuarray=False, store_on_gpu=True)
-                        psf_data_fft = psf_subregion_fft
-                    else:
-                        psf_slice = tuple([slice(self.psf_data_shape[0]/2-subregion, self.psf_data_shape[0]/2+subregion),
-                                           slice(self.psf_data_shape[1]/2-subregion, self.psf_data_shape[1]/2+subregion)])
-                        psf_subregion_fft = self.psf_data[psf_slice]
-                        psf_subregion_fft = conv.gpu_r2c_fft(psf_subregion_fft, is_gpuarray=False, store_on_gpu=True)
-                        psf_data_fft = conv.pad_array(self.psf_data)
-                        psf_data_fft = conv.gpu_r2c_fft(psf_data_fft, is_gpuarray=False, store_on_gpu=True)
-
-        elif conv_device=="cpu":
-            if conv_mode=="circular":
-                if np.all(np.array(self.psf_data_shape)==2*np.array(self.dirty_data_shape)):
-                    psf_subregion_fft = np.fft.rfft2(psf_subregion)
-                    psf_slice = tuple([slice(self.psf_data_shape[0]/2-self.dirty_data_shape[0]/2, self.psf_data_shape[0]/2+self.dirty_data_shape[0]/2),
-                                       slice(self.psf_data_shape[1]/2-self.dirty_data_shape[1]/2, self.psf_data_shape[1]/2+self.dirty_data_shape[1]/2)])
-                    psf_data_fft = self.psf_data[psf_slice]
-                    psf_data_fft = np.fft.rfft2(psf_data_fft)
-                else:
-                    psf_subregion_fft = np.fft.rfft2(psf_subregion)
-                    if psf_subregion.shape==self.psf_data_shape:
-                        psf_data_fft = psf_subregion_fft
-                    else:
-                        psf_data_fft = np.fft.rfft2(self.psf_data)
-
-            if conv_mode=="linear":
-                if np.all(np.array(self.psf_data_shape)==2*np.array(self.dirty_data_shape)):
-                    if np.all(np.array(self.dirty_data_shape)==subregion):
-                        psf_subregion_fft = np.fft.rfft2(self.psf_data)
-                        psf_data_fft = psf_subregion_fft
-                        logger.info("Using double size PSF.")
-                    else:
-                        psf_slice = tuple([slice(self.psf_data_shape[0]/2-subregion, self.psf_data_shape[0]/2+subregion),
-                                           slice(self.psf_data_shape[1]/2-subregion, self.psf_data_shape[1]/2+subregion)])
-                        psf_subregion_fft = self.psf_data[psf_slice]
-                        psf_subregion_fft = np.fft.rfft2(psf_subregion_fft)
-                        psf_data_fft = np.fft.rfft2(self.psf_data)
-                else:
-                    if np.all(np.array(self.dirty_data_shape)==subregion):
-                        psf_subregion_fft = conv.pad_array(self.psf_data)
-                        psf_subregion_fft = np.fft.rfft2(psf_subregion_fft)
-                        psf_data_fft = psf_subregion_fft
-                    else:
-                        psf_slice = tuple([slice(self.psf_data_shape[0]/2-subregion, self.psf_data_shape[0]/2+subregion),
-                                           slice(self.psf_data_shape[1]/2-subregion, self.psf_data_shape[1]/2+subregion)])
-                        psf_subregion_fft = self.psf_data[psf_slice]
-                        psf_subregion_fft = np.fft.rfft2(psf_subregion_fft)
-                        psf_data_fft = conv.pad_array(self.psf_data)
-                        psf_data_fft = np.fft.rfft2(psf_data_fft)
-
-        # The following is a call to the first of the IUWT (Isotropic Undecimated Wavelet Transform) functions. This
-        # returns the decomposition of the PSF. The norm of each scale is found - these correspond to the energies or
-        # weighting factors which must be applied when locating maxima.
-
-        ### REPLACE SCALECOUNT WITH: int(np.log2(self.dirty_data_shape[0])-1)
-
-        psf_decomposition = iuwt.iuwt_decomposition(psf_subregion, scale_count, mode=decom_mode, core_count=core_count)
-
-        psf_energies = np.empty([psf_decomposition.shape[0],1,1], dtype=np.float32)
-
-        for i in range(psf_energies.shape[0]):
-            psf_energies[i] = np.sqrt(np.sum(np.square(psf_decomposition[i,:,:])))
-
-            # INCORPORATE IF NECESSARY. POSSIBLY AT OUTER LEVEL
-
-            # psf_decomposition = psf_decomposition/psf_energies
-            # print(np.unravel_index(np.argmax(psf_decomposition), psf_decomposition.shape)[0])
+            memory_plan = memory.MemoryPlan()
+
+        # The following fetches the fft of both the full PSF and the subregion of interest. If conv_device is "gpu",
+        # these are pre-loaded onto the gpu. These are computed only once per FitsImage.
+
+        psf_subregion_fft, psf_data_fft = self.precomputed.psf_ffts(subregion, conv_device, conv_mode,
+                                                                    memory_plan.low_precision_ffts)
+
+        # The following fetches the norm of each scale of the IUWT (Isotropic Undecimated Wavelet Transform)
+        # decomposition of the PSF - these correspond to the energies or weighting factors which must be applied when
+        # locating maxima. Only scales which have not been computed by a previous call are computed here.
+
+        psf_energies = self.precomputed.psf_energies(subregion, scale_count, decom_mode, core_count)
 
         ######################################################MAJOR LOOP######################################################
 
         major_loop_niter = 0
         max_coeff = 1
 
-        model = np.zeros_like(self.dirty_data)
+        model = np.zeros_like(run.dirty_data)
 
         std_current = 1000
         std_last = 1
@@ -259,20 +349,19 @@ class FitsImage:
         min_scale = 0   # The current minimum scale of interest. If this ever equals or exceeds the scale_count
         # value, it will also break the following loop.
 
-        # In the case that edge_supression is desired, the following sets up a masking array.
-
-        if edge_suppression:
-            edge_corruption = 0
-            suppression_array = np.zeros([scale_count,subregion,subregion],np.float32)
-            for i in range(scale_count):
-                edge_corruption += 2*2**i
-                if edge_offset>edge_corruption:
-                    suppression_array[i,edge_offset:-edge_offset, edge_offset:-edge_offset] = 1
-                else:
-                    suppression_array[i,edge_corruption:-edge_corruption, edge_corruption:-edge_corruption] = 1
-        elif edge_offset>0:
-            suppression_array = np.zeros([scale_count,subregion,subregion],np.float32)
-            suppression_array[:,edge_offset:-edge_offset, edge_offset:-edge_offset] = 1
+        # A run which resumes from a checkpoint continues the major loop from the state of the checkpoint.
+
+        if run.resume is not None:
+            major_loop_niter, std_current, min_scale = run.resume
+            run.resume = None
+
+        residual = run.residual
+
+        # In the case that edge_supression is desired, the following determines the width of the border which is
+        # suppressed at each scale.
+
+        if edge_suppression|(edge_offset>0):
+            suppression_widths = tools.suppression_widths(scale_count, edge_suppression, edge_offset)
 
         # The following is the major loop. Its exit conditions are reached if if the number of major loop iterations
         # exceeds a user defined value, the maximum wavelet coefficient is zero or the standard deviation of the
@@ -281,6 +370,8 @@ class FitsImage:
         while (((major_loop_niter<major_loop_miter) & (max_coeff>0)) & ((std_ratio>accuracy)
                    & (np.max(dirty_subregion)>flux_threshold))):
 
+            iteration_start_time = time.time()
+
             # The first interior loop allows for the model to be re-estimated at a higher scale in the case of a poor
             # SNR. If, however, a better job cannot be done, the loop will terminate.
 
@@ -288,24 +379,32 @@ class FitsImage:
 
                 # This is the IUWT decomposition of the dirty image subregion up to scale_count, followed by a
                 # thresholding of the resulting wavelet coefficients based on the MAD estimator. This is a denoising
-                # operation.
+                # operation. If the dirty image is unchanged since the last decomposition, as happens between the
+                # runs of the scale-by-scale approach, the previous decomposition is extended rather than rebuilt.
 
                 if min_scale==0:
-                    dirty_decomposition = iuwt.iuwt_decomposition(dirty_subregion, scale_count, 0, decom_mode, core_count)
+                    with profiler.phase("decomposition", dirty_subregion):
+                        dirty_decomposition = run.decomposition("dirty", dirty_subregion, scale_count, decom_mode,
+                                                                core_count, memory_plan.cache_decompositions)
 
-                    thresholds = tools.estimate_threshold(dirty_decomposition, edge_excl, int_excl)
+                    with profiler.phase("thresholding", dirty_decomposition):
+                        thresholds = tools.estimate_threshold(dirty_decomposition, edge_excl, int_excl)
 
-                    if self.mask_name is not None:
-                        dirty_decomposition = iuwt.iuwt_decomposition(dirty_subregion*self.mask[subregion_slice], scale_count, 0,
-                            decom_mode, core_count)
+                    if self.mask is not None:
+                        with profiler.phase("decomposition", dirty_subregion):
+                            masked_dirty_subregion = dirty_subregion*self.mask[subregion_slice]
+                            dirty_decomposition = run.decomposition("masked_dirty", masked_dirty_subregion,
+                                                                    scale_count, decom_mode, core_count,
+                                                                    memory_plan.cache_decompositions)
 
-                    dirty_decomposition_thresh = tools.apply_threshold(dirty_decomposition, thresholds,
-                        sigma_level=sigma_level)
+                    with profiler.phase("thresholding", dirty_decomposition):
+                        dirty_decomposition_thresh = tools.apply_threshold(dirty_decomposition, thresholds,
+                            sigma_level=sigma_level)
 
                     # If edge_supression is desired, the following simply masks out the offending wavelet coefficients.
 
                     if edge_suppression|(edge_offset>0):
-                        dirty_decomposition_thresh *= suppression_array
+                        tools.suppress_edges(dirty_decomposition_thresh, suppression_widths)
 
                     # The following calculates and stores the normalised maximum at each scale.
 
@@ -359,10 +458,11 @@ class FitsImage:
                 # to objects containing a maximum wavelet coefficient within some user-specified tolerance of the
                 # maximum  at that scale.
 
-                extracted_sources, extracted_sources_mask = \
-                    tools.source_extraction(thresh_slice, tolerance,
-                    mode=extraction_mode, store_on_gpu=all_on_gpu,
-                    neg_comp=neg_comp)
+                with profiler.phase("extraction", thresh_slice):
+                    extracted_sources, extracted_sources_mask = \
+                        tools.source_extraction(thresh_slice, tolerance,
+                        mode=extraction_mode, store_on_gpu=all_on_gpu,
+                        neg_comp=neg_comp, dtype=np.float32 if memory_plan.single_precision else None)
 
                 # for blah in range(extracted_sources.shape[0]):
                 #
@@ -373,103 +473,32 @@ class FitsImage:
                 # The wavelet coefficients of the extracted sources are recomposed into a single image,
                 # which should contain only the structures of interest.
 
-                recomposed_sources = iuwt.iuwt_recomposition(extracted_sources, scale_adjust, decom_mode, core_count)
+                with profiler.phase("recomposition", extracted_sources):
+                    recomposed_sources = iuwt.iuwt_recomposition(extracted_sources, scale_adjust, decom_mode,
+                                                                 core_count)
 
                 ######################################################MINOR LOOP######################################################
 
-                x = np.zeros_like(recomposed_sources)
-                r = recomposed_sources.copy()
-                p = recomposed_sources.copy()
-
-                minor_loop_niter = 0
-
-                snr_last = 0
-                snr_current = 0
-
-                # The following is the minor loop of the algorithm. In particular, we make use of the conjugate
-                # gradient descent method to optimise our model. The variables have been named in order to appear
-                # consistent with the algorithm.
-
-                while (minor_loop_niter<minor_loop_miter):
-
-                    Ap = conv.fft_convolve(p, psf_subregion_fft, conv_device, conv_mode, store_on_gpu=all_on_gpu)
-                    Ap = iuwt.iuwt_decomposition(Ap, max_scale, scale_adjust, decom_mode, core_count,
-                                                 store_on_gpu=all_on_gpu)
-                    Ap = extracted_sources_mask*Ap
-                    Ap = iuwt.iuwt_recomposition(Ap, scale_adjust, decom_mode, core_count)
-
-                    alpha_denominator = np.dot(p.reshape(1,-1),Ap.reshape(-1,1))[0,0]
-                    alpha_numerator = np.dot(r.reshape(1,-1),r.reshape(-1,1))[0,0]
-                    alpha = alpha_numerator/alpha_denominator
-
-                    xn = x + alpha*p
+                # The following is the minor loop of the algorithm. The model of the extracted sources is optimised
+                # by the selected solver, which acts on the masked deconvolution operator.
 
-                    # The following enforces the positivity constraint which necessitates some recalculation.
+                minor_loop_operator = minor.MinorLoopOperator(psf_subregion_fft, extracted_sources_mask, max_scale,
+                                                              scale_adjust, decom_mode, core_count, conv_device,
+                                                              conv_mode, store_on_gpu=all_on_gpu, profiler=profiler)
 
-                    if (np.min(xn)<0) & (enforce_positivity):
+                with profiler.phase("minor_loop", recomposed_sources):
+                    x, snr_current, minor_loop_niter, minor_loop_outcome = \
+                        minor.minor_loop(minor_loop_operator, extracted_sources, recomposed_sources, minor_loop_miter,
+                                         enforce_positivity, minor_loop_solver, hooks,
+                                         major_loop_niter + 1, memory_plan.dtype)
 
-                        xn[xn<0] = 0
-                        p = (xn-x)/alpha
+                # The following flow control determines whether or not the model is adequate and if a recalculation
+                # is required.
 
-                        Ap = conv.fft_convolve(p, psf_subregion_fft, conv_device, conv_mode, store_on_gpu=all_on_gpu)
-                        Ap = iuwt.iuwt_decomposition(Ap, max_scale, scale_adjust, decom_mode, core_count,
-                                                     store_on_gpu=all_on_gpu)
-                        Ap = extracted_sources_mask*Ap
-                        Ap = iuwt.iuwt_recomposition(Ap, scale_adjust, decom_mode, core_count)
-
-                    rn = r - alpha*Ap
-
-                    beta_numerator = np.dot(rn.reshape(1,-1), rn.reshape(-1,1))[0,0]
-                    beta_denominator = np.dot(r.reshape(1,-1), r.reshape(-1,1))[0,0]
-                    beta = beta_numerator/beta_denominator
-
-                    p = rn + beta*p
-
-                    model_sources = conv.fft_convolve(xn, psf_subregion_fft, conv_device, conv_mode, store_on_gpu=all_on_gpu)
-                    model_sources = iuwt.iuwt_decomposition(model_sources, max_scale, scale_adjust, decom_mode,
-                                                            core_count, store_on_gpu=all_on_gpu)
-                    model_sources = extracted_sources_mask*model_sources
-
-                    if all_on_gpu:
-                        model_sources = model_sources.get()
-
-                    # We compare our model to the sources extracted from the data.
-
-                    snr_last = snr_current
-                    snr_current = tools.snr_ratio(extracted_sources, model_sources)
-
-                    minor_loop_niter += 1
-
-                    logger.debug("SNR at iteration {0} = {1}".format(minor_loop_niter, snr_current))
-
-                    # The following flow control determines whether or not the model is adequate and if a
-                    # recalculation is required.
-
-                    if (minor_loop_niter==1)&(snr_current>40):
-                        logger.info("SNR too large on first iteration - false detection. "
-                                    "Incrementing the minimum scale.")
-                        min_scale += 1
-                        break
-
-                    if snr_current>40:
-                        logger.info("Model has reached <1% error - exiting minor loop.")
-                        x = xn
-                        min_scale = 0
-                        break
-
-                    if (minor_loop_niter>2)&(snr_current<=snr_last):
-                        if (snr_current>10.5):
-                            logger.info("SNR has decreased - Model has reached ~{}% error - exiting minor loop." \
-                                        .format(int(100/np.power(10,snr_current/20))))
-                            min_scale = 0
-                            break
-                        else:
-                            logger.info("SNR has decreased - SNR too small. Incrementing the minimum scale.")
-                            min_scale += 1
-                            break
-
-                    r = rn
-                    x = xn
+                if minor_loop_outcome=="accept":
+                    min_scale = 0
+                elif minor_loop_outcome=="reject":
+                    min_scale += 1
 
                 logger.info("{} minor loop iterations performed.".format(minor_loop_niter))
 
@@ -497,7 +526,8 @@ class FitsImage:
 
                 model[subregion_slice] += loop_gain*x
 
-                residual = self.dirty_data - conv.fft_convolve(model, psf_data_fft, conv_device, conv_mode)
+                with profiler.phase("residual_update", model):
+                    residual = run.dirty_data - conv.fft_convolve(model, psf_data_fft, conv_device, conv_mode)
 
                 # The following assesses whether or not the residual has improved.
 
@@ -511,7 +541,8 @@ class FitsImage:
                 if std_ratio<0:
                     logger.info("Residual has worsened - reverting changes.")
                     model[subregion_slice] -= loop_gain*x
-                    residual = self.dirty_data - conv.fft_convolve(model, psf_data_fft, conv_device, conv_mode)
+                    with profiler.phase("residual_update", model):
+                        residual = run.dirty_data - conv.fft_convolve(model, psf_data_fft, conv_device, conv_mode)
 
                 # The current residual becomes the dirty image for the subsequent iteration.
 
@@ -520,26 +551,57 @@ class FitsImage:
                 major_loop_niter += 1
                 logger.info("{} major loop iterations performed.".format(major_loop_niter))
 
+                # If a checkpoint is kept, the state of the run is saved once the checkpoint interval has passed.
+
+                if (self.checkpoint is not None) and self.checkpoint.due():
+                    self.checkpoint.save(run.model + model, residual, scale_count, major_loop_niter, run.total_niter,
+                                         std_current, min_scale)
+
+                profiler.record("major", iteration=major_loop_niter, std_current=std_current, std_ratio=std_ratio,
+                                max_scale=max_scale, scale_adjust=scale_adjust, minor_loop_niter=minor_loop_niter,
+                                snr_current=snr_current, subregion=subregion)
+
+                # A callback may request that the deconvolution stops once the current iteration is complete.
+
+                if hooks.emit("major", iteration=major_loop_niter, scale_count=scale_count, std_current=std_current,
+                              std_ratio=std_ratio, snr_current=snr_current, max_scale=max_scale,
+                              scale_adjust=scale_adjust, minor_loop_niter=minor_loop_niter,
+                              iteration_time=time.time() - iteration_start_time):
+                    logger.info("Stopping as requested.")
+                    break
+
             # The following condition will only trigger if MORESANE did no work - this is an exit condition for the
             # by-scale approach.
 
             if (major_loop_niter==0):
                 logger.info("Current MORESANE iteration did no work - finished.")
-                self.complete = True
+                run.complete = True
                 break
 
-        # If MORESANE did work at the current iteration, the following simply updates the values in the class
-        # variables self.model and self.residual.
+        # If MORESANE did work at the current iteration, the following simply updates the model and residual of the
+        # run. A single run then stores them in self.model and self.residual.
 
         if major_loop_niter>0:
-            self.model += model
-            self.residual = residual
+            run.model += model
+            run.residual = residual
+            run.component_groups.append(components.ComponentList.from_model(model, scale_count))
+
+        run.major_loop_niter = major_loop_niter
+
+        if not run.by_scale:
+            self.model = run.model
+            self.residual = run.residual
+            self.component_groups = run.component_groups
+
+            hooks.emit("completion", major_loop_niter=major_loop_niter, std_current=std_current,
+                       stopped=hooks.stop_requested)
 
     def moresane_by_scale(self, start_scale=1, stop_scale=20, subregion=None, sigma_level=4, loop_gain=0.1,
                           tolerance=0.75, accuracy=1e-6, major_loop_miter=100, minor_loop_miter=30, all_on_gpu=False,
                           decom_mode="ser", core_count=1, conv_device='cpu', conv_mode='linear', extraction_mode='cpu',
                           enforce_positivity=False, edge_suppression=False,
-                          edge_offset=0, flux_threshold=0, neg_comp=False, edge_excl=0, int_excl=0):
+                          edge_offset=0, flux_threshold=0, neg_comp=False, edge_excl=0, int_excl=0,
+                          minor_loop_solver="cg", memory_budget=None, resume=None):
         """
         Extension of the MORESANE algorithm. This takes a scale-by-scale approach, attempting to remove all sources
         at the lower scales before moving onto the higher ones. At each step the algorithm may return to previous
@@ -548,7 +610,8 @@ class FitsImage:
         INPUTS:
         start_scale         (default=1)         The first scale which is to be considered.
         stop_scale          (default=20)        The maximum scale which is to be considered. Optional.
-        subregion           (default=None):     Size, in pixels, of the central region to be analyzed and deconvolved.
+        subregion           (default=None):     Size, in pixels, of the central region to be analyzed and deconvolved,
+                                                or a window. See moresane.
         sigma_level         (default=4)         Number of sigma at which thresholding is to be performed.
         loop_gain           (default=0.1):      Loop gain for the deconvolution.
         tolerance           (default=0.75):     Tolerance level for object extraction. Significant objects contain
@@ -570,37 +633,55 @@ class FitsImage:
         edge_suppression    (default=False):    Boolean specifier for whether or not the edges are to be suprressed.
         edge_offset         (default=0):        Numeric value for an additional user-specified number of edge pixels
                                                 to be ignored. This is added to the minimum suppression.
+        minor_loop_solver   (default='cg'):     Solver used in the minor loop - currently only 'cg'.
+        memory_budget       (default=None):     Memory budget, in bytes or as a string such as "4G". See moresane.
+        resume              (default=None):     Checkpoint, as returned by checkpoint.load_checkpoint, from which the
+                                                deconvolution continues. start_scale is then ignored.
 
         OUTPUTS:
         self.model          (no default):       Model extracted by the algorithm.
         self.residual       (no default):       Residual signal after deconvolution.
         """
 
-        # The following preserves the dirty image as it will be changed on every iteration.
+        logger = self.logger
 
-        dirty_data = self.dirty_data
+        # The dirty image of each call of moresane is the residual of the previous one. This is held by the RunState,
+        # so the dirty image of the FitsImage is never replaced.
 
-        scale_count = start_scale
+        run = self.start_run(resume)
+        run.by_scale = True
 
+        scale_count = start_scale if resume is None else resume["scale_count"]
 
-        while not (self.complete):
+        self.hooks.reset()
+
+        while not (run.complete):
 
             logger.info("MORESANE at scale {}".format(scale_count))
 
-            self.moresane(subregion=subregion, scale_count=scale_count, sigma_level=sigma_level, loop_gain=loop_gain,
-                          tolerance=tolerance, accuracy=accuracy, major_loop_miter=major_loop_miter,
+            self.hooks.emit("scale_change", scale_count=scale_count)
+
+            self.moresane(subregion=subregion, scale_count=scale_count, sigma_level=sigma_level,
+                          loop_gain=loop_gain, tolerance=tolerance, accuracy=accuracy,
+                          major_loop_miter=major_loop_miter,
                           minor_loop_miter=minor_loop_miter, all_on_gpu=all_on_gpu, decom_mode=decom_mode,
                           core_count=core_count, conv_device=conv_device, conv_mode=conv_mode,
                           extraction_mode=extraction_mode, enforce_positivity=enforce_positivity,
                           edge_suppression=edge_suppression, edge_offset=edge_offset,
                           flux_threshold=flux_threshold, neg_comp=neg_comp,
-                          edge_excl=edge_excl, int_excl=int_excl)
+                          edge_excl=edge_excl, int_excl=int_excl, minor_loop_solver=minor_loop_solver,
+                          memory_budget=memory_budget, run=run)
+
+            run.dirty_data = run.residual
+
+            run.total_niter += run.major_loop_niter
 
-            self.dirty_data = self.residual
+            if self.hooks.stop_requested:
+                break
 
             scale_count += 1
 
-            if (scale_count>(np.log2(self.dirty_data.shape[0]))-1):
+            if (scale_count>(np.log2(run.dirty_data.shape[0]))-1):
                 logger.info("Maximum scale reached - finished.")
                 break
 
@@ -608,140 +689,552 @@ class FitsImage:
                 logger.info("Maximum scale reached - finished.")
                 break
 
-        # Restores the original dirty image.
+        self.model = run.model
+        self.residual = run.residual
+        self.component_groups = run.component_groups
 
-        self.dirty_data = dirty_data
-        self.complete = False
+        self.hooks.emit("completion", major_loop_niter=run.total_niter, std_current=np.std(self.residual),
+                        stopped=self.hooks.stop_requested)
 
     def restore(self):
         """
-        This method constructs the restoring beam and then adds the convolution to the residual.
+        This method convolves the model with the restoring beam and then adds the residual. The beam is a Gaussian, so
+        it is applied through its parameters by gaussian_convolve rather than constructed, or a stamp of the beam is
+        added at each component of the model if that is cheaper. The convolution is linear if the PSF is twice the
+        size of the dirty image, as in the major loop, and circular otherwise.
         """
-        clean_beam, beam_params = beam_fit(self.psf_data, self.psf_hdu_list[0].header)
+
+        beam_params = self.precomputed.beam_parameters(self.psf_hdr, self.beam_params)
+        covariance = beam_covariance(beam_params, self.psf_hdr)
 
         if np.all(np.array(self.psf_data_shape)==2*np.array(self.dirty_data_shape)):
-            self.restored = np.fft.fftshift(np.fft.irfft2(np.fft.rfft2(conv.pad_array(self.model))*np.fft.rfft2(clean_beam)))
-            self.restored = self.restored[self.dirty_data_shape[0]/2:-self.dirty_data_shape[0]/2,
-                            self.dirty_data_shape[1]/2:-self.dirty_data_shape[1]/2]
+            conv_mode = "linear"
         else:
-            self.restored = np.fft.fftshift(np.fft.irfft2(np.fft.rfft2(self.model)*np.fft.rfft2(clean_beam)))
+            conv_mode = "circular"
+
+        component_count = np.count_nonzero(self.model)
+
+        if components.splat_cost(self.model.shape, component_count, covariance)< \
+                conv.gaussian_convolve_cost(self.model.shape, covariance, conv_mode):
+            self.logger.debug("Restoring {} components individually.".format(component_count))
+            self.restored = components.ComponentList.from_model(self.model).restore(covariance, conv_mode)
+        else:
+            self.restored = conv.gaussian_convolve(self.model, covariance, conv_mode)
+
         self.restored += self.residual
-        self.restored = self.restored.astype(np.float32)
 
-        self.img_hdu_list[0].header.update('BMAJ',beam_params[0])
-        self.img_hdu_list[0].header.update('BMIN',beam_params[1])
-        self.img_hdu_list[0].header.update('BPA',beam_params[2])
+        self.img_hdr.update('BMAJ',beam_params[0])
+        self.img_hdr.update('BMIN',beam_params[1])
+        self.img_hdr.update('BPA',beam_params[2])
+
+    def components(self, by_scale=False):
+        """
+        Returns the model as a list of components. See components.ComponentList.
+
+        INPUTS:
+        by_scale    (default=False):    Boolean specifier for whether the components are grouped by the scale at
+                                        which they were added. This is only possible once FitsImage.moresane or
+                                        FitsImage.moresane_by_scale has produced the model - otherwise the components
+                                        are not grouped.
+
+        OUTPUTS:
+        components                      ComponentList of the model.
+        """
+
+        if by_scale and (self.component_groups is not None):
+            if self.component_groups:
+                grouped = components.ComponentList.concatenate(self.component_groups)
+            else:
+                grouped = components.ComponentList(self.model.shape, [], [], [], [])
+
+            # The groups are only those of the model if it has not since been changed, e.g. by facet mode.
+
+            if np.array_equal(grouped.to_model(), self.model):
+                return grouped
+
+        if by_scale:
+            self.logger.warning("The model is not grouped by scale - its components are listed ungrouped.")
+
+        return components.ComponentList.from_model(self.model)
 
     def handle_input(self, input_hdr):
         """
-        This method tries to ensure that the input data has the correct dimensions.
+        This method tries to ensure that the input data has the correct dimensions. See plane_slice.
 
         INPUTS:
         input_hdr   (no default)    Header from which data shape is to be extracted.
         """
 
-        input_slice = input_hdr['NAXIS']*[0]
+        return plane_slice(input_hdr)
 
-        for i in range(input_hdr['NAXIS']):
-            if input_hdr['CTYPE%d'%(i+1)].startswith("RA"):
-                input_slice[-1] = slice(None)
-            if input_hdr['CTYPE%d'%(i+1)].startswith("DEC"):
-                input_slice[-2] = slice(None)
+    def save_fits(self, data, name, output_format="fits"):
+        """
+        This method simply saves the model components and the residual.
 
-        return input_slice
+        INPUTS:
+        data            (no default)        Data which is to be saved.
+        name            (no default)        File name for new .fits file. Will overwrite.
+        output_format   (default="fits")    Output format - "fits" or "compressed". See pipeline.OutputWriter.
+        """
 
-    def save_fits(self, data, name):
+        writer = pipeline.OutputWriter(output_format)
+        writer.write(name, data, self.img_hdr)
+        writer.close()
+
+    def make_logger(self, level="INFO", log_name="PyMORESANE.log"):
         """
-        This method simply saves the model components and the residual.
+        Convenience function which creates a logger for the module. See make_logger.
+        """
+
+        return make_logger(level, log_name)
+
+
+class RunState(object):
+    """
+    The state of a single deconvolution. FitsImage.moresane and FitsImage.moresane_by_scale keep everything which
+    changes while they run here, and only store the model and residual in the FitsImage once they are finished. A
+    FitsImage is therefore never left half-way through a deconvolution, and FitsImages which share a
+    PrecomputationCache may be deconvolved concurrently.
+    """
+
+    def __init__(self, dirty_data, model, residual, component_groups=None):
+        """
+        INPUTS:
+        dirty_data          (no default):   Array containing the image which is to be deconvolved.
+        model               (no default):   Array containing the model to which the run adds. It is copied.
+        residual            (no default):   Array containing the residual before the run.
+        component_groups    (default=None): Component groups of the model, see FitsImage.component_groups. The
+                                            model is taken to be added at scale zero if these are not given.
+        """
+
+        self.dirty_data = dirty_data
+        self.model = np.copy(model)
+        self.residual = residual
+
+        # The scale-by-scale approach sets by_scale, as it then resets the hooks and stores the results itself.
+
+        self.by_scale = False
+        self.complete = False
+        self.major_loop_niter = 0
+        self.total_niter = 0
+
+        # The major loop state from which the first call of FitsImage.moresane continues, if the run resumes from a
+        # checkpoint.
+
+        self.resume = None
+
+        # The decompositions of the dirty image belong to the run rather than to the PrecomputationCache, as the
+        # cache is only concerned with the PSF and may be shared.
+
+        self.decompositions = {}
+
+        # The components which each call of FitsImage.moresane adds to the model. Unless the groups of the model
+        # from which the run starts are known, its components are taken to be added at scale zero.
+
+        if component_groups is not None:
+            self.component_groups = list(component_groups)
+        elif np.any(self.model):
+            self.component_groups = [components.ComponentList.from_model(self.model, 0)]
+        else:
+            self.component_groups = []
+
+    def decomposition(self, name, in1, scale_count, decom_mode="ser", core_count=1, store=True):
+        """
+        Returns the decomposition of an image up to scale_count. The most recent decomposition stored under name is
+        reused, and extended if necessary, when it is the decomposition of the same image. Otherwise it is replaced.
 
         INPUTS:
-        data    (no default)    Data which is to be saved.
-        name    (no default)    File name for new .fits file. Will overwrite.
+        name            (no default):       Name under which the decomposition is stored, e.g. "dirty".
+        in1             (no default):       Array which is to be decomposed.
+        scale_count     (no default):       Maximum scale to be considered.
+        decom_mode      (default='ser'):    Specifier for decomposition mode - serial, multiprocessing, or gpu.
+        core_count      (default=1):        For multiprocessing, specifies the number of cores.
+        store           (default=True):     Boolean specifier for whether the decomposition is stored. If not, any
+                                            stored decomposition under name is discarded to free its memory.
+
+        OUTPUTS:
+        Array containing the decomposition.
         """
-        data = data.reshape(1, 1, data.shape[0], data.shape[0])
-        new_file = pyfits.PrimaryHDU(data,self.img_hdu_list[0].header)
-        new_file.writeto("{}".format(name), clobber=True)
 
-    def make_logger(self, level="INFO"):
+        if not store:
+            self.decompositions.pop(name, None)
+            return iuwt.iuwt_decomposition(in1, scale_count, 0, decom_mode, core_count)
+
+        if (name not in self.decompositions) or (not self.decompositions[name].matches(in1, decom_mode)):
+            self.decompositions[name] = precompute.IncrementalDecomposition(in1, decom_mode, core_count)
+
+        return self.decompositions[name].decomposition(scale_count)
+
+    @classmethod
+    def from_checkpoint(cls, state):
         """
-        Convenience function which creates a logger for the module.
+        Alternative constructor which creates the RunState of a deconvolution which resumes from a checkpoint.
 
         INPUTS:
-        level   (default="INFO"):   Minimum log level for logged/streamed messages.
+        state   (no default):   Checkpoint, as returned by checkpoint.load_checkpoint.
 
         OUTPUTS:
-        logger                      Logger for the function. NOTE: Must be bound to variable named logger.
+        run                     RunState which continues from the checkpoint.
         """
-        level = getattr(logging, level.upper())
 
-        logger = logging.getLogger(__name__)
-        logger.setLevel(logging.DEBUG)
+        run = cls(state["residual"], state["model"], state["residual"])
+
+        run.total_niter = state["total_niter"]
+        run.resume = (state["major_loop_niter"], state["std_current"], state["min_scale"])
+
+        return run
+
+
+class ImageLogger(logging.LoggerAdapter):
+    """
+    Adapter of a logger which prefixes the messages of a FitsImage with the name of the image, if it has one.
+    """
+
+    def process(self, msg, kwargs):
+        if self.extra["image"] is not None:
+            msg = "[{}] {}".format(self.extra["image"], msg)
+
+        return msg, kwargs
+
+
+def plane_slice(header, crop=None):
+    """
+    Determines the slice which selects the first plane of the data described by a .fits header. RA and DEC are
+    assumed to be the last two axes of the data, as they are the first two axes of the file. If the header does not
+    name them, the last two axes are used.
+
+    INPUTS:
+    header  (no default):   Header of the data.
+    crop    (default=None): Maximum size of the plane along each of the last two axes. Larger planes are cropped to
+                            their central region.
+
+    OUTPUTS:
+    List of the indices and slices which select the plane.
+    """
+
+    naxis = header['NAXIS']
+
+    input_slice = naxis*[0]
+
+    for i in range(naxis):
+        ctype = header.get('CTYPE%d'%(i+1), "")
+        if ctype.startswith("RA"):
+            input_slice[-1] = slice(None)
+        if ctype.startswith("DEC"):
+            input_slice[-2] = slice(None)
+
+    if not any(isinstance(index, slice) for index in input_slice):
+        input_slice[-2:] = [slice(None), slice(None)]
+
+    # The size of the axis NAXISn is that of the nth axis from the end of the data.
+
+    if crop is not None:
+        for axis, width in zip([-2, -1], crop):
+            size = header['NAXIS%d'%(-axis)]
+            if isinstance(input_slice[axis], slice) and (size>width):
+                input_slice[axis] = slice(size//2-width//2, size//2-width//2+width)
+
+    return input_slice
+
+
+def read_plane(name, crop=None):
+    """
+    Reads the header and a single plane of the primary HDU of a .fits file. Only the plane is read from disk - the
+    remaining planes of a cube are never loaded. The file is closed before returning.
+
+    INPUTS:
+    name    (no default):   Name of the .fits file.
+    crop    (default=None): Maximum size of the plane along each axis, see plane_slice.
+
+    OUTPUTS:
+    data                    Array containing the plane.
+    header                  Header of the primary HDU.
+    """
+
+    hdu_list = pyfits.open(name, memmap=True)
+
+    try:
+        header = hdu_list[0].header
+        data = np.asarray(hdu_list[0].section[tuple(plane_slice(header, crop))])
+    finally:
+        hdu_list.close()
+
+    return data, header
+
+
+def smooth_mask(mask):
+    """
+    Normalises a deconvolution mask and smooths it so that its edges do not cut through sources.
+
+    INPUTS:
+    mask    (no default):   Array containing the mask. Only the last two axes are retained.
+
+    OUTPUTS:
+    Array containing the smoothed mask, in single precision.
+    """
+
+    mask = mask.reshape(mask.shape[-2], mask.shape[-1]).astype(np.float32)
+    mask /= np.max(mask)
+
+    # The 5x5 box filter is separable, so it is applied along each axis in turn rather than by an FFT convolution.
+
+    mask = ndimage.uniform_filter(mask, 5, mode="constant")
+    mask /= np.max(mask)
+
+    return mask
+
+
+def make_logger(level="INFO", log_name="PyMORESANE.log"):
+    """
+    Convenience function which creates a logger for the module. Handlers added by a previous call are replaced, so
+    that calling it again in the same process does not repeat every message.
+
+    INPUTS:
+    level       (default="INFO"):           Minimum log level for logged/streamed messages.
+    log_name    (default="PyMORESANE.log"): Name of the log file, which is overwritten. No log file is written if
+                                            log_name is None or empty.
+
+    OUTPUTS:
+    logger                                  Logger for the function. NOTE: Must be bound to variable named logger.
+    """
+    level = getattr(logging, level.upper())
 
-        fh = logging.FileHandler('PyMORESANE.log', mode='w')
-        fh.setLevel(level)
+    # The handlers are attached to the package logger so that messages from all the pymoresane modules are
+    # handled.
 
-        ch = logging.StreamHandler()
-        ch.setLevel(level)
+    logger = logging.getLogger(__name__.split(".")[0])
+    logger.setLevel(logging.DEBUG)
 
-        formatter = logging.Formatter('%(asctime)s [%(levelname)s]: %(''message)s', datefmt='[%m/%d/%Y] [%I:%M:%S]')
-        fh.setFormatter(formatter)
-        ch.setFormatter(formatter)
+    for handler in [handler for handler in logger.handlers if getattr(handler, "pymoresane", False)]:
+        logger.removeHandler(handler)
+        handler.close()
 
-        logger.addHandler(fh)
-        logger.addHandler(ch)
+    formatter = logging.Formatter('%(asctime)s [%(levelname)s]: %(''message)s', datefmt='[%m/%d/%Y] [%I:%M:%S]')
 
-        return logger
+    handlers = [logging.StreamHandler()]
 
+    if log_name:
+        handlers.insert(0, logging.FileHandler(log_name, mode='w'))
 
-def main():
-    
-    args = pparser.handle_parser()
+    for handler in handlers:
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+        handler.pymoresane = True
+        logger.addHandler(handler)
+
+    return logger
+
+
+def deconvolution_parameters(args):
+    """
+    Collects the deconvolution parameters from the parsed command line arguments.
+
+    INPUTS:
+    args    (no default):   Parsed arguments, as returned by handle_parser.
+
+    OUTPUTS:
+    params                  Dictionary of keyword arguments for FitsImage.moresane if args.singlerun is set, otherwise
+                            for FitsImage.moresane_by_scale.
+    """
+
+    params = dict(subregion=args.subregion, sigma_level=args.sigmalevel, loop_gain=args.loopgain,
+                  tolerance=args.tolerance, accuracy=args.accuracy, major_loop_miter=args.majorloopmiter,
+                  minor_loop_miter=args.minorloopmiter, all_on_gpu=args.allongpu, decom_mode=args.decommode,
+                  core_count=args.corecount, conv_device=args.convdevice, conv_mode=args.convmode,
+                  extraction_mode=args.extractionmode, enforce_positivity=args.enforcepositivity,
+                  edge_suppression=args.edgesuppression, edge_offset=args.edgeoffset,
+                  flux_threshold=args.fluxthreshold, neg_comp=args.negcomp, edge_excl=args.edgeexcl,
+                  int_excl=args.intexcl, minor_loop_solver=args.minorloopsolver, memory_budget=args.memorybudget)
+
+    if args.singlerun:
+        params["scale_count"] = args.scalecount
+    else:
+        params["start_scale"] = args.startscale
+        params["stop_scale"] = args.stopscale
+
+    return params
+
+
+def run_parameters(args):
+    """
+    Collects the options of a run other than the deconvolution parameters - the initial model, the checkpoint and
+    the regions of interest - from the parsed command line arguments.
+
+    INPUTS:
+    args    (no default):   Parsed arguments, as returned by handle_parser.
+
+    OUTPUTS:
+    params                  Dictionary of keyword arguments for api.Deconvolution.run.
+    """
+
+    # An initial model in a .npz file is a component list, see components.ComponentList.
+
+    if args.initialmodel is None:
+        initial_model = None
+    elif args.initialmodel.lower().endswith(".npz"):
+        initial_model = components.ComponentList.load(args.initialmodel)
+    else:
+        initial_model = read_plane(args.initialmodel)[0]
+
+    return dict(initial_model=initial_model, checkpoint=args.checkpoint, checkpoint_interval=args.checkpointinterval,
+                resume=args.resume, regions=args.regions, region_fraction=args.regionfraction)
+
+
+def save_parameters(args):
+    """
+    Collects the options which determine how the model is written - as an image, a component list or both - from the
+    parsed command line arguments.
+
+    INPUTS:
+    args    (no default):   Parsed arguments, as returned by handle_parser.
+
+    OUTPUTS:
+    params                  Dictionary of keyword arguments for api.Deconvolution.save.
+    """
+
+    return dict(component_name=args.componentlist, component_scales=args.componentscales,
+                model_image=not args.nomodelimage)
+
+
+def output_names(args):
+    """
+    Determines the names of the model, residual and restored .fits files from the parsed command line arguments.
+
+    INPUTS:
+    args    (no default):   Parsed arguments, as returned by handle_parser.
+
+    OUTPUTS:
+    Tuple of the model, residual and restored file names.
+    """
 
     if (args.outputname is None):
         if (args.residualname is None)|(args.restoredname is None)|(args.modelname is None):
             raise ValueError("If outputname is unspecified, residualname, restoredname and modelname must be present.")
 
-    data = FitsImage(args.dirty, args.psf, args.mask)
+    model_name = args.modelname if args.modelname is not None else args.outputname+"_model.fits"
+    residual_name = args.residualname if args.residualname is not None else args.outputname+"_residual.fits"
+    restored_name = args.restoredname if args.restoredname is not None else args.outputname+"_restored.fits"
+
+    return model_name, residual_name, restored_name
+
+
+def main(args=None):
+    """
+    Entry point of runsane.
+
+    INPUTS:
+    args    (default=None): Parsed arguments, as returned by parser.handle_parser. Parsed here if not given.
+    """
+
+    if args is None:
+        args = pparser.handle_parser()
+
+    # As a daemon, runsane runs the jobs it receives rather than the one given on the command line. The server module
+    # is imported here as it makes use of FitsImage.
+
+    if args.serve is not None:
+        make_logger(args.loglevel, args.logfile)
 
-    logger = data.make_logger(args.loglevel)
+        from pymoresane.server import serve
+
+        serve(args)
+        return
+
+    model_name, residual_name, restored_name = output_names(args)
+
+    params = deconvolution_parameters(args)
+
+    # The multi-extension format writes all the images to a single file named after the output.
+
+    if args.outputformat=="mef":
+        if args.outputname is None:
+            raise ValueError("The mef output format requires outputname.")
+        mef_name = args.outputname + ".fits"
+    else:
+        mef_name = None
+
+    logger = make_logger(args.loglevel, args.logfile)
     logger.info("Parameters:\n" + str(args)[10:-1])
 
-    start_time = time.time()
+    # With a coordinator, the planes or facets are deconvolved by remote workers (see worker_main).
 
-    if args.singlerun:
-        data.moresane(args.subregion, args.scalecount, args.sigmalevel, args.loopgain, args.tolerance, args.accuracy,
-                      args.majorloopmiter, args.minorloopmiter, args.allongpu, args.decommode, args.corecount,
-                      args.convdevice, args.convmode, args.extractionmode, args.enforcepositivity,
-                      args.edgesuppression, args.edgeoffset,
-                      args.fluxthreshold, args.negcomp, args.edgeexcl,
-                      args.intexcl)
+    if args.coordinator is not None:
+        if not (args.cube or (args.facetsize is not None)):
+            raise ValueError("A coordinator requires either cube mode or facet mode.")
+
+        import pymoresane.distributed as distributed
+
+        coordinator = distributed.Coordinator(distributed.parse_address(args.coordinator), args.authkey)
     else:
-        data.moresane_by_scale(args.startscale, args.stopscale, args.subregion, args.sigmalevel, args.loopgain,
-                               args.tolerance, args.accuracy, args.majorloopmiter, args.minorloopmiter, args.allongpu,
-                               args.decommode,  args.corecount, args.convdevice, args.convmode, args.extractionmode,
-                               args.enforcepositivity, args.edgesuppression,
-                               args.edgeoffset, args.fluxthreshold,
-                               args.negcomp, args.edgeexcl, args.intexcl)
+        coordinator = None
+
+    try:
+        # Cube mode is handled separately as it runs the deconvolution in a pool of processes. It is imported here as
+        # the cube module itself makes use of FitsImage.
+
+        if args.cube:
+            from pymoresane.cube import deconvolve_cube
+
+            if (args.profile is not None) | (args.events is not None):
+                logger.warning("Profiling and progress events are unavailable in cube mode.")
+            if args.outputformat!="fits":
+                logger.warning("Cube mode always writes uncompressed .fits cubes.")
+            if (args.checkpoint is not None) | (args.initialmodel is not None):
+                raise ValueError("Checkpoints and initial models are unavailable in cube mode.")
+            if args.componentlist is not None:
+                raise ValueError("Component lists are unavailable in cube mode.")
+            if args.regions:
+                raise ValueError("Regions of interest are unavailable in cube mode.")
+
+            deconvolve_cube(args.dirty, args.psf, model_name, residual_name, restored_name, params, args.singlerun,
+                            args.mask, args.psfcache, args.cubeworkers, coordinator=coordinator)
+            return
+
+        # The command line is a thin wrapper around the in-memory interface of the api module, which is imported here
+        # as it makes use of FitsImage.
+
+        from pymoresane.api import Deconvolution
+
+        deconvolution = Deconvolution.from_fits(args.dirty, args.psf, args.mask, args.psfcache)
+        data = deconvolution.image
+
+        # Under a memory budget, the peak memory of each phase is measured and reported, which requires a profiler.
+
+        profile = (args.profile is not None) | (args.memorybudget is not None)
+
+        if profile | (args.events is not None):
+            if args.facetsize is not None:
+                logger.warning("Profiling, memory reports and progress events are unavailable in facet mode.")
+            else:
+                if profile:
+                    data.profiler = profiling.Profiler(sample_rss=args.memorybudget is not None)
+                if args.events is not None:
+                    event_stream = events.EventStream(args.events)
+                    data.hooks.add(event_stream)
+
+        start_time = time.time()
+
+        deconvolution.run(args.singlerun, args.facetsize, args.facetoverlap, args.facetworkers, args.facetmajorcycles,
+                          coordinator, **dict(run_parameters(args), **params))
+
+    finally:
+        if coordinator is not None:
+            coordinator.close()
 
     end_time = time.time()
     logger.info("Elapsed time was %s." % (time.strftime('%H:%M:%S', time.gmtime(end_time - start_time))))
 
-    if args.modelname is None:
-        data.save_fits(data.model, args.outputname+"_model.fits")
-    else:
-        data.save_fits(data.model, args.modelname)
+    deconvolution.save(model_name, residual_name, restored_name, args.outputformat, mef_name, **save_parameters(args))
 
-    if args.residualname is None:
-        data.save_fits(data.residual, args.outputname+"_residual.fits")
-    else:
-        data.save_fits(data.residual, args.residualname)
+    if data.profiler.enabled:
+        if args.memorybudget is not None:
+            logger.info("Peak memory by phase:\n" + memory.memory_report(data.profiler.summary()))
+        if args.profile is not None:
+            data.profiler.save(args.profile)
+        data.profiler.close()
 
-    data.restore()
-
-    if args.restoredname is None:
-        data.save_fits(data.restored, args.outputname+"_restored.fits")
-    else:
-        data.save_fits(data.restored, args.restoredname)
+    if (args.events is not None) & (args.facetsize is None):
+        event_stream.close()
 
     # test.moresane(scale_count = 9, major_loop_miter=100, minor_loop_miter=30, tolerance=0.8, \
     #                 conv_mode="linear", accuracy=1e-6, loop_gain=0.2, enforce_positivity=True, sigma_level=5,
@@ -751,3 +1244,21 @@ def main():
     #                 all_on_gpu=True, edge_suppression=True)
     # test.moresane_by_scale(subregion=512, major_loop_miter=100, minor_loop_miter=30, tolerance=0.7,
     #                 conv_mode="circular", accuracy=1e-6, loop_gain=0.2, enforce_positivity=True, sigma_level=4)
+
+
+def worker_main(args=None):
+    """
+    Entry point of runsane-worker, which deconvolves the planes or facets distributed by a coordinator.
+
+    INPUTS:
+    args    (default=None): Parsed arguments, as returned by parser.handle_worker_parser. Parsed here if not given.
+    """
+
+    import pymoresane.distributed as distributed
+
+    if args is None:
+        args = pparser.handle_worker_parser()
+
+    make_logger(args.loglevel)
+
+    distributed.run_worker(distributed.parse_address(args.coordinator), args.authkey, args.workerid)
@@ -0,0 +1,352 @@
+import logging
+import os
+import re
+import resource
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_size(size):
+    """
+    Converts a memory size such as "512M" or "4G" to bytes. Units are binary and a trailing B is optional.
+
+    INPUTS:
+    size    (no default):   Size as a string, or a number of bytes.
+
+    OUTPUTS:
+    Number of bytes.
+    """
+
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    match = re.match(r"^\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)I?B?\s*$", size.upper())
+
+    if match is None:
+        raise ValueError("Unable to interpret memory size {}. Use e.g. 512M or 4G.".format(size))
+
+    return int(float(match.group(1))*_SIZE_UNITS[match.group(2)])
+
+
+def format_size(nbytes):
+    """
+    Converts a number of bytes to a readable string, e.g. "1.5G".
+    """
+
+    for unit in ["T", "G", "M", "K"]:
+        if abs(nbytes)>=_SIZE_UNITS[unit]:
+            return "{:.1f}{}".format(float(nbytes)/_SIZE_UNITS[unit], unit)
+
+    return "{}B".format(int(nbytes))
+
+
+def current_rss():
+    """
+    Returns the resident set size of this process in bytes. The current value is read from /proc where available,
+    otherwise the peak resident set size reported by getrusage is returned instead.
+    """
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1])*resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process in bytes, as reported by getrusage.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, whereas macOS reports bytes.
+
+    if os.uname()[0]=="Darwin":
+        return int(peak)
+
+    return int(peak)*1024
+
+
+class RSSSampler(object):
+    """
+    Samples the resident set size of the process in a background thread. The sampled values are attributed to every
+    phase which is active at the time, so that the peak resident set size of each phase is known. Unlike tracemalloc,
+    this includes memory allocated outside Python, e.g. by FFTW or the gpu driver, but short-lived peaks between two
+    samples are missed.
+    """
+
+    def __init__(self, interval=0.01):
+        """
+        INPUTS:
+        interval    (default=0.01): Time, in seconds, between samples.
+        """
+
+        self.interval = interval
+        self.active = []
+        self.peaks = {}
+        self.peak = current_rss()
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """
+        Takes a sample and updates the peaks of the active phases.
+        """
+
+        rss = current_rss()
+
+        with self._lock:
+            self.peak = max(self.peak, rss)
+
+            for name in self.active:
+                self.peaks[name] = max(self.peaks.get(name, 0), rss)
+
+    def enter(self, name):
+        """
+        Marks a phase as active. A sample is taken on entry and exit so that short phases are still measured.
+        """
+
+        with self._lock:
+            self.active.append(name)
+
+        self.sample()
+
+    def exit(self, name):
+        """
+        Marks a phase as no longer active.
+        """
+
+        self.sample()
+
+        with self._lock:
+            self.active.remove(name)
+
+    def close(self):
+        """
+        Stops the sampling thread.
+        """
+
+        self._stop.set()
+        self._thread.join()
+
+
+class MemoryPlan(object):
+    """
+    The memory saving options of a deconvolution, as chosen by plan_memory.
+
+    low_precision_ffts      The PSF FFTs are stored as complex64 rather than complex128.
+    cache_decompositions    The decompositions of the dirty image are kept between iterations and runs of the
+                            scale-by-scale approach. When False, they are recomputed instead.
+    single_precision        The extracted sources and the vectors of the minor loop are float32 rather than float64.
+    """
+
+    def __init__(self, low_precision_ffts=False, cache_decompositions=True, single_precision=False):
+        self.low_precision_ffts = low_precision_ffts
+        self.cache_decompositions = cache_decompositions
+        self.single_precision = single_precision
+
+    def options(self):
+        """
+        Returns the names of the memory saving options which are enabled.
+        """
+
+        options = []
+
+        if self.low_precision_ffts:
+            options.append("low precision PSF FFTs")
+        if not self.cache_decompositions:
+            options.append("no decomposition cache")
+        if self.single_precision:
+            options.append("single precision minor loop")
+
+        return options
+
+    @property
+    def dtype(self):
+        """
+        The type of the extracted sources and minor loop vectors.
+        """
+
+        return np.float32 if self.single_precision else np.float64
+
+
+# The plans which are tried in turn, from the fastest and most accurate to the most frugal.
+
+PLANS = [MemoryPlan(),
+         MemoryPlan(low_precision_ffts=True),
+         MemoryPlan(low_precision_ffts=True, cache_decompositions=False),
+         MemoryPlan(low_precision_ffts=True, cache_decompositions=False, single_precision=True)]
+
+
+def estimate_memory(image_shape, psf_shape, subregion, scale_count, conv_mode="linear", masked=False, plan=None):
+    """
+    Estimates the peak memory required by FitsImage.moresane. The estimate counts the large arrays which are alive at
+    the same time - the images, the PSF FFTs, the stored decompositions, the extracted sources and the minor loop
+    vectors - together with the temporaries of a convolution of the full image. It is an estimate of the arrays held
+    by the deconvolution only and does not include the interpreter or the loaded libraries.
+
+    INPUTS:
+    image_shape     (no default):       Shape of the dirty image.
+    psf_shape       (no default):       Shape of the PSF.
+    subregion       (no default):       Size, in pixels, of the central region to be deconvolved.
+    scale_count     (no default):       Maximum scale to be considered.
+    conv_mode       (default='linear'): Specifier for convolution mode - linear or circular.
+    masked          (default=False):    Boolean specifier for whether a deconvolution mask is used.
+    plan            (default=None):     MemoryPlan for which the estimate is made. Defaults to no savings.
+
+    OUTPUTS:
+    Estimated number of bytes.
+    """
+
+    if plan is None:
+        plan = MemoryPlan()
+
+    image_size = int(np.prod(image_shape))
+    subregion_size = subregion**2
+    scale_size = scale_count*subregion_size
+
+    float_bytes = np.dtype(plan.dtype).itemsize
+    fft_bytes = 8 if plan.low_precision_ffts else 16
+
+    # The dirty image, model, residual and restored image of the FitsImage, the model and residual of moresane and
+    # the PSF, together with the smoothed mask.
+
+    total = 6*4*image_size + 4*int(np.prod(psf_shape))
+
+    if masked:
+        total += 4*image_size
+
+    # The PSF FFTs of the subregion and of the full image, which are the same when the subregion is the full image.
+    # Linear convolution transforms arrays of twice the size.
+
+    def fft_size(side):
+        if conv_mode=="linear":
+            return 2*side*(side + 1)
+        else:
+            return side*(side//2 + 1)
+
+    total += fft_bytes*fft_size(subregion)
+
+    if subregion!=image_shape[0]:
+        total += fft_bytes*fft_size(image_shape[0])
+
+    # The convolution of the full image holds its transform, the product and the real result in double precision.
+
+    total += 2*16*fft_size(image_shape[0]) + 8*2*fft_size(image_shape[0])
+
+    # The stored decompositions hold the detail coefficients, a copy of the image and the smoothed coefficients.
+
+    if plan.cache_decompositions:
+        total += (2 if masked else 1)*(8*scale_size + 12*subregion_size)
+
+    # The thresholded decomposition, the support of the extracted sources and their coefficients. The labels of a
+    # single scale are held during the extraction.
+
+    total += 8*scale_size + scale_size + float_bytes*scale_size + 4*subregion_size
+
+    # The minor loop keeps the response of the current and next model and a work array, together with the vectors of
+    # the conjugate gradient method. Each iteration adds the decomposition of a response and its masked copy.
+
+    total += 3*float_bytes*scale_size + 6*float_bytes*subregion_size
+    total += 2*8*scale_size
+
+    return int(total)
+
+
+def plan_memory(budget, image_shape, psf_shape, subregion, scale_count, conv_mode="linear", masked=False):
+    """
+    Chooses the fastest MemoryPlan whose estimated peak memory is within the budget. If no plan is within the budget,
+    the most frugal plan is returned with a warning.
+
+    INPUTS:
+    budget          (no default):       Memory budget in bytes.
+    image_shape     (no default):       Shape of the dirty image.
+    psf_shape       (no default):       Shape of the PSF.
+    subregion       (no default):       Size, in pixels, of the central region to be deconvolved.
+    scale_count     (no default):       Maximum scale to be considered.
+    conv_mode       (default='linear'): Specifier for convolution mode - linear or circular.
+    masked          (default=False):    Boolean specifier for whether a deconvolution mask is used.
+
+    OUTPUTS:
+    plan                                The chosen MemoryPlan.
+    estimate                            The estimated peak memory of the plan in bytes.
+    """
+
+    for plan in PLANS:
+        estimate = estimate_memory(image_shape, psf_shape, subregion, scale_count, conv_mode, masked, plan)
+
+        if estimate<=budget:
+            break
+    else:
+        logger.warning("Memory budget of {} cannot be met - the smallest estimate is {}."
+                       .format(format_size(budget), format_size(estimate)))
+
+    logger.debug("Memory plan for {} scales: {} (estimated {} of {}).".format(scale_count,
+                 ", ".join(plan.options()) or "no savings", format_size(estimate), format_size(budget)))
+
+    return plan, estimate
+
+
+def divide_budget(budget, worker_count, worker_estimate):
+    """
+    Divides a memory budget between worker processes. If each worker would receive less than worker_estimate, fewer
+    workers are used, but never fewer than one.
+
+    INPUTS:
+    budget          (no default):   Memory budget in bytes, or a string such as "4G".
+    worker_count    (no default):   Number of workers requested.
+    worker_estimate (no default):   Estimated peak memory of a worker in bytes.
+
+    OUTPUTS:
+    worker_count                    Number of workers which are to be used.
+    worker_budget                   Memory budget of each worker in bytes.
+    """
+
+    budget = parse_size(budget)
+
+    max_workers = max(int(budget//max(worker_estimate, 1)), 1)
+
+    if worker_count>max_workers:
+        logger.info("Reducing the number of workers from {} to {} to fit the memory budget of {}."
+                    .format(worker_count, max_workers, format_size(budget)))
+        worker_count = max_workers
+
+    return worker_count, budget//worker_count
+
+
+def memory_report(summary):
+    """
+    Formats the per-phase peak memory of a profiling.Profiler summary as a table for the log.
+
+    INPUTS:
+    summary     (no default):   Dictionary returned by Profiler.summary.
+
+    OUTPUTS:
+    String containing the table.
+    """
+
+    lines = ["{:<20}{:>8}{:>14}{:>14}".format("Phase", "Calls", "Peak alloc", "Peak RSS")]
+
+    for name, stats in sorted(summary["phases"].items()):
+        peak_rss = stats.get("peak_rss_bytes")
+        lines.append("{:<20}{:>8}{:>14}{:>14}".format(name, stats["calls"],
+                     format_size(stats["peak_bytes"]) if summary["trace_memory"] else "-",
+                     format_size(peak_rss) if peak_rss is not None else "-"))
+
+    if summary.get("peak_rss_bytes") is not None:
+        lines.append("Peak RSS of the run: {}".format(format_size(summary["peak_rss_bytes"])))
+
+    return "\n".join(lines)
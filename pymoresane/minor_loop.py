@@ -0,0 +1,312 @@
+import logging
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+
+import pymoresane.iuwt as iuwt
+import pymoresane.iuwt_convolution as conv
+import pymoresane.iuwt_toolbox as tools
+import pymoresane.profiling as profiling
+
+logger = logging.getLogger(__name__)
+
+
+class MinorLoopOperator(LinearOperator):
+    """
+    The masked deconvolution operator R M W H of the minor loop, where H is the convolution with the PSF, W the IUWT
+    decomposition, M the mask of the extracted sources and R the IUWT recomposition. Vectors are flattened images.
+    """
+
+    def __init__(self, psf_fft, extracted_sources_mask, max_scale, scale_adjust, decom_mode="ser", core_count=1,
+                 conv_device="cpu", conv_mode="linear", store_on_gpu=False, profiler=None):
+        """
+        Stores the quantities which define the operator.
+
+        INPUTS:
+        psf_fft                 (no default):       FFT of the PSF, as passed to conv.fft_convolve.
+        extracted_sources_mask  (no default):       Mask of the significant structures.
+        max_scale               (no default):       Maximum scale of the decomposition.
+        scale_adjust            (no default):       Number of omitted scales.
+        decom_mode              (default='ser'):    Specifier for decomposition mode - serial, multiprocessing, or gpu.
+        core_count              (default=1):        For multiprocessing, specifies the number of cores.
+        conv_device             (default='cpu'):    Specifier for device to be used - cpu or gpu.
+        conv_mode               (default='linear'): Specifier for convolution mode - linear or circular.
+        store_on_gpu            (default=False):    Boolean specifier for whether responses are left on the gpu.
+        profiler                (default=None):     profiling.Profiler to which the operator reports, if any.
+        """
+
+        self.psf_fft = psf_fft
+        self.extracted_sources_mask = extracted_sources_mask
+        self.max_scale = max_scale
+        self.scale_adjust = scale_adjust
+        self.decom_mode = decom_mode
+        self.core_count = core_count
+        self.conv_device = conv_device
+        self.conv_mode = conv_mode
+        self.store_on_gpu = store_on_gpu
+        self.profiler = profiler if profiler is not None else profiling.NULL_PROFILER
+
+        self.image_shape = tuple(extracted_sources_mask.shape[1:])
+
+        super(MinorLoopOperator, self).__init__(np.float64, 2*(int(np.prod(self.image_shape)),))
+
+    def response(self, in1):
+        """
+        Returns the unmasked response W H in1 of an image. As the operator is linear, responses may be combined
+        linearly in place of recomputation.
+        """
+
+        with self.profiler.phase("convolution", in1):
+            out1 = conv.fft_convolve(in1, self.psf_fft, self.conv_device, self.conv_mode,
+                                     store_on_gpu=self.store_on_gpu)
+
+        with self.profiler.phase("decomposition", in1):
+            out1 = iuwt.iuwt_decomposition(out1, self.max_scale, self.scale_adjust, self.decom_mode, self.core_count,
+                                           store_on_gpu=self.store_on_gpu)
+
+        return out1
+
+    def recompose(self, in1):
+        """
+        Returns the masked recomposition R M in1 of a response.
+        """
+
+        with self.profiler.phase("recomposition", in1):
+            return iuwt.iuwt_recomposition(self.extracted_sources_mask*in1, self.scale_adjust, self.decom_mode,
+                                           self.core_count)
+
+    def _matvec(self, x):
+        return np.asarray(self.recompose(self.response(x.reshape(self.image_shape)))).ravel()
+
+    def _rmatvec(self, x):
+
+        # The adjoint is only implemented on the CPU. In the event that the PSF FFT is on the gpu, it is fetched.
+
+        psf_fft = self.psf_fft.get() if hasattr(self.psf_fft, "get") else self.psf_fft
+
+        out1 = iuwt.ser_iuwt_recomposition_adjoint(x.reshape(self.image_shape), self.max_scale, self.scale_adjust)
+        out1 = iuwt.ser_iuwt_decomposition_adjoint(self.extracted_sources_mask*out1, self.scale_adjust)
+        out1 = conv.fft_convolve_adjoint(out1, psf_fft, self.conv_mode)
+
+        return out1.ravel()
+
+
+def snr_outcome(snr_current, snr_last, minor_loop_niter):
+    """
+    Applies the SNR-based stopping rule of the minor loop.
+
+    INPUTS:
+    snr_current         (no default):   SNR of the current model.
+    snr_last            (no default):   SNR of the model at the previous iteration.
+    minor_loop_niter    (no default):   Number of minor loop iterations performed, including the current one.
+
+    OUTPUTS:
+    outcome                             None if the loop is to continue, "accept" if the current model is to be
+                                        kept, "revert" if the previous model is to be kept and "reject" if the
+                                        minimum scale is to be incremented.
+    """
+
+    if (minor_loop_niter==1)&(snr_current>40):
+        logger.info("SNR too large on first iteration - false detection. Incrementing the minimum scale.")
+        return "reject"
+
+    if snr_current>40:
+        logger.info("Model has reached <1% error - exiting minor loop.")
+        return "accept"
+
+    if (minor_loop_niter>2)&(snr_current<=snr_last):
+        if (snr_current>10.5):
+            logger.info("SNR has decreased - Model has reached ~{}% error - exiting minor loop."
+                        .format(int(100/np.power(10,snr_current/20))))
+            return "revert"
+        else:
+            logger.info("SNR has decreased - SNR too small. Incrementing the minimum scale.")
+            return "reject"
+
+    return None
+
+
+def minor_loop(operator, extracted_sources, recomposed_sources, minor_loop_miter=30, enforce_positivity=False,
+               solver="cg", hooks=None, major_iteration=None, dtype=np.float64):
+    """
+    Handler for the solvers of the minor loop. Every solver must apply the SNR-based stopping rule, see snr_outcome.
+
+    INPUTS:
+    operator            (no default):       MinorLoopOperator of the current iteration.
+    extracted_sources   (no default):       The wavelet coefficients of the extracted sources.
+    recomposed_sources  (no default):       The recomposition of the extracted sources.
+    minor_loop_miter    (default=30):       Maximum number of iterations allowed in the minor loop.
+    enforce_positivity  (default=False):    Boolean specifier for whether or not a model must be strictly positive.
+    solver              (default='cg'):     Solver to be used - currently only 'cg'.
+    hooks               (default=None):     events.EventHooks to which minor events are emitted. If a callback
+                                            requests a stop, the current model is accepted.
+    major_iteration     (default=None):     Number of the major iteration, reported with the minor events.
+    dtype               (default=float64):  Type of the vectors of the 'cg' solver. float32 halves their
+                                            memory at the cost of precision.
+
+    OUTPUTS:
+    x                                       The model of the extracted sources.
+    snr_current                             The SNR of the model.
+    minor_loop_niter                        The number of minor loop iterations performed.
+    outcome                                 "accept" if the model is to be used, "reject" if the minimum scale is to
+                                            be incremented and None if the iteration limit was reached.
+    """
+
+    if solver=="cg":
+        return cg_minor_loop(operator, extracted_sources, recomposed_sources, minor_loop_miter, enforce_positivity,
+                             hooks, major_iteration, dtype)
+    else:
+        raise ValueError("Unknown minor loop solver {}.".format(solver))
+
+
+class MinorLoopState(object):
+    """
+    Preallocated vectors of the conjugate gradient minor loop. All updates are performed in place and the current and
+    next iterates are swapped rather than copied, so that the vector updates do not allocate.
+    """
+
+    def __init__(self, extracted_sources, recomposed_sources, store_on_gpu=False, dtype=np.float64):
+        """
+        Allocates the vectors of the minor loop.
+
+        INPUTS:
+        extracted_sources   (no default):       The wavelet coefficients of the extracted sources.
+        recomposed_sources  (no default):       The recomposition of the extracted sources.
+        store_on_gpu        (default=False):    Boolean specifier for whether responses are left on the gpu, in which
+                                                case the responses are not preallocated.
+        dtype               (default=float64):  Type of the vectors.
+        """
+
+        self.x = np.zeros(recomposed_sources.shape, dtype)
+        self.xn = np.empty(recomposed_sources.shape, dtype)
+        self.r = np.array(recomposed_sources, dtype=dtype)
+        self.rn = np.empty(recomposed_sources.shape, dtype)
+
+        self.p = np.empty(recomposed_sources.shape, dtype)
+
+        # The unmasked operator response (the decomposition of the convolved image) of x is kept between iterations.
+        # As the operator is linear, it can be updated alongside x itself, which avoids a second convolution and
+        # decomposition on each iteration. The response of x is initially zero as x is.
+
+        if store_on_gpu:
+            self.x_response = 0
+            self.xn_response = None
+            self.work = None
+        else:
+            self.x_response = np.zeros(extracted_sources.shape, dtype)
+            self.xn_response = np.empty(extracted_sources.shape, dtype)
+            self.work = np.empty(extracted_sources.shape, dtype)
+
+        self.extracted_sources_norm = np.sqrt(np.vdot(extracted_sources.ravel(), extracted_sources.ravel()))
+
+    def advance(self):
+        """
+        Makes the next iterate current by swapping the references of the current and next vectors.
+        """
+
+        self.x, self.xn = self.xn, self.x
+        self.r, self.rn = self.rn, self.r
+        self.x_response, self.xn_response = self.xn_response, self.x_response
+
+
+def cg_minor_loop(operator, extracted_sources, recomposed_sources, minor_loop_miter, enforce_positivity,
+                  hooks=None, major_iteration=None, dtype=np.float64):
+    """
+    The conjugate gradient minor loop. The variables have been named in order to appear consistent with the
+    algorithm.
+
+    INPUTS:
+    See minor_loop.
+
+    OUTPUTS:
+    See minor_loop.
+    """
+
+    state = MinorLoopState(extracted_sources, recomposed_sources, operator.store_on_gpu, dtype)
+
+    state.p[:] = state.r
+
+    rr = np.vdot(state.r.ravel(), state.r.ravel())
+
+    minor_loop_niter = 0
+
+    snr_last = 0
+    snr_current = 0
+
+    while (minor_loop_niter<minor_loop_miter):
+
+        # Only the response of p is computed on each iteration.
+
+        p_response = operator.response(state.p)
+        Ap = operator.recompose(p_response)
+
+        alpha = rr/np.vdot(state.p.ravel(), Ap.ravel())
+
+        np.multiply(state.p, alpha, out=state.xn)
+        state.xn += state.x
+
+        # The following enforces the positivity constraint which necessitates some recalculation. This is the only
+        # case in which the response of p must be recomputed.
+
+        if (np.min(state.xn)<0) & (enforce_positivity):
+
+            np.maximum(state.xn, 0, out=state.xn)
+            np.subtract(state.xn, state.x, out=state.p)
+            state.p /= alpha
+
+            p_response = operator.response(state.p)
+            Ap = operator.recompose(p_response)
+
+        np.multiply(Ap, -alpha, out=state.rn)
+        state.rn += state.r
+
+        rr_next = np.vdot(state.rn.ravel(), state.rn.ravel())
+        beta = rr_next/rr
+
+        state.p *= beta
+        state.p += state.rn
+
+        # We compare our model to the sources extracted from the data. The masked response of the model is formed in
+        # the work array, where its difference from the extracted sources is also taken.
+
+        snr_last = snr_current
+
+        with operator.profiler.phase("snr", extracted_sources):
+            if operator.store_on_gpu:
+                state.xn_response = state.x_response + alpha*p_response
+                model_sources = (operator.extracted_sources_mask*state.xn_response).get()
+                snr_current = tools.snr_ratio(extracted_sources, model_sources)
+            else:
+                np.multiply(p_response, alpha, out=state.xn_response)
+                state.xn_response += state.x_response
+                np.multiply(operator.extracted_sources_mask, state.xn_response, out=state.work)
+                snr_current = tools.snr_ratio(extracted_sources, state.work, state.extracted_sources_norm,
+                                              state.work)
+
+        minor_loop_niter += 1
+
+        logger.debug("SNR at iteration {0} = {1}".format(minor_loop_niter, snr_current))
+
+        operator.profiler.record("minor", iteration=minor_loop_niter, snr_current=snr_current,
+                                 max_scale=operator.max_scale, scale_adjust=operator.scale_adjust)
+
+        if hooks is not None:
+            if hooks.emit("minor", iteration=minor_loop_niter, major_iteration=major_iteration,
+                          snr_current=snr_current, max_scale=operator.max_scale, scale_adjust=operator.scale_adjust):
+                return state.xn, snr_current, minor_loop_niter, "accept"
+
+        # The following flow control determines whether or not the model is adequate and if a recalculation is
+        # required.
+
+        outcome = snr_outcome(snr_current, snr_last, minor_loop_niter)
+
+        if outcome=="accept":
+            return state.xn, snr_current, minor_loop_niter, outcome
+        elif outcome=="revert":
+            return state.x, snr_current, minor_loop_niter, "accept"
+        elif outcome=="reject":
+            return state.x, snr_current, minor_loop_niter, outcome
+
+        rr = rr_next
+        state.advance()
+
+    return state.x, snr_current, minor_loop_niter, None
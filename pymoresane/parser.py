@@ -1,18 +1,21 @@
 import argparse
+import os
 
 
-def handle_parser():
+def make_parser():
     """
-    This function parses in values from command line, allowing for user control from the system terminal.
+    This function creates the parser of the runsane command line. See handle_parser.
     """
     parser = argparse.ArgumentParser(description="Runs the pymoresane deconvolution algorithm with the specified "
                                                  "arguments. In the event that non-critical parameters are missing, "
                                                  "the defaults will be used.",
                                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument("dirty", help="File name and location of the input dirty map .fits file.")
+    parser.add_argument("dirty", help="File name and location of the input dirty map .fits file. Not required with "
+                                      "--serve.", nargs='?', default=None)
 
-    parser.add_argument("psf", help="File name and location input psf .fits file.")
+    parser.add_argument("psf", help="File name and location input psf .fits file. Not required with --serve.",
+                        nargs='?', default=None)
 
     parser.add_argument("outputname", help="File name and location of the output model and residual .fits files.",
                         nargs='?', default=None)
@@ -21,6 +24,35 @@ def handle_parser():
                                                    "in single-run mode. Scale-by-scale is usually the better choice."
                                                    , action="store_true")
 
+    parser.add_argument("-cu", "--cube", help="Specify whether every plane of the non-spatial (e.g. FREQ and STOKES) "
+                                              "axes is to be deconvolved. Planes are processed in parallel and each "
+                                              "output is written as a single cube.", action="store_true")
+
+    parser.add_argument("-cw", "--cubeworkers", help="Specify the number of processes used in cube mode. Defaults to "
+                                                     "the number of CPU cores.", default=None, type=int)
+
+    parser.add_argument("-co", "--coordinator", help="Specify an address, as HOST:PORT, on which to listen for workers "
+                                                     "started with runsane-worker. The planes (in cube mode) or facets "
+                                                     "(in facet mode) are then deconvolved by the workers.",
+                        default=None)
+
+    parser.add_argument("-ak", "--authkey", help="Specify the authentication key shared by the coordinator and its "
+                                                 "workers. Defaults to the PYMORESANE_AUTHKEY environment variable.",
+                        default=os.environ.get("PYMORESANE_AUTHKEY"))
+
+    parser.add_argument("-fs", "--facetsize", help="Specify the pixel width of the facets into which the image is "
+                                                   "divided. Facets are deconvolved in parallel. By default, the image "
+                                                   "is not faceted.", default=None, type=int)
+
+    parser.add_argument("-fo", "--facetoverlap", help="Specify the minimum overlap, in pixels, between neighbouring "
+                                                      "facets.", default=32, type=int)
+
+    parser.add_argument("-fw", "--facetworkers", help="Specify the number of processes used in facet mode. Defaults "
+                                                      "to the number of CPU cores.", default=None, type=int)
+
+    parser.add_argument("-fmc", "--facetmajorcycles", help="Specify the maximum number of global major cycles in "
+                                                           "facet mode.", default=3, type=int)
+
     parser.add_argument("-sbr", "--subregion", help="Specify pixel width of the central region of the dirty .fits "
                                                    "which is to be deconvolved.", default=None, type=int)
 
@@ -57,6 +89,9 @@ def handle_parser():
     parser.add_argument("-milm", "--minorloopmiter", help="Specify the maximum number of minor loop iterations."
                                                           , default=50, type=int)
 
+    parser.add_argument("-mls", "--minorloopsolver", help="Specify the solver used in the minor loop."
+                                                          , default="cg", choices=["cg"])
+
     parser.add_argument("-aog", "--allongpu", help="Specify whether as much code as possible is to be executed on the "
                                                    "gpu. Overrides the behaviour of all other gpu options"
                                                    , action='store_true')
@@ -95,11 +130,83 @@ def handle_parser():
     parser.add_argument("-ll", "--loglevel", help="Specify logging level.", default="INFO"
                                                   , choices=["DEBUG","INFO", "WARNING", "ERROR","CRITICAL"])
 
+    parser.add_argument("-lf", "--logfile", help="Specify the name of the log file, which is overwritten. An empty "
+                                                 "name writes no log file.", default="PyMORESANE.log")
+
+    parser.add_argument("-pr", "--profile", help="File name of a JSON file to which the time, calls and allocations "
+                                                 "of each phase and a record of each iteration are written.",
+                        default=None)
+
+    parser.add_argument("-mb", "--memorybudget", help="Specify a memory budget, e.g. 512M or 4G. Lower precision "
+                                                      "and fewer cached decompositions or workers are used as "
+                                                      "required to stay within it, and the peak memory of each phase "
+                                                      "is reported.", default=None)
+
+    parser.add_argument("-ev", "--events", help="File name to which progress events (major and minor iterations, "
+                                                "scale changes and completion) are written as newline-delimited JSON. "
+                                                "Use - for standard output.", default=None)
+
     parser.add_argument("-m", "--mask", help="File name and location of the input .fits mask.", default=None)
 
+    parser.add_argument("-pc", "--psfcache", help="Directory in which PSF precomputations (FFTs, wavelet energies and "
+                                                   "the restoring beam) are cached. Runs which share a PSF will "
+                                                   "reuse these instead of recomputing them.", default=None)
+
+    parser.add_argument("-ck", "--checkpoint", help="File name of a checkpoint of the major loop, which is written "
+                                                    "periodically so that a run which dies can be resumed.",
+                        default=None)
+
+    parser.add_argument("-ci", "--checkpointinterval", help="Specify the minimum time, in seconds, between "
+                                                            "checkpoints.", type=float, default=600)
+
+    parser.add_argument("-rs", "--resume", help="Continue from the checkpoint, if it exists, rather than starting "
+                                                "from the beginning.", action="store_true")
+
+    parser.add_argument("-im", "--initialmodel", help="File name of a .fits model, or of a .npz component list, from "
+                                                      "which the deconvolution starts, e.g. that of an earlier run. "
+                                                      "Its residual is computed once before the deconvolution.",
+                        default=None)
+
+    parser.add_argument("-cl", "--componentlist", help="File name to which the model is written as a list of its "
+                                                       "non-zero pixels (y, x and flux), which is usually much "
+                                                       "smaller than the model image. Use a .npz extension to read "
+                                                       "it back with --initialmodel.", default=None)
+
+    parser.add_argument("-cls", "--componentscales", help="Specify whether the components are grouped by the scale "
+                                                          "at which they were added to the model.",
+                        action="store_true")
+
+    parser.add_argument("-nmi", "--nomodelimage", help="Do not write the model image. Requires --componentlist.",
+                        action="store_true")
+
+    parser.add_argument("-roi", "--regions", help="Deconvolve only windows around the regions which contain "
+                                                  "significant emission, found from the residual or the mask. Most "
+                                                  "effective for compact sources with a small maximum scale.",
+                        action="store_true")
+
+    parser.add_argument("-rf", "--regionfraction", help="Specify the maximum fraction of the image which the regions "
+                                                        "may cover before the full image is deconvolved instead.",
+                        type=float, default=0.5)
+
+    parser.add_argument("-sv", "--serve", help="Specify an address on which to run as a daemon which accepts jobs - "
+                                               "either the path of a UNIX socket or HOST:PORT. Other options apply "
+                                               "to every job unless the job overrides them.", default=None)
+
+    parser.add_argument("-sw", "--serveworkers", help="Specify the number of jobs the daemon runs at once. Defaults to "
+                                                      "the number of cores.", type=int, default=None)
+
+    parser.add_argument("-sq", "--servequeue", help="Specify the maximum number of jobs the daemon holds, queued or "
+                                                    "running. Further jobs are refused. Unlimited by default.",
+                        type=int, default=None)
+
     parser.add_argument("-ft", "--fluxthreshold", help="Flux threshold level for shallow deconvolution.", default=0,
                         type=float)
 
+    parser.add_argument("-of", "--outputformat", help="Specify the format of the output images: one .fits file per "
+                                                      "image, one losslessly tile-compressed .fits file per image or "
+                                                      "a single multi-extension .fits file named after outputname.",
+                        default="fits", choices=["fits", "compressed", "mef"])
+
     parser.add_argument("-rn", "--residualname", help="Specific residual image name.", default=None)
 
     parser.add_argument("-mn", "--modelname", help="Specific model image name.", default=None)
@@ -122,4 +229,88 @@ def handle_parser():
                                                   "when estimating the noise"
                                                   ".", type=int, default=0)
 
+    return parser
+
+
+def handle_parser(args=None, namespace=None):
+    """
+    This function parses in values from command line, allowing for user control from the system terminal.
+
+    INPUTS:
+    args        (default=None): List of arguments to parse. Defaults to the command line.
+    namespace   (default=None): Parsed arguments whose values replace the defaults of the parser.
+    """
+    parser = make_parser()
+
+    args = parser.parse_args(args, namespace)
+
+    if (args.serve is None) and ((args.dirty is None) or (args.psf is None)):
+        parser.error("the following arguments are required: dirty, psf")
+
+    if args.resume and (args.checkpoint is None):
+        parser.error("--resume requires --checkpoint")
+
+    if args.nomodelimage and (args.componentlist is None):
+        parser.error("--nomodelimage requires --componentlist")
+
+    return args
+
+
+def handle_worker_parser():
+    """
+    This function parses the command line of runsane-worker, which connects to a coordinator started by runsane.
+    """
+    parser = argparse.ArgumentParser(description="Runs a pymoresane worker which deconvolves the planes or facets "
+                                                 "distributed by a coordinator.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("coordinator", help="Address of the coordinator as HOST:PORT.")
+
+    parser.add_argument("-ak", "--authkey", help="Specify the authentication key shared by the coordinator and its "
+                                                 "workers. Defaults to the PYMORESANE_AUTHKEY environment variable.",
+                        default=os.environ.get("PYMORESANE_AUTHKEY"))
+
+    parser.add_argument("-wi", "--workerid", help="Specify an identifier for the worker. Defaults to the host name and "
+                                                  "process id.", default=None)
+
+    parser.add_argument("-ll", "--loglevel", help="Specify logging level.", default="INFO"
+                                                  , choices=["DEBUG","INFO", "WARNING", "ERROR","CRITICAL"])
+
     return parser.parse_args()
+
+
+def handle_batch_parser():
+    """
+    This function parses the command line of runsane-batch. Any arguments which are not batch options are runsane
+    options, which apply to every job of the manifest unless the job overrides them.
+
+    OUTPUTS:
+    args                    Parsed batch options.
+    options                 List of the remaining runsane options.
+    """
+    parser = argparse.ArgumentParser(description="Runs pymoresane on every dirty map and PSF listed in a manifest. "
+                                                 "Any further runsane options (e.g. -ep or --loopgain 0.2) apply to "
+                                                 "every job.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("manifest", help="File name of a .csv or .json manifest of jobs. Each job has a dirty, psf "
+                                         "and output entry and optionally an id. Any other entries are runsane "
+                                         "options, given by their long names without dashes (e.g. loopgain).")
+
+    parser.add_argument("-bw", "--batchworkers", help="Specify the number of jobs which are run at once. Defaults to "
+                                                      "the number of cores.", type=int, default=None)
+
+    parser.add_argument("-rr", "--rerun", help="Specify whether jobs which have already completed, as recorded by "
+                                               "their .done markers, are run again.", action="store_true")
+
+    parser.add_argument("-rp", "--report", help="File name of a JSON file to which a summary of the batch - counts, "
+                                                "timings, throughput and failures - is written.", default=None)
+
+    parser.add_argument("-pc", "--psfcache", help="Directory in which PSF precomputations are shared between jobs "
+                                                  "and kept between batches. Defaults to a temporary directory.",
+                        default=None)
+
+    parser.add_argument("-ll", "--loglevel", help="Specify logging level.", default="INFO"
+                                                  , choices=["DEBUG","INFO", "WARNING", "ERROR","CRITICAL"])
+
+    return parser.parse_known_args()
@@ -0,0 +1,328 @@
+import logging
+import threading
+import pyfits
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the stream of items passing between the stages of a Pipeline.
+
+_END = object()
+
+# The number of bytes converted at a time when data is written to a .fits file.
+
+_WRITE_BLOCK_SIZE = 2**22
+
+
+class Pipeline(object):
+    """
+    A three stage pipeline in which a reader thread prefetches the input of the next task and a writer thread flushes
+    the output of the previous task while the current task is processed in the calling thread. The stages are
+    connected by bounded queues, so that at most queue_size inputs and outputs are held in memory at any one time.
+    """
+
+    def __init__(self, read, process, write, queue_size=2):
+        """
+        INPUTS:
+        read        (no default):   Function which takes a task and returns its input, e.g. a plane of a cube. If
+                                    None, each task is its own input.
+        process     (no default):   Function which takes a task and its input and returns its output. If None, the
+                                    input is passed to the writer unchanged.
+        write       (no default):   Function which takes a task and its output and stores the output.
+        queue_size  (default=2):    Maximum number of items waiting between two stages.
+        """
+
+        self.read = read
+        self.process = process
+        self.write = write
+        self.queue_size = queue_size
+
+    def run(self, tasks):
+        """
+        Runs every task through the pipeline. Exceptions raised in the reader or writer thread are re-raised in the
+        calling thread.
+
+        INPUTS:
+        tasks       (no default):   Iterable of tasks.
+        """
+
+        read_queue = queue.Queue(self.queue_size)
+        write_queue = queue.Queue(self.queue_size)
+
+        errors = []
+        stop = threading.Event()
+
+        def put(out_queue, item):
+            # Waits for space in the queue, giving up if another stage has failed.
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def reader():
+            try:
+                for task in tasks:
+                    data = self.read(task) if self.read is not None else task
+                    if not put(read_queue, (task, data)):
+                        return
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+            finally:
+                put(read_queue, _END)
+
+        def writer():
+            try:
+                while True:
+                    try:
+                        item = write_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        if stop.is_set():
+                            return
+                        continue
+                    if item is _END:
+                        return
+                    self.write(*item)
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+
+        reader_thread = threading.Thread(target=reader, name="pymoresane-reader")
+        writer_thread = threading.Thread(target=writer, name="pymoresane-writer")
+        reader_thread.daemon = True
+        writer_thread.daemon = True
+
+        reader_thread.start()
+        writer_thread.start()
+
+        try:
+            while not stop.is_set():
+                try:
+                    item = read_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _END:
+                    break
+                task, data = item
+                if self.process is not None:
+                    data = self.process(task, data)
+                if not put(write_queue, (task, data)):
+                    break
+        except Exception:
+            stop.set()
+            raise
+        finally:
+            # Unless a stage has failed, the writer flushes every output which has been queued before it exits.
+            if not stop.is_set():
+                put(write_queue, _END)
+            writer_thread.join()
+            stop.set()
+            reader_thread.join()
+
+        if errors:
+            raise errors[0]
+
+
+class CubeFileWriter(object):
+    """
+    Writes a .fits cube plane by plane. The file is allocated on creation, after which each plane is written
+    directly to its position in the file. This allows planes to be written as soon as they are available and in any
+    order, without holding the whole cube in memory.
+    """
+
+    def __init__(self, name, header, shape):
+        """
+        INPUTS:
+        name        (no default):   Name of the .fits file. Will overwrite.
+        header      (no default):   Header of the cube. Its NAXIS keywords must describe shape.
+        shape       (no default):   Shape of the cube. The last two axes are the plane axes.
+        """
+
+        header = header.copy()
+
+        header.update('BITPIX', -32)
+
+        for key in ['BSCALE', 'BZERO', 'BLANK']:
+            if key in header:
+                del header[key]
+
+        header_bytes = header.tostring()
+
+        if not isinstance(header_bytes, bytes):
+            header_bytes = header_bytes.encode("ascii")
+
+        self.name = name
+        self.shape = tuple(shape)
+        self.plane_shape = self.shape[-2:]
+        self.header_size = len(header_bytes)
+        self.plane_size = int(np.prod(self.plane_shape))*4
+
+        # The data unit of a .fits file is padded to a multiple of 2880 bytes. Writing the last byte allocates the
+        # whole file.
+
+        data_size = int(np.prod(self.shape))*4
+        padded_size = -(-data_size//2880)*2880
+
+        self.file = open(name, "wb+")
+        self.file.write(header_bytes)
+
+        if padded_size>0:
+            self.file.seek(self.header_size + padded_size - 1)
+            self.file.write(b"\0")
+
+        self.lock = threading.Lock()
+
+    def write_plane(self, plane, data):
+        """
+        Writes a single plane of the cube.
+
+        INPUTS:
+        plane       (no default):   Index of the plane, counting over all the non-spatial axes.
+        data        (no default):   Array containing the plane.
+        """
+
+        data = np.asarray(data).reshape(self.plane_shape)
+
+        # The plane is converted to big-endian float32 a block of rows at a time, so that no copy of the whole plane
+        # is made and the plane itself is never modified.
+
+        rows = max(_WRITE_BLOCK_SIZE//(4*self.plane_shape[1]), 1)
+
+        with self.lock:
+            self.file.seek(self.header_size + plane*self.plane_size)
+
+            for row in range(0, self.plane_shape[0], rows):
+                self.file.write(np.asarray(data[row:row+rows], dtype=">f4").tobytes())
+
+    def close(self):
+        """
+        Closes the file.
+        """
+
+        self.file.close()
+
+
+class OutputWriter(object):
+    """
+    Writes images to .fits files in a background thread, so that the images can be written while the deconvolution
+    continues, e.g. while the model is restored. The header of each image is copied when the image is queued, so later
+    changes to the header do not affect the file. The images themselves must not be modified until the writer is
+    closed.
+
+    The output formats are:
+    fits        One file per image. The data is written by a CubeFileWriter, so no copy of the image is made.
+    compressed  One tile-compressed file per image. The compression (GZIP_2 without quantisation) is lossless.
+    mef         A single multi-extension file, with one extension per image named after the image. The file is
+                written when the writer is closed.
+    """
+
+    FORMATS = ("fits", "compressed", "mef")
+
+    def __init__(self, output_format="fits", mef_name=None):
+        """
+        INPUTS:
+        output_format   (default="fits"):   Output format - "fits", "compressed" or "mef".
+        mef_name        (default=None):     Name of the multi-extension file. Required by the "mef" format.
+        """
+
+        if output_format not in self.FORMATS:
+            raise ValueError("Unknown output format {}. Formats are {}.".format(output_format,
+                                                                               ", ".join(self.FORMATS)))
+
+        if (output_format=="mef") and (mef_name is None):
+            raise ValueError("A multi-extension output requires a file name.")
+
+        self.output_format = output_format
+        self.mef_name = mef_name
+        self.extensions = []
+        self.error = None
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="output-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, name, data, header, extname=None):
+        """
+        Queues an image to be written. As for FitsImage.save_fits, the image is written with two additional leading
+        axes.
+
+        INPUTS:
+        name        (no default):   File name of the image. Will overwrite. Ignored by the "mef" format.
+        data        (no default):   Array containing the image.
+        header      (no default):   Header of the image, which is copied.
+        extname     (default=None): Name of the extension of the image in the "mef" format.
+        """
+
+        data = np.asarray(data, dtype=np.float32)
+        data = data.reshape((1,)*(4-data.ndim) + data.shape)
+
+        # The header is matched to the shape and type of the data by pyfits, which does not copy the data. pyfits
+        # builds the compressed and multi-extension files from a copy, as it may convert the data in place.
+
+        header = pyfits.PrimaryHDU(data, header.copy()).header
+
+        if self.output_format!="fits":
+            data = np.array(data)
+
+        self.queue.put((name, data, header, extname))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+
+            if item is _END:
+                break
+
+            try:
+                self._write(*item)
+            except Exception as error:
+                logger.exception("Failed to write {}.".format(item[0]))
+                if self.error is None:
+                    self.error = error
+
+        if self.extensions and (self.error is None):
+            try:
+                pyfits.HDUList(self.extensions).writeto(self.mef_name, clobber=True)
+            except Exception as error:
+                logger.exception("Failed to write {}.".format(self.mef_name))
+                self.error = error
+
+    def _write(self, name, data, header, extname):
+        if self.output_format=="fits":
+            writer = CubeFileWriter(name, header, data.shape)
+            try:
+                writer.write_plane(0, data)
+            finally:
+                writer.close()
+
+        elif self.output_format=="compressed":
+            hdu = pyfits.CompImageHDU(data, header, compression_type="GZIP_2", quantize_level=0)
+            pyfits.HDUList([pyfits.PrimaryHDU(), hdu]).writeto(name, clobber=True)
+
+        elif self.output_format=="mef":
+            if extname is not None:
+                header.update('EXTNAME', extname)
+            if self.extensions:
+                self.extensions.append(pyfits.ImageHDU(data, header))
+            else:
+                self.extensions.append(pyfits.PrimaryHDU(data, header))
+
+    def close(self):
+        """
+        Waits for the queued images to be written. Any error raised while writing is re-raised here.
+        """
+
+        self.queue.put(_END)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,535 @@
+import functools
+import logging
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+import pymoresane.iuwt as iuwt
+import pymoresane.iuwt_convolution as conv
+from pymoresane.beam_fit import beam_fit, fit_region, gaussian_beam, psf_peak
+
+logger = logging.getLogger(__name__)
+
+
+def central_slice(shape, width):
+    """
+    Convenience function which returns the slices of the central region of the given width of an array.
+
+    INPUTS:
+    shape       (no default):   Shape of the array.
+    width       (no default):   Width, in pixels, of the central region.
+
+    OUTPUTS:
+    Tuple of slices selecting the central region.
+    """
+
+    return tuple(slice(sz//2-width//2, sz//2+width//2) for sz in shape[-2:])
+
+
+def synchronised(method):
+    """
+    Decorator which holds the lock of an instance, its lock attribute, while the method runs.
+    """
+
+    @functools.wraps(method)
+    def locked_method(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return locked_method
+
+
+class IncrementalDecomposition(object):
+    """
+    The IUWT decomposition of a single array. The decomposition is extended one scale at a time as more scales are
+    requested - the smoothed coefficients of the last computed scale are kept so that no scale is computed twice.
+    """
+
+    def __init__(self, in1, decom_mode="ser", core_count=1):
+        """
+        Stores a copy of the array which is to be decomposed.
+
+        INPUTS:
+        in1         (no default):       Array which is to be decomposed.
+        decom_mode  (default='ser'):    Specifier for decomposition mode - serial, multiprocessing, or gpu.
+        core_count  (default=1):        For multiprocessing, specifies the number of cores.
+        """
+
+        self.source = np.array(in1)
+        self.decom_mode = decom_mode
+        self.core_count = core_count
+
+        self.detail_coeffs = np.empty([0, in1.shape[0], in1.shape[1]])
+        self.smoothed = self.source
+
+    def matches(self, in1, decom_mode):
+        """
+        Determines whether or not this decomposition is that of the given array.
+        """
+
+        return (decom_mode==self.decom_mode) and (in1.shape==self.source.shape) and np.array_equal(in1, self.source)
+
+    def decomposition(self, scale_count):
+        """
+        Returns the decomposition up to scale_count, computing only the scales which are not yet available. The GPU
+        implementation cannot be extended, so it is recomputed whenever more scales are requested.
+        """
+
+        if scale_count>self.detail_coeffs.shape[0]:
+            if self.decom_mode=="gpu":
+                self.detail_coeffs = iuwt.iuwt_decomposition(self.source, scale_count, 0, self.decom_mode,
+                                                             self.core_count)
+            else:
+                self.detail_coeffs, self.smoothed = iuwt.extend_iuwt_decomposition(self.detail_coeffs,
+                                                                                   self.smoothed, scale_count,
+                                                                                   self.decom_mode, self.core_count)
+
+        return self.detail_coeffs[:scale_count]
+
+
+class DiskCache(object):
+    """
+    An on-disk store of quantities derived from a PSF. Entries are keyed by a hash of the PSF data together with the
+    parameters on which they depend and are stored as .npy files, which are loaded by memory mapping. This allows
+    runs which share a PSF to skip its preprocessing.
+    """
+
+    def __init__(self, cache_dir, psf_data):
+        """
+        INPUTS:
+        cache_dir   (no default):   Directory in which entries are stored. Created if it does not exist.
+        psf_data    (no default):   Array containing the PSF.
+        """
+
+        self.cache_dir = cache_dir
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        psf_data = np.ascontiguousarray(psf_data)
+
+        psf_hash = hashlib.sha1(psf_data.tobytes())
+        psf_hash.update(repr((psf_data.shape, psf_data.dtype.str)).encode())
+
+        self.psf_hash = psf_hash.hexdigest()
+
+    def path(self, name, params):
+        """
+        Returns the file name of the entry with the given name and parameters.
+        """
+
+        key = hashlib.sha1((self.psf_hash + repr(params)).encode()).hexdigest()
+
+        return os.path.join(self.cache_dir, "{}_{}.npy".format(name, key))
+
+    def load(self, name, params):
+        """
+        Returns a read-only memory map of the entry with the given name and parameters, or None if no such entry
+        exists.
+        """
+
+        path = self.path(name, params)
+
+        if os.path.isfile(path):
+            logger.debug("Loading {} from {}.".format(name, path))
+            return np.load(path, mmap_mode="r")
+
+        return None
+
+    def save(self, name, params, data):
+        """
+        Stores an entry. The entry is written to a temporary file which is then renamed, so that concurrent runs
+        never see a partially written entry. The temporary file is unique to the process and thread.
+        """
+
+        path = self.path(name, params)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+
+        with open(tmp_path, "wb") as tmp_file:
+            np.save(tmp_file, np.asarray(data))
+
+        os.replace(tmp_path, path)
+
+
+def beam_key(psf_data, psf_header):
+    """
+    Returns a hash of the region of the PSF to which the restoring beam is fitted, together with the pixel size. This
+    identifies the fitted beam parameters.
+
+    INPUTS:
+    psf_data    (no default):   Array containing the PSF.
+    psf_header  (no default):   Header of the PSF.
+
+    OUTPUTS:
+    Hexadecimal digest of the hash.
+    """
+
+    psf_region = np.ascontiguousarray(psf_data[fit_region(psf_data.shape)])
+
+    key = hashlib.sha1(psf_region.tobytes())
+    key.update(repr((psf_region.shape, psf_region.dtype.str, psf_header['CDELT1'], psf_header['CDELT2'])).encode())
+
+    return key.hexdigest()
+
+
+class BeamSidecar(object):
+    """
+    A small JSON file alongside a PSF file, named after it, which records the restoring beam parameters fitted to the
+    PSF keyed by beam_key. Runs which use the same PSF file then skip the fit without a disk cache. Nothing is stored
+    if the file cannot be written.
+    """
+
+    def __init__(self, psf_name):
+        """
+        INPUTS:
+        psf_name    (no default):   Name of the .fits file of the PSF.
+        """
+
+        self.name = psf_name + ".beam.json"
+
+    def entries(self):
+        """
+        Returns the dictionary of beam parameters stored in the sidecar, which is empty if it does not exist or cannot
+        be read.
+        """
+
+        try:
+            with open(self.name) as sidecar:
+                entries = json.load(sidecar)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        return entries if isinstance(entries, dict) else {}
+
+    def load(self, key):
+        """
+        Returns the beam parameters stored under key, or None if there are none.
+        """
+
+        return self.entries().get(key)
+
+    def save(self, key, beam_params):
+        """
+        Stores beam parameters under key. The sidecar is written to a temporary file which is then renamed, so that
+        concurrent runs never see a partially written sidecar.
+        """
+
+        entries = self.entries()
+        entries[key] = [float(param) for param in beam_params]
+
+        tmp_name = "{}.{}.{}.tmp".format(self.name, os.getpid(), threading.current_thread().ident)
+
+        try:
+            with open(tmp_name, "w") as sidecar:
+                json.dump(entries, sidecar)
+
+            os.replace(tmp_name, self.name)
+        except (IOError, OSError) as error:
+            logger.debug("Restoring beam parameters not stored in {} - {}".format(self.name, error))
+
+
+class PrecomputationCache(object):
+    """
+    Stores the quantities which MORESANE derives from the PSF so that they are computed only once per FitsImage. This
+    allows repeated calls to FitsImage.moresane, as in the scale-by-scale approach, to reuse the PSF FFTs and to
+    extend the PSF decompositions by the additional scales only. The decompositions of the dirty image are kept by
+    the main.RunState of each deconvolution.
+
+    A PrecomputationCache may be shared by FitsImages which are deconvolved concurrently in several threads. Its
+    methods hold a lock, so that each quantity is computed by one thread while the others wait for it.
+    """
+
+    def __init__(self, psf_data, dirty_data_shape, cache_dir=None, psf_name=None):
+        """
+        INPUTS:
+        psf_data            (no default):   Array containing the PSF.
+        dirty_data_shape    (no default):   Shape of the dirty image.
+        cache_dir           (default=None): Directory of an on-disk cache which is shared between runs. Only the
+                                            PSF FFTs, PSF energies and restoring beam parameters are stored there.
+        psf_name            (default=None): Name of the .fits file of the PSF, alongside which the fitted restoring
+                                            beam parameters are stored, see BeamSidecar.
+        """
+
+        self.psf_data = psf_data
+        self.psf_data_shape = psf_data.shape
+        self.dirty_data_shape = dirty_data_shape
+
+        self.psf_fft_cache = {}
+        self.psf_decompositions = {}
+        self.psf_energy_cache = {}
+        self.beam_cache = {}
+
+        self.lock = threading.RLock()
+
+        if cache_dir is not None:
+            self.disk_cache = DiskCache(cache_dir, psf_data)
+        else:
+            self.disk_cache = None
+
+        self.beam_sidecar = BeamSidecar(psf_name) if psf_name is not None else None
+
+    def psf_subregion(self, subregion):
+        """
+        Returns the central region of the PSF which corresponds to a subregion of the dirty image.
+        """
+
+        if np.all(np.array(self.psf_data_shape)==2*np.array(self.dirty_data_shape)):
+            return self.psf_data[central_slice(self.psf_data_shape, subregion)]
+        else:
+            return self.psf_data[central_slice(self.dirty_data_shape, subregion)]
+
+    @synchronised
+    def psf_ffts(self, subregion, conv_device="cpu", conv_mode="linear", low_precision=False):
+        """
+        Returns the FFT of both the PSF subregion of interest and the full PSF. If conv_device is "gpu", these are
+        pre-loaded onto the gpu.
+
+        INPUTS:
+        subregion       (no default):       Size, in pixels, of the central region to be deconvolved.
+        conv_device     (default='cpu'):    Specifier for device to be used - cpu or gpu.
+        conv_mode       (default='linear'): Specifier for convolution mode - linear or circular.
+        low_precision   (default=False):    Boolean specifier for whether FFTs on the cpu are stored as complex64,
+                                            which halves their memory at the cost of precision. Entries on disk are
+                                            always stored at full precision.
+
+        OUTPUTS:
+        psf_subregion_fft                   FFT of the PSF used for convolutions with the subregion.
+        psf_data_fft                        FFT of the PSF used for convolutions with the full image.
+        """
+
+        key = (subregion, conv_device, conv_mode)
+
+        if low_precision & (conv_device=="cpu"):
+            key += ("low_precision",)
+
+        if key in self.psf_fft_cache:
+            return self.psf_fft_cache[key]
+
+        # Full precision FFTs which were computed earlier are converted and discarded, so that both are not kept.
+
+        if (key[-1]=="low_precision") and (key[:-1] in self.psf_fft_cache):
+            self.psf_fft_cache[key] = self._fft_precision(*self.psf_fft_cache.pop(key[:-1]), key=key)
+            return self.psf_fft_cache[key]
+
+        # FFTs on the gpu are not stored on disk. The dirty image shape is part of the key of the on-disk entries as
+        # it determines which region of the PSF is transformed.
+
+        disk_params = (subregion, conv_mode, tuple(self.dirty_data_shape))
+
+        if (self.disk_cache is not None) & (conv_device=="cpu"):
+            psf_subregion_fft = self.disk_cache.load("psf_subregion_fft", disk_params)
+            psf_data_fft = self.disk_cache.load("psf_data_fft", disk_params)
+
+            if (psf_subregion_fft is not None) & (psf_data_fft is not None):
+                self.psf_fft_cache[key] = self._fft_precision(psf_subregion_fft, psf_data_fft, key)
+                return self.psf_fft_cache[key]
+
+        if conv_device=="gpu":
+            fft = lambda in1: conv.gpu_r2c_fft(in1, is_gpuarray=False, store_on_gpu=True)
+        else:
+            fft = np.fft.rfft2
+
+        psf_subregion = self.psf_subregion(subregion)
+        double_psf = np.all(np.array(self.psf_data_shape)==2*np.array(self.dirty_data_shape))
+        full_subregion = np.all(np.array(self.dirty_data_shape)==subregion)
+
+        if conv_mode=="circular":
+            psf_subregion_fft = fft(psf_subregion)
+            if double_psf:
+                psf_data_fft = fft(self.psf_data[central_slice(self.psf_data_shape, self.dirty_data_shape[0])])
+            elif psf_subregion.shape==self.psf_data_shape:
+                psf_data_fft = psf_subregion_fft
+            else:
+                psf_data_fft = fft(self.psf_data)
+
+        elif conv_mode=="linear":
+            if double_psf:
+                if full_subregion:
+                    psf_subregion_fft = fft(self.psf_data)
+                    psf_data_fft = psf_subregion_fft
+                    logger.info("Using double size PSF.")
+                else:
+                    psf_subregion_fft = fft(self.psf_data[central_slice(self.psf_data_shape, 2*subregion)])
+                    psf_data_fft = fft(self.psf_data)
+            else:
+                if full_subregion:
+                    psf_subregion_fft = fft(conv.pad_array(self.psf_data))
+                    psf_data_fft = psf_subregion_fft
+                else:
+                    psf_subregion_fft = fft(self.psf_data[central_slice(self.psf_data_shape, 2*subregion)])
+                    psf_data_fft = fft(conv.pad_array(self.psf_data))
+
+        if (self.disk_cache is not None) & (conv_device=="cpu"):
+            self.disk_cache.save("psf_subregion_fft", disk_params, psf_subregion_fft)
+            self.disk_cache.save("psf_data_fft", disk_params, psf_data_fft)
+
+        self.psf_fft_cache[key] = self._fft_precision(psf_subregion_fft, psf_data_fft, key)
+
+        return self.psf_fft_cache[key]
+
+    def _fft_precision(self, psf_subregion_fft, psf_data_fft, key):
+        """
+        Converts the PSF FFTs to complex64 if the key is that of low precision FFTs. The FFTs remain a single array
+        when the subregion is the full image.
+        """
+
+        if key[-1]!="low_precision":
+            return (psf_subregion_fft, psf_data_fft)
+
+        if psf_data_fft is psf_subregion_fft:
+            psf_subregion_fft = psf_data_fft = psf_subregion_fft.astype(np.complex64)
+        else:
+            psf_subregion_fft = psf_subregion_fft.astype(np.complex64)
+            psf_data_fft = psf_data_fft.astype(np.complex64)
+
+        return (psf_subregion_fft, psf_data_fft)
+
+    @synchronised
+    def psf_decomposition(self, subregion, scale_count, decom_mode="ser", core_count=1):
+        """
+        Returns the IUWT decomposition of the PSF subregion up to scale_count.
+        """
+
+        key = (subregion, decom_mode)
+
+        if key not in self.psf_decompositions:
+            self.psf_decompositions[key] = IncrementalDecomposition(self.psf_subregion(subregion), decom_mode,
+                                                                    core_count)
+
+        return self.psf_decompositions[key].decomposition(scale_count)
+
+    @synchronised
+    def psf_energies(self, subregion, scale_count, decom_mode="ser", core_count=1):
+        """
+        Returns the norm of each scale of the PSF decomposition. These correspond to the energies or weighting factors
+        which must be applied when locating maxima. The PSF decomposition is used only to derive these, so only the
+        energies are stored on disk.
+        """
+
+        key = (subregion, decom_mode)
+
+        psf_energies = self.psf_energy_cache.get(key, np.empty([0,1,1], dtype=np.float32))
+        computed_scales = psf_energies.shape[0]
+
+        if (scale_count>computed_scales) & (self.disk_cache is not None):
+            disk_energies = self.disk_cache.load("psf_energies", key + (scale_count,))
+
+            if disk_energies is not None:
+                psf_energies = disk_energies
+                computed_scales = scale_count
+                self.psf_energy_cache[key] = psf_energies
+
+        if scale_count>computed_scales:
+            psf_decomposition = self.psf_decomposition(subregion, scale_count, decom_mode, core_count)
+
+            psf_energies = np.concatenate([psf_energies,
+                                           np.empty([scale_count-computed_scales,1,1], dtype=np.float32)])
+
+            for i in range(computed_scales, scale_count):
+                psf_energies[i] = np.sqrt(np.sum(np.square(psf_decomposition[i,:,:])))
+
+            self.psf_energy_cache[key] = psf_energies
+
+            if self.disk_cache is not None:
+                self.disk_cache.save("psf_energies", key + (scale_count,), psf_energies)
+
+        return psf_energies[:scale_count]
+
+    @synchronised
+    def beam_parameters(self, psf_header, beam_params=None):
+        """
+        Returns the parameters of the restoring beam, as fitted to the PSF by beam_fit. Fitted parameters are stored
+        in the disk cache and in the sidecar of the PSF file rather than refitted.
+
+        INPUTS:
+        psf_header      (no default):   Header of the PSF.
+        beam_params     (default=None): Known beam parameters - BMAJ, BMIN and BPA. If given, these are used rather
+                                        than fitted.
+
+        OUTPUTS:
+        beam_params                     List of the beam parameters - BMAJ, BMIN and BPA.
+        """
+
+        key = (psf_header['CDELT1'], psf_header['CDELT2'])
+
+        if beam_params is not None:
+            key += tuple(beam_params)
+
+        if key in self.beam_cache:
+            return self.beam_cache[key]
+
+        if (beam_params is None) & (self.disk_cache is not None):
+            beam_params = self.disk_cache.load("fitted_beam_params", key)
+
+        if (beam_params is None) & (self.beam_sidecar is not None):
+            sidecar_key = beam_key(self.psf_data, psf_header)
+            beam_params = self.beam_sidecar.load(sidecar_key)
+
+        if beam_params is None:
+            beam_params = beam_fit(self.psf_data, psf_header)[1]
+
+            if self.disk_cache is not None:
+                self.disk_cache.save("fitted_beam_params", key, beam_params)
+
+            if self.beam_sidecar is not None:
+                self.beam_sidecar.save(sidecar_key, beam_params)
+
+        self.beam_cache[key] = [float(param) for param in beam_params]
+
+        return self.beam_cache[key]
+
+    def beam(self, psf_header, beam_params=None):
+        """
+        Returns the restoring beam and its parameters. Only the parameters are stored, see beam_parameters, as the beam
+        is constructed from them by gaussian_beam. FitsImage.restore does not require the beam itself.
+
+        INPUTS:
+        psf_header      (no default):   Header of the PSF.
+        beam_params     (default=None): Known beam parameters - BMAJ, BMIN and BPA.
+
+        OUTPUTS:
+        clean_beam                      Array containing the restoring beam.
+        beam_params                     List of the beam parameters - BMAJ, BMIN and BPA.
+        """
+
+        beam_params = self.beam_parameters(psf_header, beam_params)
+
+        clean_beam = gaussian_beam(self.psf_data_shape, psf_peak(self.psf_data), beam_params, psf_header)
+
+        return clean_beam, beam_params
+
+    @synchronised
+    def entries(self):
+        """
+        Returns the stored PSF FFTs, PSF energies and restoring beam parameters as a dictionary of arrays. Together with
+        load_entries, this allows the precomputations to be shared with other processes. FFTs on the gpu are omitted.
+        """
+
+        entries = {}
+
+        for key, value in self.psf_fft_cache.items():
+            if isinstance(value[0], np.ndarray):
+                entries[("psf_ffts",) + key] = value
+
+        for key, value in self.psf_energy_cache.items():
+            entries[("psf_energies",) + key] = value
+
+        for key, value in self.beam_cache.items():
+            entries[("beam",) + key] = np.asarray(value)
+
+        return entries
+
+    @synchronised
+    def load_entries(self, entries):
+        """
+        Stores precomputations created by entries, possibly in another process.
+        """
+
+        for key, value in entries.items():
+            if key[0]=="psf_ffts":
+                self.psf_fft_cache[key[1:]] = tuple(value)
+            elif key[0]=="psf_energies":
+                self.psf_energy_cache[key[1:]] = value
+            elif key[0]=="beam":
+                self.beam_cache[key[1:]] = [float(param) for param in value]
@@ -0,0 +1,229 @@
+import json
+import logging
+import time
+import tracemalloc
+import numpy as np
+import pymoresane.memory as memory
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler(object):
+    """
+    Collects the wall time, number of calls, allocated bytes and array sizes of each phase of a deconvolution, along
+    with a record of every major and minor iteration. A FitsImage reports to the profiler assigned to its profiler
+    attribute. Phases may be nested, e.g. the convolutions of the minor loop are also part of the minor_loop phase, so
+    the times of the phases need not sum to the total.
+
+    For each phase, allocated_bytes is the sum over all calls of the memory allocated by the call at its peak, and
+    peak_bytes is the largest such value. If the resident set size is sampled, peak_rss_bytes is the largest resident
+    set size of the process observed during the phase.
+    """
+
+    enabled = True
+
+    def __init__(self, trace_memory=True, sample_rss=False):
+        """
+        INPUTS:
+        trace_memory    (default=True): Boolean specifier for whether allocations are traced using tracemalloc. This
+                                        measures the bytes allocated by each phase, at some cost in speed.
+        sample_rss      (default=False):Boolean specifier for whether the resident set size of the process is
+                                        sampled in a background thread, see memory.RSSSampler.
+        """
+
+        self.phases = {}
+        self.iterations = []
+        self.start_time = time.time()
+
+        self.trace_memory = trace_memory
+        self.started_tracing = False
+        self._stack = []
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+        self.rss_sampler = memory.RSSSampler() if sample_rss else None
+
+    def phase(self, name, *arrays):
+        """
+        Returns a context manager which times the enclosed code as part of the named phase.
+
+        INPUTS:
+        name    (no default):   Name of the phase, e.g. "decomposition".
+        arrays  (no default):   Arrays processed by the phase. The largest of these is recorded.
+        """
+
+        return _Phase(self, name, arrays)
+
+    def record(self, kind, **fields):
+        """
+        Records an iteration.
+
+        INPUTS:
+        kind    (no default):   Kind of iteration, e.g. "major" or "minor".
+        fields  (no default):   Quantities describing the iteration.
+        """
+
+        fields["kind"] = kind
+        fields["time"] = time.time() - self.start_time
+
+        self.iterations.append(fields)
+
+    def _stats(self, name):
+        if name not in self.phases:
+            self.phases[name] = dict(calls=0, time=0.0, allocated_bytes=0, peak_bytes=0, max_array_bytes=0,
+                                     max_array_shape=None)
+        return self.phases[name]
+
+    def _enter(self, name, arrays):
+        stats = self._stats(name)
+        stats["calls"] += 1
+
+        for array in arrays:
+            nbytes = getattr(array, "nbytes", 0)
+            if nbytes>stats["max_array_bytes"]:
+                stats["max_array_bytes"] = int(nbytes)
+                stats["max_array_shape"] = list(np.shape(array))
+
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+
+            # The peak is reset for each phase. The peak of the enclosing phase so far is kept on the stack first.
+
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+
+            self._stack.append([current, 0])
+
+        if self.rss_sampler is not None:
+            self.rss_sampler.enter(name)
+
+        return time.time()
+
+    def _exit(self, name, start_time):
+        stats = self.phases[name]
+        stats["time"] += time.time() - start_time
+
+        if self.rss_sampler is not None:
+            self.rss_sampler.exit(name)
+            stats["peak_rss_bytes"] = self.rss_sampler.peaks[name]
+
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            start, child_peak = self._stack.pop()
+
+            # Nested phases pass their peaks on to the enclosing phase, as they reset the peak.
+
+            peak = max(peak, child_peak)
+
+            stats["allocated_bytes"] += max(peak - start, 0)
+            stats["peak_bytes"] = max(stats["peak_bytes"], peak - start)
+
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+
+    def summary(self):
+        """
+        Returns the collected statistics as a dictionary, suitable for conversion to JSON.
+        """
+
+        summary = dict(total_time=time.time() - self.start_time, trace_memory=self.trace_memory,
+                       phases=self.phases, iterations=self.iterations)
+
+        if self.rss_sampler is not None:
+            summary["peak_rss_bytes"] = max(self.rss_sampler.peak, memory.peak_rss())
+
+        return summary
+
+    def save(self, name):
+        """
+        Writes the collected statistics to a JSON file.
+
+        INPUTS:
+        name    (no default):   Name of the output file. Will overwrite.
+        """
+
+        with open(name, "w") as out_file:
+            json.dump(self.summary(), out_file, indent=2, default=to_json)
+
+        logger.info("Profile written to {}.".format(name))
+
+    def close(self):
+        """
+        Stops tracing allocations if this profiler started it, and stops sampling the resident set size.
+        """
+
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+        if self.rss_sampler is not None:
+            self.rss_sampler.close()
+
+
+class _Phase(object):
+    """
+    Context manager returned by Profiler.phase.
+    """
+
+    __slots__ = ["profiler", "name", "arrays", "start_time"]
+
+    def __init__(self, profiler, name, arrays):
+        self.profiler = profiler
+        self.name = name
+        self.arrays = arrays
+
+    def __enter__(self):
+        self.start_time = self.profiler._enter(self.name, self.arrays)
+
+    def __exit__(self, *exc_info):
+        self.profiler._exit(self.name, self.start_time)
+        return False
+
+
+class NullProfiler(object):
+    """
+    Profiler which does nothing. Used when profiling is disabled, so that instrumented code costs no more than a
+    method call.
+    """
+
+    enabled = False
+
+    def phase(self, name, *arrays):
+        return _NULL_PHASE
+
+    def record(self, kind, **fields):
+        pass
+
+
+class _NullPhase(object):
+    """
+    Context manager returned by NullProfiler.phase.
+    """
+
+    __slots__ = []
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+NULL_PROFILER = NullProfiler()
+
+
+def to_json(value):
+    """
+    Converts numpy scalars for json.dump and json.dumps.
+    """
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    raise TypeError("{} is not JSON serialisable.".format(type(value)))
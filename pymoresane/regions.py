@@ -0,0 +1,236 @@
+import logging
+import numpy as np
+import pymoresane.iuwt as iuwt
+import pymoresane.iuwt_convolution as conv
+import pymoresane.iuwt_toolbox as tools
+from scipy import ndimage, stats
+from pymoresane.beam_fit import FWHM, beam_covariance
+
+logger = logging.getLogger(__name__)
+
+# Default maximum fraction of the image which the regions of interest may cover. Beyond this, deconvolving the
+# windows one by one is unlikely to be cheaper than deconvolving the full image.
+
+REGION_FRACTION = 0.5
+
+
+def significance_map(image, scale_count, sigma_level=4, neg_comp=False, edge_suppression=False, edge_offset=0,
+                     edge_excl=0, int_excl=0, decom_mode="ser", core_count=1):
+    """
+    Determines where an image contains significant emission, from the thresholded wavelet coefficients of its
+    residual up to scale_count. This is a single decomposition without any deconvolution. Islands of coefficients
+    above sigma_level are kept only if their peak is also above the level at which noise would be expected to exceed
+    it less than once in the whole decomposition, so that noise peaks do not give regions of their own. If the image
+    has a mask, the mask is used instead.
+
+    INPUTS:
+    image           (no default):       FitsImage which is to be deconvolved.
+    scale_count     (no default):       Maximum scale to be considered.
+    sigma_level     (default=4):        Number of sigma at which thresholding is to be performed.
+    neg_comp        (default=False):    Boolean specifier for whether negative coefficients are significant.
+    edge_suppression(default=False):    Boolean specifier for whether the coefficients corrupted by the edges are
+                                        ignored, see iuwt_toolbox.suppression_widths.
+    edge_offset     (default=0):        Number of additional edge pixels to be ignored.
+    edge_excl       (default=0):        Number of pixels to exclude from the edges when estimating the noise.
+    int_excl        (default=0):        Number of pixels to exclude from the centre when estimating the noise.
+    decom_mode      (default='ser'):    Specifier for decomposition mode - serial, multiprocessing, or gpu.
+    core_count      (default=1):        For multiprocessing, specifies the number of cores.
+
+    OUTPUTS:
+    significant                         Boolean array which is True where there is significant emission.
+    """
+
+    if image.mask is not None:
+        return image.mask>0
+
+    decomposition = iuwt.iuwt_decomposition(image.residual, scale_count, 0, decom_mode, core_count)
+
+    thresholds = tools.estimate_threshold(decomposition, edge_excl, int_excl)
+
+    if edge_suppression|(edge_offset>0):
+        tools.suppress_edges(decomposition, tools.suppression_widths(scale_count, edge_suppression, edge_offset))
+
+    # The significance of each pixel is that of its most significant coefficient, in units of the noise.
+
+    snr = np.zeros(image.dirty_data_shape, dtype=np.float32)
+
+    for i in range(scale_count):
+        coefficients = np.abs(decomposition[i,:,:]) if neg_comp else decomposition[i,:,:]
+        np.maximum(snr, coefficients/thresholds[i], out=snr)
+
+    peak_level = max(sigma_level, stats.norm.isf(1./decomposition.size))
+
+    labels, label_count = ndimage.label(snr>sigma_level, structure=np.ones([3,3]))
+
+    if label_count==0:
+        return labels>0
+
+    peaks = ndimage.maximum(snr, labels, np.arange(1, label_count + 1))
+
+    return np.concatenate(([False], np.asarray(peaks)>peak_level))[labels]
+
+
+def square_window(box, shape):
+    """
+    Returns the square window, of even size, which contains a box and lies within the image. The size is rounded up
+    to one for which the FFT is fast, so that windows share their PSF precomputations.
+
+    INPUTS:
+    box     (no default):   List of the first and last rows and columns of the box - [row0, row1, col0, col1].
+    shape   (no default):   Shape of the image.
+
+    OUTPUTS:
+    Tuple of slices selecting the window, or None if the window does not fit within the image.
+    """
+
+    size = 2*conv.fast_length(int(np.ceil(max(box[1] - box[0], box[3] - box[2])/2.)))
+
+    if size>min(shape):
+        return None
+
+    starts = [min(max((first + last - size)//2, 0), sz - size) for first, last, sz in zip(box[::2], box[1::2], shape)]
+
+    return tuple(slice(start, start + size) for start in starts)
+
+
+def overlap(window1, window2):
+    """
+    Determines whether or not two windows overlap.
+    """
+
+    return all((slice1.start<slice2.stop) and (slice2.start<slice1.stop) for slice1, slice2 in zip(window1, window2))
+
+
+def find_regions(image, scale_count, sigma_level=4, max_fraction=REGION_FRACTION, neg_comp=False,
+                 edge_suppression=False, edge_offset=0, edge_excl=0, int_excl=0, decom_mode="ser", core_count=1):
+    """
+    Finds the regions of an image which contain significant emission, see significance_map, and places a square
+    window around each. A window extends beyond its emission by the wavelet margin of scale_count and by the full width
+    at half maximum of the restoring beam, so that the wavelet coefficients and the PSF main lobe of every source
+    near its edge fall within it. Windows which overlap are merged.
+
+    INPUTS:
+    image           (no default):       FitsImage which is to be deconvolved.
+    scale_count     (no default):       Maximum scale to be considered.
+    sigma_level     (default=4):        Number of sigma at which thresholding is to be performed.
+    max_fraction    (default=0.5):      Maximum fraction of the image which the windows may cover. Beyond this the
+                                        emission is taken to be widespread and no windows are returned.
+    neg_comp        (default=False):    Boolean specifier for whether negative coefficients are significant.
+    edge_suppression(default=False):    Boolean specifier for whether the coefficients corrupted by the edges are
+                                        ignored, see iuwt_toolbox.suppression_widths.
+    edge_offset     (default=0):        Number of additional edge pixels to be ignored.
+    edge_excl       (default=0):        Number of pixels to exclude from the edges when estimating the noise.
+    int_excl        (default=0):        Number of pixels to exclude from the centre when estimating the noise.
+    decom_mode      (default='ser'):    Specifier for decomposition mode - serial, multiprocessing, or gpu.
+    core_count      (default=1):        For multiprocessing, specifies the number of cores.
+
+    OUTPUTS:
+    windows                             List of windows, as pairs of slices, ordered by their peak residual, or None
+                                        if the full image should be deconvolved.
+    """
+
+    significant = significance_map(image, scale_count, sigma_level, neg_comp, edge_suppression, edge_offset,
+                                   edge_excl, int_excl, decom_mode, core_count)
+
+    objects = ndimage.find_objects(ndimage.label(significant, structure=np.ones([3,3]))[0])
+
+    if not objects:
+        logger.info("No significant emission found - deconvolving the full image.")
+        return None
+
+    beam_params = image.precomputed.beam_parameters(image.psf_hdr, image.beam_params)
+    psf_margin = int(np.ceil(FWHM*np.sqrt(np.max(np.linalg.eigvalsh(beam_covariance(beam_params, image.psf_hdr))))))
+
+    # The wavelet margin is the distance over which the IUWT spreads the coefficients of a source, which is also the
+    # width of the border it corrupts.
+
+    margin = max(tools.suppression_widths(scale_count, True)[-1], psf_margin)
+
+    boxes = [[rows.start - margin, rows.stop + margin, columns.start - margin, columns.stop + margin]
+             for rows, columns in objects]
+
+    # Overlapping windows are replaced by the window of the union of their boxes until none overlap. Windows which do
+    # not fit within the image mean that the emission is too extended for this approach.
+
+    while True:
+        windows = [square_window(box, image.dirty_data_shape) for box in boxes]
+
+        if any(window is None for window in windows):
+            logger.info("Emission is too extended for regions of interest - deconvolving the full image.")
+            return None
+
+        pairs = [(i, j) for i in range(len(windows)) for j in range(i + 1, len(windows))
+                 if overlap(windows[i], windows[j])]
+
+        if not pairs:
+            break
+
+        i, j = pairs[0]
+        boxes[i] = [min(boxes[i][0], boxes[j][0]), max(boxes[i][1], boxes[j][1]),
+                    min(boxes[i][2], boxes[j][2]), max(boxes[i][3], boxes[j][3])]
+        del boxes[j]
+
+    covered = sum((window[0].stop - window[0].start)**2 for window in windows)
+
+    if covered>max_fraction*np.prod(image.dirty_data_shape):
+        logger.info("Regions of interest cover {:.0%} of the image - deconvolving the full image."
+                    .format(float(covered)/np.prod(image.dirty_data_shape)))
+        return None
+
+    # The brightest regions are deconvolved first, so that their sidelobes are removed from the others.
+
+    windows.sort(key=lambda window: -np.max(image.residual[window]))
+
+    return windows
+
+
+def deconvolve_regions(image, single_run=False, max_fraction=REGION_FRACTION, **params):
+    """
+    Deconvolves only the regions of an image which contain significant emission, see find_regions. The window of each
+    region is deconvolved in turn by FitsImage.moresane or FitsImage.moresane_by_scale, whose residual is always that
+    of the full image, so that the sidelobes of each region are removed from the others. If the emission is
+    widespread, the full image is deconvolved instead. The result is stored in image.model and image.residual.
+
+    INPUTS:
+    image           (no default):       FitsImage which is to be deconvolved.
+    single_run      (default=False):    Boolean specifier for whether FitsImage.moresane is used rather than
+                                        FitsImage.moresane_by_scale.
+    max_fraction    (default=0.5):      Maximum fraction of the image which the windows may cover.
+    params          (no default):       Keyword arguments for FitsImage.moresane or FitsImage.moresane_by_scale. The
+                                        subregion is only used if the full image is deconvolved instead.
+    """
+
+    subregion = params.pop("subregion", None)
+
+    if subregion is None:
+        subregion = image.dirty_data_shape[0]
+
+    # The regions are found at the largest scale which is deconvolved.
+
+    max_scale = int(np.log2(image.dirty_data_shape[0]) - 1)
+
+    if single_run:
+        scale_count = min(params.get("scale_count") or max_scale, max_scale)
+    else:
+        scale_count = min(params.get("stop_scale", 20), max_scale)
+
+    windows = find_regions(image, scale_count, params.get("sigma_level", 4), max_fraction,
+                           params.get("neg_comp", False), params.get("edge_suppression", False),
+                           params.get("edge_offset", 0), params.get("edge_excl", 0), params.get("int_excl", 0),
+                           params.get("decom_mode", "ser"), params.get("core_count", 1))
+
+    if windows is None:
+        windows = [subregion]
+    else:
+        logger.info("Deconvolving {} regions of interest of {}.".format(len(windows), ", ".join(
+                    "{}px at ({}, {})".format(window[0].stop - window[0].start, window[0].start, window[1].start)
+                    for window in windows)))
+
+    for window in windows:
+        if single_run:
+            image.moresane(subregion=window, **params)
+        else:
+            image.moresane_by_scale(subregion=window, **params)
+
+        if image.hooks.stop_requested:
+            break
@@ -0,0 +1,525 @@
+import json
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import numpy as np
+import pymoresane.batch as batch
+import pymoresane.distributed as distributed
+import pymoresane.precompute as precompute
+import pymoresane.shared as shared
+
+from collections import OrderedDict
+from pymoresane.api import Deconvolution, as_plane
+from pymoresane.main import deconvolution_parameters, output_names, read_plane, run_parameters, save_parameters
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+logger = logging.getLogger(__name__)
+
+# The number of finished jobs whose status is kept by a server.
+
+_HISTORY_SIZE = 1000
+
+# Images which a job may pass in shared memory, and the images it may receive in shared memory.
+
+_SHARED_INPUTS = ("dirty", "psf", "mask")
+_SHARED_OUTPUTS = ("model", "residual", "restored")
+
+
+def shared_descriptor(entry):
+    """
+    Converts a shared memory entry of a job, {"shm": name, "shape": shape, "dtype": dtype}, to the descriptor of a
+    shared.SharedArray. The data type defaults to single precision.
+    """
+
+    try:
+        return entry["shm"], tuple(int(sz) for sz in entry["shape"]), np.dtype(entry.get("dtype", "float32")).str
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Shared memory must be given as {\"shm\": name, \"shape\": shape, \"dtype\": dtype}.")
+
+
+def init_worker(cache_dir, started):
+    """
+    Initialises a worker process of a server.
+
+    INPUTS:
+    cache_dir   (no default):   Directory in which PSF precomputations are shared between workers.
+    started     (no default):   Queue on which the worker announces the jobs it starts.
+    """
+
+    batch.init_worker(cache_dir)
+
+    batch._worker["started"] = started
+
+
+def deconvolve_request(args, inputs, outputs, pixel_size=None, beam=None):
+    """
+    Deconvolves a job of a server. Images are read from and written to files as runsane would, unless they are given
+    in shared memory.
+
+    INPUTS:
+    args        (no default):   Parsed arguments of the job, as returned by batch.parse_job.
+    inputs      (no default):   Dictionary of the descriptors of the input images in shared memory.
+    outputs     (no default):   Dictionary of the descriptors of the output images in shared memory. If empty, the
+                                images are written to files instead.
+    pixel_size  (default=None): Pixel size, see api.make_header. Required for a dirty image in shared memory unless
+                                the beam is in pixels.
+    beam        (default=None): Restoring beam parameters - BMAJ, BMIN and BPA.
+
+    OUTPUTS:
+    beam_params                 List of the restoring beam parameters.
+    """
+
+    # Shared memory belongs to the client, so it is attached without registering it with the resource tracker.
+
+    attached = dict((key, shared.SharedArray.attach(descriptor, track=False)) for key, descriptor in
+                    list(inputs.items()) + list(outputs.items()))
+
+    try:
+        if "dirty" in attached:
+            dirty_data, img_hdr = as_plane(attached["dirty"].array, "dirty image"), None
+        else:
+            dirty_data, img_hdr = read_plane(args.dirty)
+
+        # A PSF in shared memory cannot be recognised between jobs by its name, so its precomputations are shared
+        # through the disk cache only, which is keyed by the content of the PSF.
+
+        if "psf" in attached:
+            psf_data = np.asarray(as_plane(attached["psf"].array, "PSF"), dtype=np.float32)
+            psf_hdr = None
+            precomputed = precompute.PrecomputationCache(psf_data, dirty_data.shape,
+                                                         args.psfcache or batch._worker["cache_dir"])
+        else:
+            psf_data, psf_hdr, precomputed = batch.job_psf(args.psf, dirty_data.shape, args.psfcache)
+
+        if "mask" in attached:
+            mask = attached["mask"].array
+        elif args.mask is not None:
+            mask = read_plane(args.mask)[0]
+        else:
+            mask = None
+
+        deconvolution = Deconvolution(dirty_data, psf_data, pixel_size, beam, mask, img_hdr, psf_hdr,
+                                      precomputed=precomputed)
+
+        deconvolution.run(args.singlerun, **dict(run_parameters(args), **deconvolution_parameters(args)))
+
+        if outputs:
+            deconvolution.restore()
+
+            for key in _SHARED_OUTPUTS:
+                if key in attached:
+                    attached[key].array[...] = getattr(deconvolution, key).reshape(attached[key].shape)
+        else:
+            mef_name = args.outputname + ".fits" if args.outputformat=="mef" else None
+
+            deconvolution.save(*output_names(args), output_format=args.outputformat, mef_name=mef_name,
+                               **save_parameters(args))
+
+        return list(deconvolution.beam)
+
+    finally:
+        for array in attached.values():
+            array.close()
+
+
+def run_request(task):
+    """
+    Runs a job of a server in a worker process. Errors are reported rather than raised.
+
+    INPUTS:
+    task    (no default):   Tuple of the id of the job and the arguments of deconvolve_request.
+
+    OUTPUTS:
+    job_id                  Id of the job.
+    error                   Description of the error, or None if the job completed.
+    elapsed                 Time, in seconds, taken by the job.
+    beam_params             List of the restoring beam parameters, or None if the job failed.
+    """
+
+    job_id = task[0]
+
+    batch._worker["started"].put(job_id)
+
+    start_time = time.time()
+
+    try:
+        beam_params = deconvolve_request(*task[1:])
+    except Exception as error:
+        logger.exception("Job {} failed.".format(job_id))
+        return job_id, "{}: {}".format(type(error).__name__, error), time.time() - start_time, None
+
+    return job_id, None, time.time() - start_time, beam_params
+
+
+class Server(object):
+    """
+    Runs deconvolution jobs on a pool of processes which is kept for the lifetime of the server, so that the
+    interpreter, imports, PSFs and PSF precomputations are reused between jobs rather than set up for each one.
+
+    Jobs are submitted over a socket, see serve_forever. A job is a dictionary as in a manifest of runsane-batch -
+    dirty, psf and output entries together with any runsane options - but the dirty map, PSF and mask may instead be
+    given in shared memory as {"shm": name, "shape": shape, "dtype": dtype}. The model, residual and restored images
+    are then returned in shared memory as well, if the job gives an outputs dictionary of such entries, which the
+    client must have created with the shape of the dirty map. A job may also give a pixel_size and a restoring beam,
+    see api.Deconvolution.
+    """
+
+    def __init__(self, worker_count=None, max_pending=None, cache_dir=None, defaults=None):
+        """
+        INPUTS:
+        worker_count    (default=None): Number of jobs which are run at once. Defaults to the number of cores.
+        max_pending     (default=None): Maximum number of jobs, queued or running, which are held. Further jobs are
+                                        refused. Unlimited by default.
+        cache_dir       (default=None): Directory in which PSF precomputations are shared between jobs. Defaults to a
+                                        temporary directory which is removed when the server is closed.
+        defaults        (default=None): Parsed runsane arguments whose values are the defaults of every job.
+        """
+
+        self.worker_count = worker_count if worker_count is not None else mp.cpu_count()
+        self.max_pending = max_pending
+        self.defaults = defaults
+
+        self.temporary_cache = cache_dir is None
+        self.cache_dir = tempfile.mkdtemp(prefix="pymoresane-serve-") if self.temporary_cache else cache_dir
+
+        self.jobs = OrderedDict()
+        self.job_count = 0
+        self.completed = 0
+        self.failed = 0
+        self.start_time = time.time()
+
+        self.lock = threading.Condition()
+
+        self.started = mp.Queue()
+        self.pool = mp.Pool(self.worker_count, initializer=init_worker, initargs=(self.cache_dir, self.started))
+
+        self.started_thread = threading.Thread(target=self._watch_started, name="pymoresane-serve-started")
+        self.started_thread.daemon = True
+        self.started_thread.start()
+
+        self.socket_server = None
+
+    def _watch_started(self):
+        while True:
+            job_id = self.started.get()
+
+            if job_id is None:
+                break
+
+            # The result of a short job may arrive before the announcement of its start, which must then not
+            # overwrite the final state.
+
+            with self.lock:
+                if (job_id in self.jobs) and (self.jobs[job_id]["state"]=="queued"):
+                    self.jobs[job_id]["state"] = "running"
+                    self.jobs[job_id]["started"] = time.time()
+
+    def submit(self, job):
+        """
+        Queues a job.
+
+        INPUTS:
+        job     (no default):   Dictionary describing the job.
+
+        OUTPUTS:
+        job_id                  Id of the job.
+        """
+
+        job = dict(job)
+
+        inputs = {}
+        outputs = {}
+
+        for key in _SHARED_INPUTS:
+            if isinstance(job.get(key), dict):
+                inputs[key] = shared_descriptor(job.pop(key))
+
+        for key, entry in job.pop("outputs", {}).items():
+            if key not in _SHARED_OUTPUTS:
+                raise ValueError("Unknown output {}. Outputs are {}.".format(key, ", ".join(_SHARED_OUTPUTS)))
+            outputs[key] = shared_descriptor(entry)
+
+        pixel_size = job.pop("pixel_size", None)
+        beam = job.pop("beam", None)
+
+        with self.lock:
+            self.job_count += 1
+            job_id = str(job.get("id", self.job_count))
+
+        # Images in shared memory stand in for the files which runsane would otherwise require. Without output files,
+        # the output name is never used.
+
+        job["id"] = job_id
+
+        for key in ["dirty", "psf"]:
+            if key in inputs:
+                job[key] = "shm:" + inputs[key][0]
+            elif key not in job:
+                raise ValueError("Job {} has no {}.".format(job_id, key))
+
+        if outputs:
+            job.setdefault("output", job["dirty"])
+        elif "output" not in job:
+            raise ValueError("Job {} has neither an output nor outputs in shared memory.".format(job_id))
+
+        args = batch.parse_job(job, defaults=self.defaults, output_files=not outputs)
+
+        with self.lock:
+            if (job_id in self.jobs) and (self.jobs[job_id]["state"] in ("queued", "running")):
+                raise ValueError("Job {} is already queued.".format(job_id))
+
+            if (self.max_pending is not None) and (self.pending()>=self.max_pending):
+                raise ValueError("The queue is full ({} jobs).".format(self.max_pending))
+
+            self.jobs[job_id] = dict(id=job_id, state="queued", submitted=time.time(), started=None, elapsed=None,
+                                     error=None, beam=None)
+            self._trim()
+
+        self.pool.apply_async(run_request, [(job_id, args, inputs, outputs, pixel_size, beam)],
+                              callback=self._finished)
+
+        logger.info("Job {} queued.".format(job_id))
+
+        return job_id
+
+    def _finished(self, result):
+        job_id, error, elapsed, beam_params = result
+
+        with self.lock:
+            record = self.jobs.get(job_id)
+
+            if record is not None:
+                record.update(state="failed" if error else "completed", error=error, elapsed=elapsed,
+                              beam=beam_params)
+
+            if error:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+            self.lock.notify_all()
+
+        if error:
+            logger.error("Job {} failed after {:.1f}s: {}".format(job_id, elapsed, error))
+        else:
+            logger.info("Job {} completed in {:.1f}s.".format(job_id, elapsed))
+
+    def _trim(self):
+        finished = [job_id for job_id, record in self.jobs.items() if record["state"] in ("completed", "failed")]
+
+        for job_id in finished[:max(len(finished) - _HISTORY_SIZE, 0)]:
+            del self.jobs[job_id]
+
+    def pending(self):
+        """
+        Returns the number of jobs which are queued or running.
+        """
+
+        return sum(1 for record in self.jobs.values() if record["state"] in ("queued", "running"))
+
+    def status(self, job_id):
+        """
+        Returns a copy of the record of a job - its state (queued, running, completed or failed), its timings, its
+        error and its restoring beam parameters.
+        """
+
+        with self.lock:
+            if job_id not in self.jobs:
+                raise ValueError("Unknown job {}.".format(job_id))
+
+            return dict(self.jobs[job_id])
+
+    def wait(self, job_id, timeout=None):
+        """
+        Waits for a job to finish and returns its record, see status. If the timeout, in seconds, expires first, the
+        record of the unfinished job is returned.
+        """
+
+        end_time = time.time() + timeout if timeout is not None else None
+
+        with self.lock:
+            while (job_id in self.jobs) and (self.jobs[job_id]["state"] in ("queued", "running")):
+                remaining = end_time - time.time() if end_time is not None else None
+
+                if (remaining is not None) and (remaining<=0):
+                    break
+
+                self.lock.wait(remaining if remaining is not None else 1.0)
+
+        return self.status(job_id)
+
+    def health(self):
+        """
+        Returns a summary of the state of the server - its uptime, number of workers, the numbers of queued and
+        running jobs and the numbers of jobs which have completed and failed.
+        """
+
+        with self.lock:
+            states = [record["state"] for record in self.jobs.values()]
+
+            return dict(uptime=time.time() - self.start_time, workers=self.worker_count, queued=states.count("queued"),
+                        running=states.count("running"), completed=self.completed, failed=self.failed,
+                        max_pending=self.max_pending, cache_dir=self.cache_dir)
+
+    def handle(self, request):
+        """
+        Handles a request, which is a dictionary whose op entry is one of:
+
+        submit      Queues the job given by the job entry. Replies with its id.
+        status      Replies with the record of the job given by the id entry as job.
+        wait        As status, but first waits for the job to finish, for at most timeout seconds if given.
+        jobs        Replies with the records of all the jobs held as jobs.
+        health      Replies with the summary returned by health.
+        shutdown    Stops the server once the reply has been sent. Running jobs are completed first.
+
+        OUTPUTS:
+        Dictionary with an ok entry which is True on success. On failure, the error entry describes the error.
+        """
+
+        try:
+            op = request.get("op")
+
+            if op=="submit":
+                return dict(ok=True, id=self.submit(request["job"]))
+            elif op=="status":
+                return dict(ok=True, job=self.status(str(request["id"])))
+            elif op=="wait":
+                return dict(ok=True, job=self.wait(str(request["id"]), request.get("timeout")))
+            elif op=="jobs":
+                with self.lock:
+                    return dict(ok=True, jobs=[dict(record) for record in self.jobs.values()])
+            elif op=="health":
+                return dict(ok=True, **self.health())
+            elif op=="shutdown":
+                if self.socket_server is not None:
+                    threading.Thread(target=self.socket_server.shutdown).start()
+                return dict(ok=True)
+            else:
+                raise ValueError("Unknown op {}.".format(op))
+
+        except (KeyError, TypeError, ValueError) as error:
+            return dict(ok=False, error="{}: {}".format(type(error).__name__, error))
+
+    def serve_forever(self, address):
+        """
+        Accepts requests on a socket until a shutdown request is received. Each request is a line of JSON, to which
+        the server replies with a line of JSON - see handle. A connection may carry any number of requests.
+
+        INPUTS:
+        address     (no default):   The path of a UNIX socket, or HOST:PORT for a TCP socket. Jobs refer to files by
+                                    name, so a TCP socket should only be bound to a trusted interface.
+        """
+
+        server = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+
+                    try:
+                        response = server.handle(json.loads(line.decode()))
+                    except ValueError as error:
+                        response = dict(ok=False, error="Invalid request: {}".format(error))
+
+                    self.wfile.write((json.dumps(response) + "\n").encode())
+                    self.wfile.flush()
+
+        if ":" in address:
+            class SocketServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+                daemon_threads = True
+                allow_reuse_address = True
+
+            self.socket_server = SocketServer(distributed.parse_address(address), RequestHandler)
+        else:
+            class SocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+                daemon_threads = True
+
+            if os.path.exists(address):
+                os.remove(address)
+
+            self.socket_server = SocketServer(address, RequestHandler)
+
+        logger.info("Serving on {} with {} workers.".format(address, self.worker_count))
+
+        try:
+            self.socket_server.serve_forever()
+        finally:
+            self.socket_server.server_close()
+
+            if ":" not in address:
+                os.remove(address)
+
+    def close(self):
+        """
+        Waits for the queued jobs to finish and stops the workers.
+        """
+
+        self.pool.close()
+        self.pool.join()
+
+        self.started.put(None)
+        self.started_thread.join()
+
+        if self.temporary_cache:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+def send_request(address, request, timeout=None):
+    """
+    Sends a single request to a server and returns its reply.
+
+    INPUTS:
+    address     (no default):   Address of the server, as given to Server.serve_forever.
+    request     (no default):   Dictionary describing the request, see Server.handle.
+    timeout     (default=None): Time, in seconds, after which the request is abandoned.
+
+    OUTPUTS:
+    Dictionary containing the reply.
+    """
+
+    if ":" in address:
+        connection = socket.create_connection(distributed.parse_address(address), timeout)
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(address)
+
+    try:
+        connection.sendall((json.dumps(request) + "\n").encode())
+
+        reply = connection.makefile("rb").readline()
+    finally:
+        connection.close()
+
+    return json.loads(reply.decode())
+
+
+def serve(args):
+    """
+    Runs runsane as a daemon, see Server.
+
+    INPUTS:
+    args    (no default):   Parsed arguments, as returned by parser.handle_parser. The address, number of workers and
+                            queue size are given by args.serve, args.serveworkers and args.servequeue. The other
+                            arguments are the defaults of every job.
+    """
+
+    server = Server(args.serveworkers, args.servequeue, args.psfcache, args)
+
+    try:
+        server.serve_forever(args.serve)
+    except KeyboardInterrupt:
+        logger.info("Interrupted - finishing the running jobs.")
+    finally:
+        server.close()
@@ -0,0 +1,144 @@
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+
+class SharedArray(object):
+    """
+    A numpy array backed by a block of shared memory. Other processes may attach to the same memory using the
+    descriptor of the array, which avoids copying large arrays between processes.
+    """
+
+    def __init__(self, shape, dtype, name=None, track=True):
+        """
+        Creates a new block of shared memory, or attaches to an existing one if name is given.
+
+        INPUTS:
+        shape   (no default):   Shape of the array.
+        dtype   (no default):   Data type of the array.
+        name    (default=None): Name of an existing block of shared memory.
+        track   (default=True): Boolean specifier for whether an attached block is registered with the resource
+                                tracker of this process. Child processes share the tracker of their parent, but an
+                                unrelated process must not register the block, or it will be freed when that process
+                                exits.
+        """
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+
+        size = max(int(np.prod(self.shape))*self.dtype.itemsize, 1)
+
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        elif track:
+            self.shm = shared_memory.SharedMemory(name=name)
+        else:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                self.shm = shared_memory.SharedMemory(name=name)
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, in1, dtype=None):
+        """
+        Creates a shared copy of an array.
+        """
+
+        out1 = cls(np.shape(in1), in1.dtype if dtype is None else dtype)
+        out1.array[...] = in1
+
+        return out1
+
+    @classmethod
+    def attach(cls, descriptor, track=True):
+        """
+        Attaches to the shared array described by descriptor. See __init__ for track.
+        """
+
+        name, shape, dtype = descriptor
+
+        return cls(shape, dtype, name, track)
+
+    def descriptor(self):
+        """
+        Returns a picklable description of the array - its name, shape and data type.
+        """
+
+        return self.shm.name, self.shape, self.dtype.str
+
+    def close(self):
+        """
+        Releases this process' view of the shared memory. The block itself is freed once the owner has also called
+        close.
+        """
+
+        self.array = None
+        self.shm.close()
+
+        if self.owner:
+            self.shm.unlink()
+
+
+def share_entries(entries):
+    """
+    Copies a dictionary of arrays (or tuples of arrays) into shared memory.
+
+    INPUTS:
+    entries     (no default):   Dictionary whose values are arrays or tuples of arrays.
+
+    OUTPUTS:
+    shared                      Dictionary of the corresponding SharedArrays.
+    descriptors                 Dictionary of the corresponding descriptors, which may be sent to other processes.
+    """
+
+    shared = {}
+    descriptors = {}
+
+    for key, value in entries.items():
+        if isinstance(value, tuple):
+            shared[key] = tuple(SharedArray.from_array(np.asarray(array)) for array in value)
+            descriptors[key] = tuple(array.descriptor() for array in shared[key])
+        else:
+            shared[key] = SharedArray.from_array(np.asarray(value))
+            descriptors[key] = shared[key].descriptor()
+
+    return shared, descriptors
+
+
+def attach_entries(descriptors):
+    """
+    Attaches to a dictionary of shared arrays created by share_entries.
+
+    INPUTS:
+    descriptors (no default):   Dictionary of descriptors, as returned by share_entries.
+
+    OUTPUTS:
+    shared                      Dictionary of the corresponding SharedArrays.
+    entries                     Dictionary of the corresponding arrays.
+    """
+
+    shared = {}
+    entries = {}
+
+    for key, value in descriptors.items():
+        if isinstance(value[0], tuple):
+            shared[key] = tuple(SharedArray.attach(descriptor) for descriptor in value)
+            entries[key] = tuple(array.array for array in shared[key])
+        else:
+            shared[key] = SharedArray.attach(value)
+            entries[key] = shared[key].array
+
+    return shared, entries
+
+
+def close_entries(shared):
+    """
+    Closes every SharedArray in a dictionary created by share_entries or attach_entries.
+    """
+
+    for value in shared.values():
+        for array in (value if isinstance(value, tuple) else (value,)):
+            array.close()
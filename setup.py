@@ -11,5 +11,5 @@ setup(name='pymoresane',
       url='https://github.com/ratt-ru/PyMORESANE',
       packages=['pymoresane'],
       requires=['numpy', 'scipy', 'pyfits', 'pycuda'],
-      scripts=['pymoresane/bin/runsane'],
+      scripts=['pymoresane/bin/runsane', 'pymoresane/bin/runsane-worker', 'pymoresane/bin/runsane-batch'],
       )
@@ -0,0 +1,56 @@
+import numpy as np
+
+# Sources of the default synthetic sky - offsets (x, y) from the centre, peak flux and standard deviation in pixels.
+
+SOURCES = [(10, 20, 5., 1.), (-20, -5, 3., 3.), (0, 0, 4., 2.)]
+
+
+def synthetic_images(size=128, sources=SOURCES, noise=0.01, seed=0):
+    """
+    Creates a dirty map and PSF for tests. The PSF is an elliptical Gaussian with a weak ripple, and the dirty map is
+    the PSF convolved with a sky of Gaussian sources, plus Gaussian noise.
+
+    INPUTS:
+    size        (default=128):      Width of the square images.
+    sources     (default=SOURCES):  List of the sources of the sky, see SOURCES.
+    noise       (default=0.01):     Standard deviation of the noise.
+    seed        (default=0):        Seed of the noise.
+
+    OUTPUTS:
+    dirty                           Single precision array containing the dirty map.
+    psf                             Single precision array containing the PSF, with its peak at the centre.
+    """
+
+    y, x = np.mgrid[-size//2:size//2, -size//2:size//2]
+
+    psf = np.exp(-(x**2/(2*2.0**2) + y**2/(2*3.0**2))) + 0.05*np.cos(0.4*x)*np.exp(-(x**2 + y**2)/400.)
+    psf /= psf.max()
+
+    sky = np.zeros((size, size))
+
+    for (source_x, source_y, flux, sigma) in sources:
+        sky += flux*np.exp(-((x - source_x)**2 + (y - source_y)**2)/(2*sigma**2))
+
+    dirty = np.fft.fftshift(np.fft.irfft2(np.fft.rfft2(sky)*np.fft.rfft2(np.fft.ifftshift(psf)), s=(size, size)))
+    dirty += noise*np.random.RandomState(seed).randn(size, size)
+
+    return dirty.astype(np.float32), psf.astype(np.float32)
+
+
+def write_fits(name, data, pixel_size=1e-4):
+    """
+    Writes an image plane to a .fits file with FREQ and STOKES axes, as a dirty map or PSF is usually written.
+    Planes may be stacked along the FREQ axis by passing an array of three dimensions.
+    """
+
+    import pyfits
+
+    header = pyfits.Header()
+
+    for key, value in [('CTYPE1', 'RA---SIN'), ('CTYPE2', 'DEC--SIN'), ('CTYPE3', 'FREQ'), ('CTYPE4', 'STOKES'),
+                       ('CDELT1', -pixel_size), ('CDELT2', pixel_size)]:
+        header.update(key, value)
+
+    data = np.asarray(data, dtype=np.float32)
+
+    pyfits.PrimaryHDU(data.reshape((1,)*(4 - data.ndim) + data.shape), header).writeto(name, clobber=True)
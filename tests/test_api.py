@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+import pymoresane.api as api
+
+from synthetic import synthetic_images
+
+
+class TestApi(unittest.TestCase):
+
+    def setUp(self):
+        self.dirty, self.psf = synthetic_images(64)
+
+    def test_deconvolve_defaults(self):
+        model, residual, restored = api.deconvolve(self.dirty, self.psf)
+
+        self.assertEqual(model.shape, self.dirty.shape)
+        self.assertTrue(np.any(model))
+        self.assertLess(np.std(residual), 0.5*np.std(self.dirty))
+        self.assertEqual(restored.shape, self.dirty.shape)
+
+    def test_single_run(self):
+        deconvolution = api.Deconvolution(self.dirty[np.newaxis,np.newaxis], self.psf, pixel_size=1e-4)
+
+        model, residual = deconvolution.run(single_run=True, scale_count=3, loop_gain=0.2)
+
+        self.assertEqual(model.shape, self.dirty.shape)
+        self.assertLess(np.std(residual), 0.5*np.std(self.dirty))
+
+    def test_not_a_plane(self):
+        self.assertRaises(ValueError, api.Deconvolution, np.zeros((2, 64, 64)), self.psf)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pyfits
+import pymoresane.batch as batch
+
+from synthetic import synthetic_images, write_fits
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        dirty, psf = synthetic_images(64)
+
+        write_fits(self.name("dirty.fits"), dirty)
+        write_fits(self.name("psf.fits"), psf)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def name(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def test_read_manifest(self):
+        with open(self.name("jobs.csv"), "w") as manifest:
+            manifest.write("id,dirty,psf,output,loopgain,enforcepositivity\n"
+                           "a,dirty.fits,psf.fits,a,0.2,true\n"
+                           ",dirty.fits,psf.fits,b,,\n")
+
+        with open(self.name("jobs.json"), "w") as manifest:
+            json.dump(dict(defaults=dict(psf="psf.fits", loopgain=0.2),
+                           jobs=[dict(id="a", dirty="dirty.fits", output="a", enforcepositivity=True),
+                                 dict(dirty="dirty.fits", output="b", loopgain=0.1)]), manifest)
+
+        csv_jobs = batch.read_manifest(self.name("jobs.csv"))
+        json_jobs = batch.read_manifest(self.name("jobs.json"))
+
+        self.assertEqual(csv_jobs, [dict(id="a", dirty="dirty.fits", psf="psf.fits", output="a", loopgain="0.2",
+                                         enforcepositivity="true"),
+                                    dict(id="b", dirty="dirty.fits", psf="psf.fits", output="b")])
+        self.assertEqual(json_jobs, [dict(id="a", dirty="dirty.fits", psf="psf.fits", output="a", loopgain=0.2,
+                                          enforcepositivity=True),
+                                     dict(id="b", dirty="dirty.fits", psf="psf.fits", output="b", loopgain=0.1)])
+
+    def test_invalid_manifest(self):
+        with open(self.name("missing.csv"), "w") as manifest:
+            manifest.write("dirty,output\ndirty.fits,a\n")
+
+        with open(self.name("duplicate.json"), "w") as manifest:
+            json.dump([dict(dirty="dirty.fits", psf="psf.fits", output=output) for output in ["a", "a"]], manifest)
+
+        self.assertRaises(ValueError, batch.read_manifest, self.name("missing.csv"))
+        self.assertRaises(ValueError, batch.read_manifest, self.name("duplicate.json"))
+
+    def test_job_arguments(self):
+        job = dict(id="a", dirty="dirty.fits", psf="psf.fits", output="a", loopgain="0.2", enforcepositivity="true",
+                   singlerun=False)
+
+        self.assertEqual(batch.job_arguments(job, ["--scalecount", "3"]),
+                         ["dirty.fits", "psf.fits", "a", "--scalecount", "3", "--enforcepositivity", "--loopgain",
+                          "0.2"])
+
+        self.assertRaises(ValueError, batch.job_arguments, dict(job, unknown=1))
+
+    def test_parse_job(self):
+        job = dict(id="a", dirty="dirty.fits", psf="psf.fits", output="a", loopgain=0.2)
+
+        args = batch.parse_job(job)
+
+        self.assertEqual(args.loopgain, 0.2)
+        self.assertEqual(batch.marker_name(args), "a.done")
+
+        self.assertRaises(ValueError, batch.parse_job, dict(job, facetsize=32))
+        self.assertRaises(ValueError, batch.parse_job, dict(job, loopgain="high"))
+
+    def test_run_batch(self):
+        jobs = [dict(id=job_id, dirty=self.name("dirty.fits"), psf=self.name("psf.fits"), output=self.name(job_id),
+                     stopscale=2) for job_id in ["a", "b"]]
+        jobs.append(dict(id="c", dirty=self.name("nothing.fits"), psf=self.name("psf.fits"), output=self.name("c")))
+
+        summary = batch.run_batch(jobs, ["--convmode", "circular"], worker_count=1)
+
+        self.assertEqual((summary["completed"], summary["skipped"], summary["failed"]), (2, 0, 1))
+        self.assertEqual(summary["failures"][0]["id"], "c")
+
+        for job_id in ["a", "b"]:
+            with open(self.name(job_id + ".done")) as marker:
+                self.assertEqual(json.load(marker)["model"], self.name(job_id + "_model.fits"))
+
+            self.assertEqual(pyfits.getdata(self.name(job_id + "_restored.fits")).shape, (1, 1, 64, 64))
+
+        self.assertFalse(os.path.exists(self.name("c.done")))
+        self.assertTrue(np.array_equal(pyfits.getdata(self.name("a_model.fits")),
+                                       pyfits.getdata(self.name("b_model.fits"))))
+
+        # The completed jobs are skipped when the batch is run again, unless they are to be rerun.
+
+        summary = batch.run_batch(jobs, ["--convmode", "circular"], worker_count=1)
+
+        self.assertEqual((summary["completed"], summary["skipped"], summary["failed"]), (0, 2, 1))
+
+        summary = batch.run_batch(jobs[:2], ["--convmode", "circular"], worker_count=2, rerun=True)
+
+        self.assertEqual((summary["completed"], summary["skipped"], summary["failed"]), (2, 0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
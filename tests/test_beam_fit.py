@@ -1,6 +1,21 @@
 import pymoresane.beam_fit
 import unittest
+import numpy as np
 
 
 class TestBeamFit(unittest.TestCase):
-    pass
\ No newline at end of file
+
+    def test_recovers_gaussian_beam(self):
+        header = {"CDELT1": -1e-4, "CDELT2": 1e-4}
+
+        for beam_params in [[8e-4, 4e-4, -60.], [6e-4, 5e-4, 0.], [1e-3, 3e-4, 35.]]:
+            psf = pymoresane.beam_fit.gaussian_beam((256, 256), (128, 128), beam_params, header)
+
+            clean_beam, fitted_params = pymoresane.beam_fit.beam_fit(psf.astype(np.float32), header)
+
+            self.assertTrue(np.allclose(fitted_params, beam_params, rtol=1e-4, atol=1e-4))
+            self.assertTrue(np.allclose(clean_beam, psf, atol=1e-4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pymoresane.checkpoint as checkpoint
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.name = os.path.join(self.directory, "checkpoint.npy")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        model = np.random.rand(16, 16).astype(np.float32)
+        residual = np.random.rand(16, 16)
+
+        checkpoint.save_checkpoint(self.name, model, residual, 3, 7, 20, 0.5, 1)
+        state = checkpoint.load_checkpoint(self.name)
+
+        self.assertTrue(np.array_equal(state["model"], model))
+        self.assertTrue(np.array_equal(state["residual"], residual))
+        self.assertEqual(state["residual"].dtype, residual.dtype)
+        self.assertEqual((state["scale_count"], state["major_loop_niter"], state["total_niter"],
+                          state["std_current"], state["min_scale"]), (3, 7, 20, 0.5, 1))
+        self.assertEqual(os.listdir(self.directory), ["checkpoint.npy"])
+
+    def test_not_a_checkpoint(self):
+        np.save(self.name, np.zeros(4))
+        self.assertRaises(ValueError, checkpoint.load_checkpoint, self.name)
+
+
+if __name__ == "__main__":
+    unittest.main()
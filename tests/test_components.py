@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pymoresane.beam_fit as beam_fit
+import pymoresane.components as components
+import pymoresane.iuwt_convolution as conv
+
+
+class TestComponents(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        self.model = np.zeros((64, 64), dtype=np.float32)
+        self.model[[0, 20, 40, 63], [5, 63, 31, 10]] = [1., 2., -0.5, 3.]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        groups = [components.ComponentList.from_model(self.model, 1),
+                  components.ComponentList.from_model(0.3*self.model, 2)]
+        component_list = components.ComponentList.concatenate(groups)
+
+        name = os.path.join(self.directory, "model.npz")
+        component_list.save(name)
+        loaded = components.ComponentList.load(name)
+
+        self.assertEqual(loaded.shape, self.model.shape)
+        self.assertTrue(np.array_equal(loaded.scale, component_list.scale))
+        self.assertTrue(np.array_equal(loaded.to_model(), self.model + (0.3*self.model).astype(np.float32)))
+        self.assertTrue(np.array_equal(loaded.select(2).to_model(), (0.3*self.model).astype(np.float32)))
+
+    def test_restore(self):
+        header = {"CDELT1": -1., "CDELT2": 1.}
+
+        for beam_params in [[5., 3., -30.], [30., 12., 45.]]:
+            covariance = beam_fit.beam_covariance(beam_params, header)
+
+            for conv_mode in ["linear", "circular"]:
+                restored = components.ComponentList.from_model(self.model).restore(covariance, conv_mode)
+                expected = conv.gaussian_convolve(self.model, covariance, conv_mode)
+
+                self.assertTrue(np.allclose(restored, expected, atol=1e-5))
+
+    def test_not_a_component_list(self):
+        name = os.path.join(self.directory, "model.npy")
+        np.save(name, self.model)
+
+        self.assertRaises(ValueError, components.ComponentList.load, name)
+
+
+if __name__ == "__main__":
+    unittest.main()
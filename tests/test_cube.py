@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pyfits
+
+from pymoresane.cube import deconvolve_cube
+from pymoresane.main import FitsImage
+from synthetic import synthetic_images, write_fits
+
+# Parameters of the deconvolution of each plane.
+
+PARAMS = dict(conv_mode="circular", loop_gain=0.2, stop_scale=3)
+
+
+class TestCube(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        planes = [synthetic_images(64, seed=seed)[0] for seed in range(3)]
+        psf = synthetic_images(64)[1]
+
+        # The last plane is empty, so that it is left unchanged.
+
+        planes[1] *= 0.5
+        planes[2] *= 0
+
+        self.plane_names = [self.name("plane{}.fits".format(i)) for i in range(3)]
+
+        for plane, plane_name in zip(planes, self.plane_names):
+            write_fits(plane_name, plane)
+
+        write_fits(self.name("cube.fits"), np.array(planes))
+        write_fits(self.name("psf.fits"), psf)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def name(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def check_cube(self, worker_count):
+        deconvolve_cube(self.name("cube.fits"), self.name("psf.fits"), self.name("model.fits"),
+                        self.name("residual.fits"), self.name("restored.fits"), PARAMS, worker_count=worker_count)
+
+        cubes = [pyfits.getdata(self.name(cube_name)) for cube_name in ["model.fits", "residual.fits",
+                                                                         "restored.fits"]]
+
+        for i, plane_name in enumerate(self.plane_names):
+            image = FitsImage(plane_name, self.name("psf.fits"))
+            image.moresane_by_scale(**PARAMS)
+            image.restore()
+
+            for cube, plane in zip(cubes, [image.model, image.residual, image.restored]):
+                self.assertEqual(cube.shape, (1, 3, 64, 64))
+                self.assertTrue(np.array_equal(cube[0,i], plane))
+
+        self.assertFalse(np.any(cubes[0][0,2]))
+
+    def test_mask(self):
+        mask = np.zeros((64, 64), dtype=np.float32)
+        mask[:32] = 1
+
+        write_fits(self.name("mask.fits"), mask)
+
+        deconvolve_cube(self.name("cube.fits"), self.name("psf.fits"), self.name("model.fits"),
+                        self.name("residual.fits"), self.name("restored.fits"), PARAMS,
+                        mask_name=self.name("mask.fits"), worker_count=1)
+
+        image = FitsImage(self.plane_names[0], self.name("psf.fits"), mask_name=self.name("mask.fits"))
+        image.moresane_by_scale(**PARAMS)
+
+        self.assertTrue(np.array_equal(pyfits.getdata(self.name("model.fits"))[0,0], image.model))
+
+    def test_pipeline(self):
+        self.check_cube(1)
+
+    def test_pool(self):
+        self.check_cube(2)
+
+
+if __name__ == "__main__":
+    unittest.main()
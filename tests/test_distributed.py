@@ -0,0 +1,164 @@
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+import pyfits
+import pymoresane.distributed as distributed
+
+from pymoresane.api import Deconvolution
+from pymoresane.cube import deconvolve_cube
+from synthetic import synthetic_images, write_fits
+
+AUTHKEY = b"pymoresane-test"
+
+PARAMS = dict(conv_mode="circular", loop_gain=0.2, stop_scale=3)
+
+
+def lost_worker(address, fetched):
+    """
+    Leases a task and never completes it, as a worker which dies mid-task would.
+    """
+
+    manager = distributed.WorkerManager(address, AUTHKEY)
+    manager.connect()
+    board = manager.get_board()
+
+    while board.fetch("killed") is None:
+        time.sleep(0.05)
+
+    fetched.set()
+    time.sleep(600)
+
+
+class RecordingHandler(logging.Handler):
+    """
+    Keeps the messages of the records it handles.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def worker(address):
+    distributed.run_worker(address, AUTHKEY, poll_interval=0.05, heartbeat_interval=0.2)
+
+
+class TestDistributed(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        planes = [synthetic_images(64, seed=seed)[0] for seed in range(3)]
+        self.dirty, self.psf = synthetic_images(128)
+
+        write_fits(self.name("cube.fits"), np.array(planes))
+        write_fits(self.name("psf.fits"), synthetic_images(64)[1])
+
+        self.coordinator = distributed.Coordinator(("127.0.0.1", 0), AUTHKEY, worker_timeout=1)
+        self.processes = []
+
+    def tearDown(self):
+        self.coordinator.close()
+
+        for process in self.processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+
+        shutil.rmtree(self.directory)
+
+    def name(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def start_workers(self, count):
+        for i in range(count):
+            self.processes.append(mp.Process(target=worker, args=(self.coordinator.address,)))
+            self.processes[-1].start()
+
+    def test_cube_with_lost_worker(self):
+        deconvolve_cube(self.name("cube.fits"), self.name("psf.fits"), self.name("model.fits"),
+                        self.name("residual.fits"), self.name("restored.fits"), PARAMS, worker_count=2)
+
+        expected = [pyfits.getdata(self.name(cube_name)) for cube_name in ["model.fits", "residual.fits",
+                                                                           "restored.fits"]]
+
+        # The first task is leased to a worker which is then killed, so the task must be requeued once its lease
+        # expires and completed by one of the two remaining workers.
+
+        fetched = mp.Event()
+        lost = mp.Process(target=lost_worker, args=(self.coordinator.address, fetched))
+        lost.start()
+
+        handler = RecordingHandler()
+        logging.getLogger("pymoresane.distributed").addHandler(handler)
+
+        errors = []
+
+        def deconvolve():
+            try:
+                deconvolve_cube(self.name("cube.fits"), self.name("psf.fits"), self.name("remote_model.fits"),
+                                self.name("remote_residual.fits"), self.name("remote_restored.fits"), PARAMS,
+                                coordinator=self.coordinator)
+            except Exception as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=deconvolve)
+        thread.start()
+
+        self.assertTrue(fetched.wait(60))
+        lost.terminate()
+        lost.join()
+
+        self.start_workers(2)
+
+        thread.join(300)
+
+        logging.getLogger("pymoresane.distributed").removeHandler(handler)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(errors, [])
+        self.assertTrue(any(message.startswith("Worker killed lost - retrying") for message in handler.messages))
+
+        for cube_name, cube in zip(["remote_model.fits", "remote_residual.fits", "remote_restored.fits"], expected):
+            self.assertTrue(np.array_equal(pyfits.getdata(self.name(cube_name)), cube))
+
+    def test_close(self):
+        self.start_workers(2)
+
+        while len(self.coordinator.board.unreleased_workers())<2:
+            time.sleep(0.05)
+
+        start_time = time.time()
+        self.coordinator.close()
+
+        self.assertLess(time.time() - start_time, 1)
+        self.assertFalse(self.coordinator.server_thread.is_alive())
+
+        for process in self.processes:
+            process.join(10)
+            self.assertEqual(process.exitcode, 0)
+
+    def test_facets(self):
+        self.start_workers(2)
+
+        remote = Deconvolution(self.dirty, self.psf, pixel_size=1e-4)
+        remote.run(facet_size=80, facet_overlap=32, coordinator=self.coordinator, **PARAMS)
+
+        local = Deconvolution(self.dirty, self.psf, pixel_size=1e-4)
+        local.run(facet_size=80, facet_overlap=32, facet_workers=2, **PARAMS)
+
+        self.assertTrue(np.allclose(remote.model, local.model, atol=1e-5))
+        self.assertTrue(np.allclose(remote.residual, local.residual, atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
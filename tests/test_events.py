@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pymoresane.events as events
+
+from pymoresane.api import Deconvolution
+from synthetic import synthetic_images
+
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dirty, self.psf = synthetic_images(64)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hooks(self):
+        hooks = events.EventHooks()
+        received = []
+
+        def stop_on_second(event, fields):
+            received.append((event, fields["iteration"]))
+            return fields["iteration"]==2
+
+        hooks.add(stop_on_second, "major")
+
+        self.assertRaises(ValueError, hooks.add, stop_on_second, "unknown")
+        self.assertFalse(hooks.emit("minor", iteration=1))
+        self.assertFalse(hooks.emit("major", iteration=1))
+        self.assertTrue(hooks.emit("major", iteration=2))
+        self.assertTrue(hooks.emit("major", iteration=3))
+        self.assertEqual(received, [("major", 1), ("major", 2), ("major", 3)])
+
+        hooks.reset()
+        self.assertFalse(hooks.stop_requested)
+
+        hooks.remove(stop_on_second)
+        self.assertFalse(hooks.emit("major", iteration=2))
+
+    def test_stop_request(self):
+        deconvolution = Deconvolution(self.dirty, self.psf, pixel_size=1e-4)
+
+        completions = []
+
+        deconvolution.image.hooks.add(lambda event, fields: fields["iteration"]==1, "major")
+        deconvolution.image.hooks.add(lambda event, fields: completions.append(fields), "completion")
+
+        deconvolution.run(single_run=True, scale_count=3, loop_gain=0.2)
+
+        self.assertEqual(len(completions), 1)
+        self.assertEqual(completions[0]["major_loop_niter"], 1)
+        self.assertTrue(completions[0]["stopped"])
+
+        # The stop request is cleared when the next deconvolution starts.
+
+        del completions[:]
+
+        deconvolution.image.hooks.remove(deconvolution.image.hooks.callbacks["major"][0])
+        deconvolution.run(single_run=True, scale_count=3, loop_gain=0.2)
+
+        self.assertFalse(completions[0]["stopped"])
+        self.assertGreater(completions[0]["major_loop_niter"], 1)
+
+    def test_stop_request_by_scale(self):
+        deconvolution = Deconvolution(self.dirty, self.psf, pixel_size=1e-4)
+
+        scales = []
+
+        def stop_at_second_scale(event, fields):
+            scales.append(fields["scale_count"])
+            return fields["scale_count"]==2
+
+        deconvolution.image.hooks.add(stop_at_second_scale, "scale_change")
+
+        deconvolution.run(stop_scale=4, loop_gain=0.2)
+
+        self.assertEqual(scales, [1, 2])
+
+    def test_event_stream(self):
+        name = os.path.join(self.directory, "events.ndjson")
+        stream = events.EventStream(name)
+
+        deconvolution = Deconvolution(self.dirty, self.psf, pixel_size=1e-4)
+        deconvolution.image.hooks.add(stream)
+        deconvolution.run(stop_scale=2, loop_gain=0.2)
+
+        stream.close()
+
+        with open(name) as in_file:
+            lines = [json.loads(line) for line in in_file]
+
+        self.assertEqual([line["event"] for line in lines if line["event"]=="scale_change"], ["scale_change"]*2)
+        self.assertEqual(lines[-1]["event"], "completion")
+        self.assertFalse(lines[-1]["stopped"])
+        self.assertTrue(all("elapsed" in line and "timestamp" in line for line in lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+import pymoresane.facets as facets
+
+from pymoresane.api import Deconvolution
+from synthetic import synthetic_images
+
+
+class TestFacets(unittest.TestCase):
+
+    def test_layout(self):
+        layout, weights = facets.facet_layout((128, 128), 80, 32)
+
+        weight_sum = np.zeros((128, 128))
+
+        for facet, weight in zip(layout, weights):
+            weight_sum[facet] += weight
+
+        self.assertEqual(len(layout), 4)
+        self.assertTrue(np.allclose(weight_sum, 1))
+
+    def test_two_by_two_facets(self):
+        dirty, psf = synthetic_images(128)
+
+        deconvolution = Deconvolution(dirty, psf, pixel_size=1e-4)
+        model, residual = deconvolution.run(facet_size=80, facet_overlap=32, facet_workers=2, stop_scale=3,
+                                            loop_gain=0.2)
+
+        full = Deconvolution(dirty, psf, pixel_size=1e-4)
+        full_model, full_residual = full.run(stop_scale=3, loop_gain=0.2)
+
+        self.assertEqual(model.shape, dirty.shape)
+        self.assertLess(np.std(residual), 0.5*np.std(dirty))
+        self.assertLess(abs(np.sum(model) - np.sum(full_model)), 0.25*np.sum(full_model))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import subprocess
+import sys
+import unittest
+
+# Modules which are only required by the gpu modes or for plotting, and so must not be imported by default.
+
+DEFERRED_MODULES = ["pycuda", "scikits.cuda", "matplotlib", "pylab"]
+
+
+def run_python(statement):
+    """
+    Runs a statement in a fresh interpreter and returns its standard output.
+    """
+
+    return subprocess.check_output([sys.executable, "-c", statement]).decode()
+
+
+def import_time(module, repeat=5):
+    """
+    Returns the shortest time, in seconds, taken to import a module in a fresh interpreter.
+    """
+
+    statement = "import time; t = time.time(); import {}; print(time.time() - t)".format(module)
+
+    return min(float(run_python(statement)) for i in range(repeat))
+
+
+def benchmark():
+    """
+    Prints the time taken to import the modules used by runsane --help and by a deconvolution.
+    """
+
+    for module in ["pymoresane.parser", "pymoresane.main"]:
+        print("{:<24}{:.3f}s".format(module, import_time(module)))
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_deferred_imports(self):
+        statement = "import sys, pymoresane.main; print(' '.join(name for name in {!r} if name in sys.modules))"
+        self.assertEqual(run_python(statement.format(DEFERRED_MODULES)).strip(), "")
+
+    def test_parser_imports(self):
+        statement = "import sys, pymoresane.parser; print('numpy' in sys.modules)"
+        self.assertEqual(run_python(statement).strip(), "False")
+
+
+if __name__ == "__main__":
+    benchmark()
+    unittest.main()
@@ -1,6 +1,36 @@
 import pymoresane.iuwt_convolution
+import pymoresane.beam_fit
 import unittest
+import numpy as np
 
 
 class TestIuwtConvolution(unittest.TestCase):
-    pass
\ No newline at end of file
+
+    def test_gaussian_convolve(self):
+        header = {"CDELT1": -1., "CDELT2": 1.}
+
+        model = np.zeros((64, 64), dtype=np.float32)
+        model[[3, 20, 40, 60], [5, 62, 31, 10]] = [1., 2., 0.5, 3.]
+
+        # The beams are, in turn, convolved by the analytic transform, the analytic transform with one and with several
+        # aliases and by separable filtering.
+
+        for beam_params in [[5., 3., -30.], [2., 1.5, 20.], [0.94, 0.71, 20.], [4., 2., 0.]]:
+            covariance = pymoresane.beam_fit.beam_covariance(beam_params, header)
+
+            beam = pymoresane.beam_fit.gaussian_beam((128, 128), (64, 64), beam_params, header)
+            padded_model = pymoresane.iuwt_convolution.pad_array(model)
+            expected = np.fft.fftshift(np.fft.irfft2(np.fft.rfft2(padded_model)*np.fft.rfft2(beam)))[32:96,32:96]
+
+            restored = pymoresane.iuwt_convolution.gaussian_convolve(model, covariance, "linear")
+            self.assertTrue(np.allclose(restored, expected, atol=1e-6))
+
+            beam = pymoresane.beam_fit.gaussian_beam((64, 64), (32, 32), beam_params, header)
+            expected = np.fft.fftshift(np.fft.irfft2(np.fft.rfft2(model)*np.fft.rfft2(beam)))
+
+            restored = pymoresane.iuwt_convolution.gaussian_convolve(model, covariance, "circular")
+            self.assertTrue(np.allclose(restored, expected, atol=1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import numpy as np
+import pymoresane.memory as memory
+import pymoresane.minor_loop as minor
+
+from pymoresane.api import Deconvolution
+from synthetic import synthetic_images
+
+
+class TestMemory(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(memory.parse_size("512M"), 512*2**20)
+        self.assertEqual(memory.parse_size("4G"), 4*2**30)
+        self.assertEqual(memory.parse_size("1.5k"), 1536)
+        self.assertEqual(memory.parse_size(" 2 GiB "), 2*2**30)
+        self.assertEqual(memory.parse_size("3TB"), 3*2**40)
+        self.assertEqual(memory.parse_size("1000"), 1000)
+        self.assertEqual(memory.parse_size(1000), 1000)
+        self.assertEqual(memory.parse_size(2.5e3), 2500)
+        self.assertRaises(ValueError, memory.parse_size, "lots")
+        self.assertRaises(ValueError, memory.parse_size, "4P")
+
+    def test_plan_memory(self):
+        args = ((1024, 1024), (1024, 1024), 1024, 9, "linear", True)
+
+        estimates = [memory.estimate_memory(*args, plan=plan) for plan in memory.PLANS]
+
+        self.assertEqual(estimates, sorted(estimates, reverse=True))
+        self.assertEqual(len(set(estimates)), len(estimates))
+
+        # Each plan is chosen while the budget allows it, and the next, more frugal, plan once it does not.
+
+        for i, estimate in enumerate(estimates):
+            self.assertEqual(memory.plan_memory(estimate, *args), (memory.PLANS[i], estimate))
+
+            if i<len(estimates) - 1:
+                self.assertIs(memory.plan_memory(estimate - 1, *args)[0], memory.PLANS[i + 1])
+
+        with self.assertLogs("pymoresane.memory", "WARNING"):
+            plan, estimate = memory.plan_memory(estimates[-1] - 1, *args)
+
+        self.assertEqual((plan, estimate), (memory.PLANS[-1], estimates[-1]))
+
+    def test_divide_budget(self):
+        self.assertEqual(memory.divide_budget("1G", 8, 300*2**20), (3, 2**30//3))
+        self.assertEqual(memory.divide_budget("1G", 2, 300*2**20), (2, 2**29))
+        self.assertEqual(memory.divide_budget(2**20, 4, 2**30), (1, 2**20))
+
+    def test_budgeted_run(self):
+        dirty, psf = synthetic_images(64)
+
+        budget = memory.estimate_memory(dirty.shape, psf.shape, 64, 3, "circular", False, memory.PLANS[-1])
+
+        # The solver of the minor loop is wrapped to record the types with which it is called.
+
+        calls = []
+
+        def recording_minor_loop(operator, extracted_sources, recomposed_sources, *args):
+            result = minor_loop(operator, extracted_sources, recomposed_sources, *args)
+            calls.append((operator.psf_fft.dtype, extracted_sources.dtype, result[0].dtype))
+            return result
+
+        minor_loop = minor.minor_loop
+        minor.minor_loop = recording_minor_loop
+
+        try:
+            budgeted = Deconvolution(dirty, psf, pixel_size=1e-4)
+            budgeted.run(single_run=True, scale_count=3, loop_gain=0.2, conv_mode="circular", memory_budget=budget)
+        finally:
+            minor.minor_loop = minor_loop
+
+        self.assertTrue(calls)
+        self.assertEqual(set(calls), set([(np.dtype(np.complex64), np.dtype(np.float32), np.dtype(np.float32))]))
+
+        # The results differ from those of an unbudgeted run only by rounding.
+
+        full = Deconvolution(dirty, psf, pixel_size=1e-4)
+        full.run(single_run=True, scale_count=3, loop_gain=0.2, conv_mode="circular")
+
+        self.assertTrue(np.allclose(budgeted.model, full.model, atol=1e-3*np.max(full.model)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pyfits
+import pymoresane.pipeline as pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_order(self):
+        outputs = []
+
+        pipeline.Pipeline(lambda task: 2*task, lambda task, data: data + 1,
+                          lambda task, data: outputs.append((task, data)), queue_size=1).run(range(20))
+
+        self.assertEqual(outputs, [(task, 2*task + 1) for task in range(20)])
+
+    def test_reader_error(self):
+        def read(task):
+            if task==3:
+                raise IOError("Unreadable plane.")
+            return task
+
+        written = []
+
+        self.assertRaises(IOError, pipeline.Pipeline(read, None, lambda task, data: written.append(task)).run,
+                          range(10))
+        self.assertTrue(set(written).issubset(range(3)))
+
+    def test_cube_file_writer(self):
+        name = os.path.join(self.directory, "cube.fits")
+        cube = np.random.rand(1, 3, 16, 24).astype(np.float32)
+
+        writer = pipeline.CubeFileWriter(name, pyfits.PrimaryHDU(cube).header, cube.shape)
+
+        for plane in [2, 0, 1]:
+            writer.write_plane(plane, cube[0,plane])
+
+        writer.close()
+
+        self.assertTrue(np.array_equal(pyfits.getdata(name), cube))
+
+    def write_images(self, output_format, mef_name=None):
+        images = [np.random.rand(32, 32).astype(np.float32) for i in range(2)]
+        names = [os.path.join(self.directory, "image{}.fits".format(i)) for i in range(2)]
+
+        header = pyfits.Header()
+        header.update('BUNIT', 'JY/BEAM')
+
+        writer = pipeline.OutputWriter(output_format, mef_name)
+
+        for name, image, extname in zip(names, images, ["MODEL", "RESIDUAL"]):
+            writer.write(name, image, header, extname)
+
+        # Later changes to the header do not affect the queued images.
+
+        header.update('BUNIT', 'JY/PIXEL')
+
+        writer.close()
+
+        return images, names
+
+    def test_output_writer_fits(self):
+        images, names = self.write_images("fits")
+
+        for name, image in zip(names, images):
+            self.assertTrue(np.array_equal(pyfits.getdata(name), image.reshape(1, 1, 32, 32)))
+            self.assertEqual(pyfits.getheader(name)['BUNIT'], 'JY/BEAM')
+
+    def test_output_writer_compressed(self):
+        images, names = self.write_images("compressed")
+
+        for name, image in zip(names, images):
+            hdus = pyfits.open(name)
+            self.assertTrue(np.array_equal(hdus[1].data, image.reshape(1, 1, 32, 32)))
+            self.assertEqual(hdus[1].header['BUNIT'], 'JY/BEAM')
+            hdus.close()
+
+    def test_output_writer_mef(self):
+        mef_name = os.path.join(self.directory, "images.fits")
+        images, names = self.write_images("mef", mef_name)
+
+        hdus = pyfits.open(mef_name)
+
+        self.assertEqual([hdu.header['EXTNAME'] for hdu in hdus], ["MODEL", "RESIDUAL"])
+
+        for hdu, image in zip(hdus, images):
+            self.assertTrue(np.array_equal(hdu.data, image.reshape(1, 1, 32, 32)))
+
+        hdus.close()
+
+        self.assertFalse(any(os.path.exists(name) for name in names))
+
+    def test_output_writer_arguments(self):
+        self.assertRaises(ValueError, pipeline.OutputWriter, "hdf5")
+        self.assertRaises(ValueError, pipeline.OutputWriter, "mef")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pymoresane.profiling as profiling
+
+from pymoresane.api import Deconvolution
+from synthetic import synthetic_images
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_phases(self):
+        profiler = profiling.Profiler()
+
+        try:
+            for i in range(2):
+                with profiler.phase("outer"):
+                    with profiler.phase("inner", np.zeros(10), np.zeros((4, 8))):
+                        data = np.ones(100000)
+                    del data
+
+            profiler.record("major", iteration=1, std_current=np.float32(0.5))
+
+            name = os.path.join(self.directory, "profile.json")
+            profiler.save(name)
+        finally:
+            profiler.close()
+
+        with open(name) as in_file:
+            summary = json.load(in_file)
+
+        phases = summary["phases"]
+
+        self.assertEqual((phases["outer"]["calls"], phases["inner"]["calls"]), (2, 2))
+        self.assertEqual(phases["inner"]["max_array_shape"], [4, 8])
+        self.assertGreaterEqual(phases["inner"]["peak_bytes"], 800000)
+        self.assertGreaterEqual(phases["outer"]["peak_bytes"], phases["inner"]["peak_bytes"])
+        self.assertEqual(summary["iterations"][0]["std_current"], 0.5)
+        self.assertEqual(summary["iterations"][0]["kind"], "major")
+
+    def test_moresane(self):
+        dirty, psf = synthetic_images(64)
+
+        deconvolution = Deconvolution(dirty, psf, pixel_size=1e-4)
+        deconvolution.image.profiler = profiling.Profiler(trace_memory=False)
+        deconvolution.run(single_run=True, scale_count=3, loop_gain=0.2)
+
+        summary = deconvolution.image.profiler.summary()
+
+        for phase in ["decomposition", "thresholding", "extraction", "recomposition", "minor_loop",
+                      "residual_update"]:
+            self.assertGreater(summary["phases"][phase]["calls"], 0)
+
+        major = [iteration for iteration in summary["iterations"] if iteration["kind"]=="major"]
+
+        self.assertEqual([iteration["iteration"] for iteration in major], list(range(1, len(major) + 1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
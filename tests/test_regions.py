@@ -0,0 +1,90 @@
+import unittest
+import numpy as np
+import pymoresane.beam_fit
+import pymoresane.precompute
+import pymoresane.regions
+
+from pymoresane.api import Deconvolution
+from synthetic import synthetic_images
+
+
+class RegionImage(object):
+    """
+    Holds the attributes of a FitsImage which find_regions uses.
+    """
+
+    def __init__(self, residual, mask=None):
+        self.psf_hdr = {"CDELT1": -1e-4, "CDELT2": 1e-4}
+        self.beam_params = None
+        self.residual = residual
+        self.mask = mask
+        self.dirty_data_shape = residual.shape
+
+        psf = pymoresane.beam_fit.gaussian_beam((256, 256), (128, 128), [4e-4, 3e-4, 0.], self.psf_hdr)
+
+        self.precomputed = pymoresane.precompute.PrecomputationCache(psf.astype(np.float32), residual.shape)
+
+
+class TestRegions(unittest.TestCase):
+
+    def setUp(self):
+        self.residual = 0.01*np.random.RandomState(1).randn(256, 256).astype(np.float32)
+
+    def test_compact_sources(self):
+        self.residual[60,60] += 1
+        self.residual[200,190] += 0.5
+
+        windows = pymoresane.regions.find_regions(RegionImage(self.residual), 3, edge_suppression=True)
+
+        self.assertEqual(len(windows), 2)
+        self.assertFalse(pymoresane.regions.overlap(windows[0], windows[1]))
+
+        for window, (y, x) in zip(windows, [(60, 60), (200, 190)]):
+            self.assertTrue((window[0].start<=y<window[0].stop) and (window[1].start<=x<window[1].stop))
+            self.assertEqual((window[0].stop - window[0].start)%2, 0)
+            self.assertEqual(window[0].stop - window[0].start, window[1].stop - window[1].start)
+
+    def test_widespread_emission(self):
+        mask = np.zeros((256, 256))
+        mask[20:230, 30:220] = 1
+
+        self.assertIsNone(pymoresane.regions.find_regions(RegionImage(self.residual, mask), 3))
+
+    def test_no_emission(self):
+        self.assertIsNone(pymoresane.regions.find_regions(RegionImage(self.residual), 3, edge_suppression=True))
+
+
+class TestDeconvolveRegions(unittest.TestCase):
+
+    def setUp(self):
+        self.dirty, self.psf = synthetic_images(256, [(-90, -80, 5., 1.), (80, 70, 3., 1.)])
+
+    def test_windows(self):
+        deconvolution = Deconvolution(self.dirty, self.psf, pixel_size=1e-4)
+
+        windows = pymoresane.regions.find_regions(deconvolution.image, 2, edge_suppression=True)
+
+        deconvolution.run(regions=True, stop_scale=2, edge_suppression=True, loop_gain=0.2)
+
+        inside = np.zeros(self.dirty.shape, dtype=bool)
+
+        for window in windows:
+            inside[window] = True
+
+        self.assertEqual(len(windows), 2)
+        self.assertFalse(np.any(deconvolution.model[~inside]))
+        self.assertLess(np.max(np.abs(deconvolution.residual)), 0.2*np.max(self.dirty))
+
+    def test_full_image_fallback(self):
+        deconvolution = Deconvolution(self.dirty, self.psf, pixel_size=1e-4)
+        deconvolution.run(regions=True, subregion=128, loop_gain=0.2)
+
+        full = Deconvolution(self.dirty, self.psf, pixel_size=1e-4)
+        full.run(subregion=128, loop_gain=0.2)
+
+        self.assertTrue(np.array_equal(deconvolution.model, full.model))
+        self.assertTrue(np.array_equal(deconvolution.residual, full.residual))
+
+
+if __name__ == "__main__":
+    unittest.main()
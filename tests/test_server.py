@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+import pyfits
+import pymoresane.server as server
+import pymoresane.shared as shared
+
+from synthetic import synthetic_images, write_fits
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dirty, self.psf = synthetic_images(64)
+
+        write_fits(self.name("dirty.fits"), self.dirty)
+        write_fits(self.name("psf.fits"), self.psf)
+
+        self.server = server.Server(worker_count=1)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def name(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def file_job(self, output, **options):
+        return dict(dirty=self.name("dirty.fits"), psf=self.name("psf.fits"), output=self.name(output),
+                    convmode="circular", stopscale=2, **options)
+
+    def test_submit_wait(self):
+        job_id = self.server.submit(self.file_job("a", id="a"))
+        failed_id = self.server.submit(dict(self.file_job("b"), dirty=self.name("nothing.fits")))
+
+        self.assertRaises(ValueError, self.server.submit, self.file_job("a", id="a"))
+        self.assertRaises(ValueError, self.server.submit, self.file_job("c", facetsize=32))
+
+        record = self.server.wait(job_id, timeout=300)
+
+        self.assertEqual(record["state"], "completed")
+        self.assertIsNone(record["error"])
+        self.assertEqual(len(record["beam"]), 3)
+        self.assertEqual(pyfits.getdata(self.name("a_model.fits")).shape, (1, 1, 64, 64))
+
+        record = self.server.wait(failed_id, timeout=300)
+
+        self.assertEqual(record["state"], "failed")
+        self.assertIsNotNone(record["error"])
+
+        health = self.server.health()
+
+        self.assertEqual((health["completed"], health["failed"], health["queued"], health["running"]), (1, 1, 0, 0))
+
+    def test_shared_memory(self):
+        file_id = self.server.submit(self.file_job("a"))
+
+        inputs = [shared.SharedArray.from_array(image) for image in [self.dirty, self.psf]]
+        outputs = [shared.SharedArray(self.dirty.shape, np.float32) for i in range(3)]
+
+        def entry(shared_array):
+            name, shape, dtype = shared_array.descriptor()
+            return dict(shm=name, shape=shape, dtype=dtype)
+
+        try:
+            job = dict(dirty=entry(inputs[0]), psf=entry(inputs[1]), pixel_size=1e-4, convmode="circular",
+                       stopscale=2, outputs=dict(zip(["model", "residual", "restored"], map(entry, outputs))))
+
+            shared_id = self.server.submit(job)
+
+            self.assertEqual(self.server.wait(file_id, timeout=300)["state"], "completed")
+            self.assertEqual(self.server.wait(shared_id, timeout=300)["state"], "completed")
+
+            for output, kind in zip(outputs, ["model", "residual"]):
+                self.assertTrue(np.array_equal(output.array, pyfits.getdata(self.name("a_{}.fits".format(kind)))[0,0]))
+        finally:
+            for shared_array in inputs + outputs:
+                shared_array.close()
+
+    def test_socket(self):
+        address = self.name("server.sock")
+
+        thread = threading.Thread(target=self.server.serve_forever, args=(address,))
+        thread.start()
+
+        while not os.path.exists(address):
+            time.sleep(0.01)
+
+        reply = server.send_request(address, dict(op="submit", job=self.file_job("a")), timeout=60)
+
+        self.assertTrue(reply["ok"])
+
+        reply = server.send_request(address, dict(op="wait", id=reply["id"], timeout=300), timeout=310)
+
+        self.assertEqual(reply["job"]["state"], "completed")
+        self.assertFalse(server.send_request(address, dict(op="unknown"), timeout=60)["ok"])
+        self.assertTrue(server.send_request(address, dict(op="shutdown"), timeout=60)["ok"])
+
+        thread.join(60)
+
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(address))
+
+
+if __name__ == "__main__":
+    unittest.main()